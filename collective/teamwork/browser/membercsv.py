@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import csv
 from cStringIO import StringIO
 
@@ -5,6 +6,7 @@ from zope.globalrequest import getRequest
 
 from collective.teamwork.interfaces import IWorkspaceContext
 from collective.teamwork.user.interfaces import IWorkspaceRoster
+from collective.teamwork.user.records import MemberRecord
 
 
 class WorkspaceMembershipCSV(object):
@@ -40,14 +42,16 @@ class WorkspaceMembershipCSV(object):
         self.schemakeys = []
 
     def _update_schema(self, members):
-        """introspect schema keys from property sheet on first member found"""
-        first = members[0]
-        sheet = first.getPropertysheet(first.listPropertysheets()[0])
+        """
+        Introspect schema keys from member records: base properties
+        (always, even if unset for the first member found), then any
+        other properties any member has.
+        """
+        found = OrderedDict.fromkeys(MemberRecord.BASE_PROPERTIES)
+        for record in members:
+            found.update((key, None) for key in record.propertyIds())
         # remove excluded keys from consideration:
-        schemakeys = filter(
-            lambda key: key not in self.EXCLUDE,
-            sheet.propertyIds(),
-            )
+        schemakeys = filter(lambda key: key not in self.EXCLUDE, found)
         # sorted base columns:
         base = [k for k in self.ORDER if k in schemakeys]
         # everything else, unsorted is appended to the sorted base:
@@ -58,8 +62,9 @@ class WorkspaceMembershipCSV(object):
         return dict((name, _get(name)) for name in self.schemakeys)
 
     def update(self, *args, **kwargs):
-        # get list of IPropertiedUser objects for all members
-        members = IWorkspaceRoster(self.context).values()
+        # get list of lightweight member records for all members
+        roster = IWorkspaceRoster(self.context)
+        members = roster.site_members.records(roster.keys())
         self._update_schema(members)
         self.info = map(self._info, members)
         self.output = StringIO()
@@ -11,7 +11,8 @@ class RosterView(object):
 
     def update(self):
         self.roster = IWorkspaceRoster(self.context)
-        self.members = self.roster.values()  # list of IPropertiedUser objects
+        # lightweight member records (not IPropertiedUser objects):
+        self.members = self.roster.site_members.records(self.roster.keys())
 
     def __call__(self, *args, **kwargs):
         self.update(*args, **kwargs)
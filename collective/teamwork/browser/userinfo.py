@@ -54,12 +54,6 @@ class UserInfo(object):
             self._secmgr = getSecurityManager()
         roster = self._roster
         data = {}  # use dict in lieu of object, simple
-        user = self._members.get(username, None)
-        if user is None or username not in roster:
-            return data  # empty if no user data or user not in workspace
-        portrait = self._members.portrait_for(username)
-        if portrait is not None:
-            data['portrait_url'] = portrait.absolute_url()
         propkeys = {
             'fullname': 'Full name',
             'email': 'Email',
@@ -68,6 +62,15 @@ class UserInfo(object):
             'home_page': 'Home page',
             'last_login_time': 'Last login',
             }
+        if username not in roster:
+            return data  # empty if user not in workspace
+        user = self._members.records([username], properties=propkeys)
+        if not user:
+            return data  # empty if no user data
+        user = user[0]
+        portrait = self._members.portrait_for(username)
+        if portrait is not None:
+            data['portrait_url'] = portrait.absolute_url()
         restricted = self.RESTRICTED_PROPS
         if self._secmgr.checkPermission('Manage users', self.context):
             restricted = ()  # manager can see these properties
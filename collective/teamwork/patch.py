@@ -1,4 +1,8 @@
+from importlib import import_module
+
+from Acquisition import aq_base, aq_inner, aq_parent
 from plone.app.layout.navigation.root import getNavigationRoot
+from Products.CMFCore.interfaces import ISiteRoot
 from Products.ATContentTypes.content.schemata import ATContentTypeSchema
 from Products.ATContentTypes.content.topic import ATTopic
 from Products.ATContentTypes.criteria.path import ATPathCriterionSchema
@@ -40,3 +44,106 @@ def patch_atct_buildquery():
     # apply the monkey patch:
     ATTopic.buildQuery = buildQuery
 
+
+def patch_pas_login_rename():
+    """
+    PAS does not notify anything on change of a user's login name, so
+    we wrap updateLoginName() (itself added to PAS by PlonePAS) to keep
+    the persistent user indexes (collective.teamwork.user.index) current
+    when login names are changed outside of SiteMembers.
+
+    Products.PlonePAS.pas must be imported (applying its patches to PAS,
+    which add updateLoginName) before this wraps the method; it is
+    imported here for that side effect.
+    """
+    import_module('Products.PlonePAS.pas')
+    from Products.PluggableAuthService.PluggableAuthService import \
+        PluggableAuthService
+    from collective.teamwork.user.index import reindex_principal
+
+    # ref to original method:
+    orig_updateLoginName = PluggableAuthService.updateLoginName
+
+    def updateLoginName(self, user_id, login_name):
+        """Update login name of user, then reindex the user"""
+        result = orig_updateLoginName(self, user_id, login_name)
+        site = aq_parent(aq_inner(self))
+        if ISiteRoot.providedBy(site):
+            reindex_principal(site, user_id)
+        return result
+
+    # apply the monkey patch:
+    PluggableAuthService.updateLoginName = updateLoginName
+
+
+def patch_pas_group_membership():
+    """
+    ZODBGroupManager (and its PlonePAS GroupManager subclass) notify
+    nothing on changes to groups or group membership, so we wrap the
+    methods making such changes, keeping the persistent group index
+    (collective.teamwork.user.index.GroupIndex) current when groups
+    are changed outside of collective.teamwork.
+
+    Principals are reindexed only when a wrapped call reports a change.
+    Removal of a group updates the index from the group's indexed
+    members, without reindexing each principal unassigned by the
+    plugin (ZODBGroupManager visits every principal with any group).
+    """
+    from functools import wraps
+    from Products.PlonePAS.plugins.group import GroupManager
+    from Products.PluggableAuthService.plugins.ZODBGroupManager import \
+        ZODBGroupManager
+    from collective.teamwork.user.index import plugin_group_index
+
+    _REMOVING = '_v_teamwork_removing_groups'
+
+    def principal_wrapper(orig):
+        @wraps(orig)
+        def wrapper(self, principal_id, group_id, *args, **kwargs):
+            result = orig(self, principal_id, group_id, *args, **kwargs)
+            if not result or group_id in getattr(aq_base(self), _REMOVING, ()):
+                return result  # unchanged, or group removal reindexes
+            index, acl_users = plugin_group_index(self)
+            if index is not None:
+                index.reindex(acl_users, principal_id)
+            return result
+        return wrapper
+
+    def group_wrapper(orig, action):
+        @wraps(orig)
+        def wrapper(self, group_id, *args, **kwargs):
+            result = orig(self, group_id, *args, **kwargs)
+            index, acl_users = plugin_group_index(self)
+            if index is not None:
+                getattr(index, action)(group_id)
+            return result
+        return wrapper
+
+    def remove_wrapper(orig):
+        @wraps(orig)
+        def wrapper(self, group_id, *args, **kwargs):
+            plugin = aq_base(self)
+            removing = getattr(plugin, _REMOVING, ())
+            setattr(plugin, _REMOVING, removing + (group_id,))
+            try:
+                result = orig(self, group_id, *args, **kwargs)
+            finally:
+                setattr(plugin, _REMOVING, removing)
+            index, acl_users = plugin_group_index(self)
+            if index is not None:
+                index.remove_group(group_id)  # via index.members_of()
+            return result
+        return wrapper
+
+    wrappers = {
+        'addPrincipalToGroup': principal_wrapper,
+        'removePrincipalFromGroup': principal_wrapper,
+        'addGroup': lambda orig: group_wrapper(orig, 'add_group'),
+        'removeGroup': remove_wrapper,
+        }
+
+    # apply the monkey patch, to methods defined by either class:
+    for klass in (ZODBGroupManager, GroupManager):
+        for name, wrapper in wrappers.items():
+            if name in klass.__dict__:
+                setattr(klass, name, wrapper(klass.__dict__[name]))
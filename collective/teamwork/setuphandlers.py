@@ -3,10 +3,16 @@ from StringIO import StringIO
 from borg.localrole.config import LOCALROLE_PLUGIN_NAME as STOCK_PLUGIN_NAME
 from borg.localrole.workspace import WorkspaceLocalRoleManager as STOCK_CLS
 from Products.CMFCore.utils import getToolByName
+from Products.PlonePAS.interfaces.group import IGroupManagement
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
 from Products.PlonePAS.Extensions.Install import activatePluginInterfaces
 
+from collective.teamwork.user.index import user_index, group_index
+from collective.teamwork.user.index import register_principals
+from collective.teamwork.user.search import search_index
 from collective.teamwork.user.localrole import manage_addEnhancedWorkspaceLRM
+from collective.teamwork.user.groupmanager import \
+    manage_addWorkspaceGroupManager
 
 
 def _install_replacement_plugin(portal, uf, out, name='enhanced_localroles'):
@@ -42,3 +48,82 @@ def replace_localrole_plugin(portal):
 def setup_localrole_plugin(context):
     replace_localrole_plugin(context.getSite())
 
+
+def install_user_index(portal):
+    """
+    Install (or rebuild existing) persistent login/userid index, user
+    search index, and group membership index used by
+    collective.teamwork.user.members.SiteMembers.
+    """
+    out = StringIO()
+    uf = getToolByName(portal, 'acl_users')
+    index = user_index(portal, create=True)
+    index.rebuild(uf)
+    print >> out, 'Indexed %s users from plugins: %s' % (
+        len(index),
+        ', '.join(index.plugins),
+        )
+    searchable = search_index(portal, create=True)
+    searchable.rebuild(uf, [userid for userid, login in index.items()])
+    print >> out, 'Indexed %s users for search' % len(searchable)
+    groups = group_index(portal, create=True)
+    groups.rebuild(uf)
+    print >> out, 'Indexed membership of %s groups from plugins: %s' % (
+        len(groups),
+        ', '.join(groups.plugins),
+        )
+    # membership storage for all users, ahead of assignment:
+    register_principals(portal, [userid for userid, _ in index.items()])
+    return out.getvalue()
+
+
+def setup_user_index(context):
+    if context.readDataFile('collective.teamwork.userindex.txt') is None:
+        return  # not our profile: do not rebuild indexes for every import
+    install_user_index(context.getSite())
+
+
+def upgrade_user_index(setup_tool):
+    """Upgrade step: build user indexes once for existing installations"""
+    portal = getToolByName(setup_tool, 'portal_url').getPortalObject()
+    install_user_index(portal)
+
+
+def install_group_plugin(portal, name='workspace_groups'):
+    """
+    Install the workspace group manager PAS plugin, and make it the
+    first group management plugin, such that new groups (including
+    workspace groups) are stored in it.  Existing groups remain in
+    the plugin storing them.  An installed group membership index is
+    rebuilt to include the plugin.
+    """
+    out = StringIO()
+    uf = getToolByName(portal, 'acl_users')
+    if name not in uf.objectIds():
+        manage_addWorkspaceGroupManager(uf, name)
+        activatePluginInterfaces(portal, name)
+        print >> out, 'Installed %s PAS group plugin' % name
+    else:
+        print >> out, '%s PAS group plugin already installed' % name
+    plugins = uf.plugins
+    ordered = lambda: plugins.listPluginIds(IGroupManagement)
+    while name in ordered() and ordered().index(name) > 0:
+        plugins.movePluginsUp(IGroupManagement, [name])
+    groups = group_index(portal)
+    if groups is not None:
+        groups.rebuild(uf)
+        print >> out, 'Indexed membership of %s groups from plugins: %s' % (
+            len(groups),
+            ', '.join(groups.plugins),
+            )
+    users = user_index(portal)
+    if users is not None:
+        # membership storage for existing users, ahead of assignment:
+        register_principals(portal, [userid for userid, _ in users.items()])
+    return out.getvalue()
+
+
+def setup_group_plugin(context):
+    if context.readDataFile('collective.teamwork.groups.txt') is None:
+        return  # not the profile installing the plugin
+    install_group_plugin(context.getSite())
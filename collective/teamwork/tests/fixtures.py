@@ -1,6 +1,8 @@
 # content fixtures shared across tests -- multi-adapter component
 # adapts test-suite and test layer
 
+import smtplib
+
 from plone.app.layout.navigation.defaultpage import isDefaultPage
 from plone.dexterity.interfaces import IDexterityFTI
 from plone.dexterity.utils import createContent
@@ -129,3 +131,47 @@ class CreateContentFixtures(object):
         # sub-team workspace:
         _add_team(team1, 'subteam')
 
+
+
+class LocalSMTP(object):
+    """
+    In-process stand-in for smtplib.SMTP, usable as smtp_factory for
+    collective.teamwork.user.mailqueue.MailQueue; records messages
+    sent (class-wide) instead of delivering them.  Set failures to
+    a number of sendmail() calls that should fail (transiently) before
+    succeeding, or refusals to a number that should be refused (5xx).
+    """
+
+    sent = []
+    connections = 0
+    failures = 0
+    refusals = 0
+
+    def __init__(self, host='localhost', port=25, timeout=None):
+        self.host, self.port, self.timeout = host, port, timeout
+        LocalSMTP.connections += 1
+
+    @classmethod
+    def reset(cls):
+        cls.sent = []
+        cls.connections = 0
+        cls.failures = 0
+        cls.refusals = 0
+
+    def starttls(self):
+        pass
+
+    def login(self, userid, password):
+        pass
+
+    def sendmail(self, mfrom, mto, text):
+        if LocalSMTP.refusals:
+            LocalSMTP.refusals -= 1
+            raise smtplib.SMTPDataError(554, 'stand-in refusal')
+        if LocalSMTP.failures:
+            LocalSMTP.failures -= 1
+            raise smtplib.SMTPServerDisconnected('stand-in failure')
+        LocalSMTP.sent.append((mfrom, mto, text))
+
+    def quit(self):
+        pass
@@ -0,0 +1,205 @@
+import unittest2 as unittest
+
+import transaction
+from plone.app.testing import TEST_USER_ID, setRoles
+from Products.PluggableAuthService.PropertiedUser import PropertiedUser
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from collective.teamwork.setuphandlers import install_group_plugin
+from collective.teamwork.tests.layers import DEFAULT_PROFILE_TESTING
+from collective.teamwork.user.groupmanager import WorkspaceGroupManager
+from collective.teamwork.user.index import group_index
+from collective.teamwork.user.interfaces import IGroups
+from collective.teamwork.user.members import SiteMembers
+
+
+class MembershipStorageTest(unittest.TestCase):
+    """Test concurrent writes to workspace group membership storage"""
+
+    def setUp(self):
+        self.db = DB(MappingStorage())
+        tm, root = self._open()
+        plugin = root['groups'] = WorkspaceGroupManager('groups')
+        plugin.addGroup('workspace-viewers')
+        plugin.addGroup('workspace-managers')
+        for principal_id in ('a', 'b'):
+            plugin.registerPrincipal(principal_id)  # as on user creation
+        tm.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _open(self):
+        tm = transaction.TransactionManager()
+        return tm, self.db.open(tm).root()
+
+    def _concurrently(self, first, second):
+        """
+        Commit changes to plugin made in two concurrent transactions;
+        ConflictError (if not resolved) propagates to fail the test.
+        """
+        tm1, root1 = self._open()
+        tm2, root2 = self._open()
+        first(root1['groups'])
+        second(root2['groups'])
+        tm1.commit()
+        tm2.commit()
+        return self._open()[1]['groups']
+
+    def test_concurrent_assignment(self):
+        group = 'workspace-viewers'
+        plugin = self._concurrently(
+            lambda plugin: plugin.addPrincipalToGroup('a', group),
+            lambda plugin: plugin.addPrincipalToGroup('b', group),
+            )
+        self.assertEqual(plugin.getGroupMembers(group), ('a', 'b'))
+        self.assertEqual(plugin.countGroupMembers(group), 2)
+
+    def test_concurrent_first_assignment(self):
+        """First assignments of one principal to different groups"""
+        assign = lambda group: (
+            lambda plugin: plugin.addPrincipalToGroup('a', group)
+            )
+        plugin = self._concurrently(
+            assign('workspace-viewers'),
+            assign('workspace-managers'),
+            )
+        self.assertEqual(
+            plugin.getGroupsForPrincipal(PropertiedUser('a')),
+            ('workspace-managers', 'workspace-viewers'),
+            )
+
+    def test_duplicate_assignment(self):
+        group = 'workspace-viewers'
+        add = lambda plugin: plugin.addPrincipalsToGroup(['a', 'b'], group)
+        plugin = self._concurrently(add, add)
+        self.assertEqual(
+            plugin.countGroupMembers(group),
+            len(plugin.getGroupMembers(group)),
+            )
+        self.assertEqual(plugin.getGroupMembers(group), ('a', 'b'))
+
+
+class GroupManagerTest(unittest.TestCase):
+    """Test workspace group manager PAS plugin"""
+
+    layer = DEFAULT_PROFILE_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        install_group_plugin(self.portal)
+        self.plugin = self.portal.acl_users.workspace_groups
+        self.site_members = SiteMembers(self.portal)
+        self.user1 = 'me@example.com'
+        self.user2 = 'you@example.com'
+        self.site_members.register(self.user1, send=False)
+        self.site_members.register(self.user2, send=False)
+        self.userids = [
+            self.site_members.userid_for(name)
+            for name in (self.user1, self.user2)
+            ]
+
+    def test_installation(self):
+        self.assertIsInstance(self.plugin, WorkspaceGroupManager)
+        install_group_plugin(self.portal)  # idempotent
+        groups = IGroups(self.portal)
+        groups.add('workspace-viewers', title=u'Viewers')
+        self.assertIn('workspace-viewers', self.plugin.listGroupIds())
+        self.assertNotIn(
+            'workspace-viewers',
+            self.portal.acl_users.source_groups.listGroupIds(),
+            )
+        self.assertIn(self.plugin.getId(), group_index(self.portal).plugins)
+        self.assertEqual(groups['workspace-viewers'].title, u'Viewers')
+
+    def test_membership(self):
+        groups = IGroups(self.portal)
+        group = groups.add('workspace-viewers', members=[self.user1])
+        self.assertEqual(group.keys(), [self.user1])
+        self.assertEqual(
+            self.plugin.getGroupMembers('workspace-viewers'),
+            (self.userids[0],),
+            )
+        self.assertEqual(self.plugin.countGroupMembers('workspace-viewers'), 1)
+        group.assign_many([self.user1, self.user2])
+        self.assertEqual(self.plugin.countGroupMembers('workspace-viewers'), 2)
+        self.assertIn(
+            'workspace-viewers',
+            self.site_members.groups_for(self.user2),
+            )
+        index = group_index(self.portal)
+        self.assertEqual(
+            sorted(index.members_of('workspace-viewers')),
+            sorted(self.userids),
+            )
+        group.unassign(self.user1)
+        self.assertEqual(group.keys(), [self.user2])
+        self.assertEqual(self.plugin.countGroupMembers('workspace-viewers'), 1)
+        self.assertNotIn(
+            'workspace-viewers',
+            index.groups_for(self.userids[0]),
+            )
+        self.assertRaises(
+            KeyError,
+            self.plugin.addPrincipalToGroup,
+            self.userids[0],
+            'unknown-group',
+            )
+
+    def test_rename_remove(self):
+        groups = IGroups(self.portal)
+        groups.add('workspace-old', title=u'Old', members=[self.user1])
+        groups.add('workspace-outer')
+        self.plugin.addPrincipalToGroup('workspace-old', 'workspace-outer')
+        group = groups.rename('workspace-old', 'workspace-new')
+        self.assertEqual(group.keys(), [self.user1])
+        self.assertEqual(group.title, u'Old')
+        self.assertEqual(
+            self.plugin.getGroupMembers('workspace-outer'),
+            ('workspace-new',),
+            )
+        self.assertEqual(self.plugin.countGroupMembers('workspace-old'), 0)
+        index = group_index(self.portal)
+        self.assertNotIn('workspace-old', index)
+        self.assertEqual(
+            index.groups_for(self.userids[0]),
+            ['workspace-new'],
+            )
+        groups.remove('workspace-new')
+        self.assertEqual(self.plugin.getGroupMembers('workspace-outer'), ())
+        self.assertNotIn(
+            'workspace-new',
+            self.site_members.groups_for(self.user1),
+            )
+        self.assertNotIn('workspace-new', index)
+
+    def test_existing_groups(self):
+        """Groups created before plugin installation stay writable"""
+        source_groups = self.portal.acl_users.source_groups
+        source_groups.addGroup('legacy-group', title='Legacy')
+        install_group_plugin(self.portal)
+        groups = IGroups(self.portal)
+        group = groups['legacy-group']
+        group.assign(self.user1)
+        group.assign(self.user2)
+        self.assertEqual(
+            sorted(source_groups.getGroupMembers('legacy-group')),
+            sorted(self.userids),
+            )
+        self.assertNotIn('legacy-group', self.plugin.listGroupIds())
+        group.unassign(self.user1)
+        self.assertEqual(group.keys(), [self.user2])
+        group.title = u'Renamed title'
+        self.assertEqual(
+            source_groups.getGroupInfo('legacy-group')['title'],
+            'Renamed title',
+            )
+        groups.remove('legacy-group')
+        self.assertNotIn('legacy-group', source_groups.listGroupIds())
+        self.assertNotIn('legacy-group', groups)
+        # removing a group that does not exist leaves cached keys intact:
+        groups.add('workspace-kept')
+        groups.remove('legacy-group')
+        self.assertIn('workspace-kept', groups.keys())
@@ -2,11 +2,14 @@ import unittest2 as unittest
 
 from plone.app.testing import TEST_USER_ID, setRoles
 from Products.CMFPlone.utils import getToolByName
+from zope.globalrequest import setRequest
 
 from collective.teamwork.tests.layers import DEFAULT_PROFILE_TESTING
 from collective.teamwork.user.interfaces import IGroups
 from collective.teamwork.user.members import SiteMembers
-from collective.teamwork.user.groups import GroupInfo, Groups
+from collective.teamwork.user.groups import GroupInfo, Groups, group_info
+from collective.teamwork.user.groups import _identity_map
+from collective.teamwork.user.index import group_index
 
 
 class GroupAdaptersTest(unittest.TestCase):
@@ -67,6 +70,56 @@ class GroupAdaptersTest(unittest.TestCase):
         assert _old not in groups
         assert _new not in groups
 
+    def test_rename_in_place(self):
+        """Rename moves metadata, membership, and optionally local roles"""
+        groups = IGroups(self.portal)
+        _old, _new = ('rename_old', 'rename_new')
+        groups.add(_old, title=u'Old title', members=[self.user1])
+        self.groups_plugin.addPrincipalToGroup(_old, self.group1)
+        self.portal.invokeFactory('Folder', 'renamed_roles')
+        folder = self.portal['renamed_roles']
+        folder.manage_setLocalRoles(_old, ['Reader'])
+        folder.reindexObjectSecurity()
+        reports = []
+        _progress = lambda *args: reports.append(args)
+        group = groups.rename(_old, _new, localroles=True, progress=_progress)
+        self.assertEqual(group.name, _new)
+        self.assertEqual(group.title, u'Old title')
+        self.assertEqual(group.keys(), [self.user1])
+        self.assertNotIn(_old, groups)
+        self.assertIn(_new, GroupInfo(self.group1).nested())
+        self.assertEqual(folder.get_local_roles_for_userid(_new), ('Reader',))
+        self.assertEqual(folder.get_local_roles_for_userid(_old), ())
+        catalog = getToolByName(self.portal, 'portal_catalog')
+        self.assertEqual(
+            len(catalog.unrestrictedSearchResults(
+                allowedRolesAndUsers='user:%s' % _old)),
+            0,
+            )
+        self.assertIn(('members', 1, 1), reports)
+        self.assertEqual(reports[-1][0], 'localroles')
+        self.assertEqual(reports[-1][1], reports[-1][2])
+
+    def test_rename_roles_progress(self):
+        """Rename moves global roles, reports member progress per batch"""
+        groups = IGroups(self.portal)
+        groups.PROGRESS_INTERVAL = 1
+        _old, _new = ('rename_old', 'rename_new')
+        groups.add(_old, members=[self.user1, self.user2])
+        role_manager = self.portal.acl_users.portal_role_manager
+        role_manager.assignRolesToPrincipal(['Reviewer'], _old)
+        reports = []
+        _progress = lambda *args: reports.append(args)
+        groups.rename(_old, _new, progress=_progress)
+        self.assertEqual(reports, [('members', 1, 2), ('members', 2, 2)])
+        principal = self.portal.acl_users.getGroupById(_new)
+        self.assertEqual(
+            role_manager.getRolesForPrincipal(principal),
+            ('Reviewer',),
+            )
+        self.assertEqual(tuple(role_manager._principal_roles.get(_old, ())),
+                         ())
+
     def test_clone_groups(self):
         groups = IGroups(self.portal)
         _old, _new = ('rename_old', 'rename_new')
@@ -80,6 +133,26 @@ class GroupAdaptersTest(unittest.TestCase):
         assert _new in groups
         assert self.user1 in groups.get(_new)
 
+    def test_assign_unassign_many(self):
+        groups = IGroups(self.portal)
+        group = groups.get(self.group1)
+        users = [self.user1, self.user2]
+        self.assertRaises(
+            ValueError,
+            group.assign_many,
+            users + ['unknown@example.com'],
+            )
+        self.assertEqual(len(group), 0)  # validated before any assignment
+        group.assign_many(users)
+        self.assertEqual(set(group.keys()), set(users))
+        self.assertRaises(ValueError, groups.get(self.group2).unassign_many,
+                          users)
+        group.unassign_many([self.user1])
+        self.assertEqual(group.keys(), [self.user2])
+        # members are assigned in bulk on group creation:
+        created = groups.add('bulk_members', members=users)
+        self.assertEqual(set(created.keys()), set(users))
+
     def test_get_user(self):
         groups = IGroups(self.portal)
         group1 = groups[self.group1]
@@ -127,6 +200,153 @@ class GroupAdaptersTest(unittest.TestCase):
         self.assertNotIn(self.user2, group1)
         self.assertNotIn(self.user2, group2)
 
+    def test_identity_map(self):
+        """One GroupInfo per group name per request"""
+        setRequest(self.layer['request'])
+        groups = IGroups(self.portal)
+        group = groups.get(self.group1)
+        self.assertIs(groups[self.group1], group)
+        self.assertIs(IGroups(self.portal).get(self.group1), group)
+        self.assertIs(group_info(self.group1, self.portal), group)
+        # given members, GroupInfo is bound to that ISiteMembers:
+        members = SiteMembers(self.portal)
+        bound = group_info(self.group1, self.portal, members)
+        self.assertIs(bound._members, members)
+        self.assertIs(group_info(self.group1, self.portal, members), bound)
+        self.assertIs(group_info(self.group1, self.portal), group)
+        group.title = u'Changed title'
+        self.assertEqual(groups.get(self.group1).title, u'Changed title')
+        groups.refresh()
+        self.assertIsNot(groups.get(self.group1), group)
+
+    def test_incremental_group_ids(self):
+        """Group ids update in place on add/remove, order retained"""
+        groups = IGroups(self.portal)
+        before = list(groups.keys())
+        groups.add('incremental')
+        self.assertEqual(groups.keys(), before + ['incremental'])
+        self.assertIn('incremental', groups)
+        self.assertEqual(len(groups), len(before) + 1)
+        groups.remove('incremental')
+        self.assertEqual(groups.keys(), before)
+        self.assertNotIn('incremental', groups)
+        self.assertIsNone(groups.get('incremental'))
+        self.assertRaises(KeyError, lambda: groups['incremental'])
+        # a fresh adapter agrees with incrementally maintained ids:
+        self.assertEqual(IGroups(self.portal).keys(), groups.keys())
+
+    def test_prefetch(self):
+        """Group metadata for many groups is loaded in one pass"""
+        setRequest(self.layer['request'])
+        groups = IGroups(self.portal)
+        groups.add('prefetch-a', title=u'Group A', description=u'First')
+        groups.add('prefetch-b', title=u'Group B')
+        groups.refresh()
+        prefetched = groups.prefetch(prefix='prefetch-')
+        self.assertEqual(prefetched.keys(), ['prefetch-a', 'prefetch-b'])
+        self.assertEqual(prefetched['prefetch-a'].title, u'Group A')
+        self.assertEqual(prefetched['prefetch-a'].description, u'First')
+        self.assertEqual(prefetched['prefetch-b'].title, u'Group B')
+        # one members adapter and plugin list shared by all:
+        group_a, group_b = prefetched.values()
+        self.assertIs(group_a._members, groups.site_members)
+        self.assertIs(group_b._members, groups.site_members)
+        self.assertIs(group_a._introspection, group_b._introspection)
+        # seeded identity map is used by get(), values:
+        self.assertIs(groups.get('prefetch-a'), prefetched['prefetch-a'])
+        self.assertEqual(
+            [group.name for group in groups.values()],
+            groups.keys(),
+            )
+
+    def test_iteration_batches(self):
+        """Iteration creates group objects lazily, in batches"""
+        setRequest(self.layer['request'])
+        groups = IGroups(self.portal)
+        groups.BATCH_SIZE = 1
+        names = groups.keys()
+        identity_map = _identity_map(self.portal)
+        identity_map.clear()
+        iterator = groups.iteritems()
+        name, group = next(iterator)
+        self.assertEqual(name, names[0])
+        self.assertEqual(group.name, names[0])
+        self.assertEqual(identity_map.keys(), [names[0]])
+        self.assertEqual(
+            [g.name for g in groups.itervalues()],
+            names,
+            )
+
+    def test_generation_invalidation(self):
+        """Group objects are invalidated by group generation changes"""
+        index = group_index(self.portal)
+        first, second = GroupInfo(self.group1), GroupInfo(self.group1)
+        self.assertNotIn(self.user1, second.keys())
+        generation = index.group_generation(self.group1)
+        first.assign(self.user1)
+        self.assertGreater(index.group_generation(self.group1), generation)
+        self.assertIn(self.user1, second.keys())
+        # changes made directly in plugin are also seen:
+        self.groups_plugin.removePrincipalFromGroup(
+            self.site_members.userid_for(self.user1),
+            self.group1,
+            )
+        self.assertNotIn(self.user1, first.keys())
+        self.assertNotIn(self.user1, second.keys())
+
+    def test_nested_principals(self):
+        """Nested groups are distinguished from users in group keys"""
+        group = GroupInfo(self.group1)
+        group.assign(self.user1)
+        self.groups_plugin.addPrincipalToGroup(self.group2, self.group1)
+        group.refresh()
+        self.assertEqual(group.keys(), [self.user1])
+        self.assertEqual(group.nested(), [self.group2])
+        self.assertEqual(
+            self.site_members.login_names(
+                [self.site_members.userid_for(self.user1), 'unknown']
+                ).values(),
+            [self.user1],
+            )
+
+    def test_transitive_membership(self):
+        """Indirect membership via nested (even cyclic) groups"""
+        outer, inner = GroupInfo(self.group1), GroupInfo(self.group2)
+        outer.assign(self.user1)
+        inner.assign(self.user2)
+        self.groups_plugin.addPrincipalToGroup(self.group2, self.group1)
+        outer.refresh()
+        self.assertEqual(outer.keys(), [self.user1])
+        self.assertEqual(outer.keys(transitive=True), [self.user1, self.user2])
+        self.assertEqual(outer.nested(transitive=True), [self.group2])
+        self.assertEqual(
+            self.site_members.groups_for(self.user2, transitive=True),
+            [self.group2, self.group1],
+            )
+        self.assertEqual(self.site_members.groups_for(self.user2),
+                         [self.group2])
+        # closure is invalidated by membership change, cycles terminate:
+        self.groups_plugin.addPrincipalToGroup(self.group1, self.group2)
+        self.assertEqual(inner.nested(transitive=True), [self.group1])
+        self.assertEqual(
+            set(inner.keys(transitive=True)),
+            set([self.user1, self.user2]),
+            )
+        self.assertEqual(
+            set(SiteMembers(self.portal).groups_for(self.user1, True)),
+            set([self.group1, self.group2]),
+            )
+
+    def test_closure_cache_default_plugins(self):
+        """Shared group closures are used with default groups plugins"""
+        index = group_index(self.portal)
+        groupmakers = dict(self.site_members._groupmakers)
+        # recursive_groups derives groups, and is active but not indexed:
+        self.assertIn('recursive_groups', groupmakers)
+        self.assertNotIn('recursive_groups', index.plugins)
+        containing, adjacent = self.site_members._containing()
+        self.assertEqual(adjacent, index.containing_groups)
+
     def test_enumeration(self):
         """Test group enumeration"""
         groups = IGroups(self.portal)
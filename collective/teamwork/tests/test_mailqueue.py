@@ -0,0 +1,83 @@
+import time
+import unittest2 as unittest
+
+import transaction
+
+from collective.teamwork.tests.fixtures import LocalSMTP
+from collective.teamwork.user.mailqueue import MailQueue, SMTPSettings
+from collective.teamwork.user.mailqueue import message_for
+
+
+MESSAGE = """From: Site <site@example.com>
+To: Someone <someone@example.com>
+Subject: Test message
+
+Hello.
+"""
+
+
+class MailQueueTest(unittest.TestCase):
+    """Test transactional outbound mail queue"""
+
+    def setUp(self):
+        LocalSMTP.reset()
+        self.queue = MailQueue(smtp_factory=LocalSMTP, retry_delay=0)
+        self.settings = SMTPSettings('localhost', 25, None, None, False)
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_message_for(self):
+        message = message_for(MESSAGE)
+        self.assertEqual(message.mfrom, 'site@example.com')
+        self.assertIn('someone@example.com', message.mto[0])
+        self.assertEqual(message.attempts, 0)
+        self.assertIn('Date:', message.text)
+
+    def test_batch_delivery(self):
+        self.queue.put(self.settings, [message_for(MESSAGE)] * 5)
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 5)
+        # at most one connection per batch:
+        self.assertLessEqual(LocalSMTP.connections, 5)
+
+    def test_retry(self):
+        LocalSMTP.failures = 2
+        self.queue.put(self.settings, [message_for(MESSAGE)])
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 1)
+        LocalSMTP.reset()
+        LocalSMTP.failures = self.queue.retries + 1
+        self.queue.put(self.settings, [message_for(MESSAGE)])
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 0)  # gave up
+
+    def test_permanent_refusal(self):
+        LocalSMTP.refusals = 1
+        self.queue.put(self.settings, [message_for(MESSAGE)])
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 0)  # dropped, not retried
+        self.assertEqual(LocalSMTP.connections, 1)
+
+    def test_retry_does_not_block(self):
+        queue = MailQueue(smtp_factory=LocalSMTP, retry_delay=3600)
+        LocalSMTP.failures = 1
+        queue.put(self.settings, [message_for(MESSAGE)])
+        deadline = time.time() + 10
+        while LocalSMTP.failures and time.time() < deadline:
+            time.sleep(0.01)
+        # first message waits for retry; others still delivered:
+        queue.put(self.settings, [message_for(MESSAGE)])
+        while not LocalSMTP.sent and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(LocalSMTP.sent), 1)
+
+    def test_after_commit(self):
+        self.queue.after_commit(self.settings, [message_for(MESSAGE)])
+        transaction.abort()
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 0)  # never sent
+        self.queue.after_commit(self.settings, [message_for(MESSAGE)])
+        transaction.commit()
+        self.queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 1)
@@ -4,10 +4,19 @@ from Acquisition import aq_base
 from plone.app.testing import TEST_USER_ID, setRoles
 from Products.CMFPlone.utils import getToolByName
 from zope.component.hooks import getSite
+import transaction
 
+from collective.teamwork.browser.membercsv import WorkspaceMembershipCSV
+from collective.teamwork.setuphandlers import setup_user_index
+from collective.teamwork.tests.fixtures import LocalSMTP
 from collective.teamwork.tests.layers import DEFAULT_PROFILE_TESTING
+from collective.teamwork.user.index import user_index, group_index
 from collective.teamwork.user.interfaces import ISiteMembers, IGroups
+from collective.teamwork.user.mailqueue import MailQueue
 from collective.teamwork.user.members import SiteMembers
+from collective.teamwork.user.members import PURGED, UNKNOWN
+from collective.teamwork.user.records import MemberRecord
+from collective.teamwork.user import pas
 
 
 class MembershipTest(unittest.TestCase):
@@ -132,6 +141,27 @@ class MembershipTest(unittest.TestCase):
     def test_addremove_nocache(self):
         self.test_addremove_user(clearcache=True)
 
+    def test_purge_many(self):
+        _IDS = ['purge1@example.com', 'purge2@example.com']
+        _UNKNOWN = 'unknown-purge@example.com'
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, send=False)
+        orig_len = len(adapter)
+        userids = [adapter.userid_for(name) for name in _IDS]
+        result = adapter.purge_many(_IDS + [_UNKNOWN])
+        self.assertEqual(result.keys(), _IDS + [_UNKNOWN])
+        self.assertEqual(result[_IDS[0]], PURGED)
+        self.assertEqual(result[_IDS[1]], PURGED)
+        self.assertEqual(result[_UNKNOWN], UNKNOWN)
+        self.assertEqual(len(adapter), orig_len - len(_IDS))
+        index = user_index(self.portal)
+        for name, userid in zip(_IDS, userids):
+            self.assertNotIn(name, adapter)
+            self.assertNotIn(name, index)
+            self.assertIsNone(self._users.getUserById(userid))
+        self.assertRaises(KeyError, adapter.__delitem__, _UNKNOWN)
+
     def test_roles_groups_for_user(self):
         """test groups_for() and roles_for()"""
         _ID = 'user3@example.com'
@@ -143,11 +173,368 @@ class MembershipTest(unittest.TestCase):
         self.assertIn(_GROUP, adapter.groups_for(_ID))
         self.assertIn('Member', adapter.roles_for(self.portal, _ID))
 
+    def test_roles_for_many(self):
+        """Bulk roles matrix matches roles_for() for each principal"""
+        _IDS = ['roles1@example.com', 'roles2@example.com']
+        _GROUP = 'rolesgroup'
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, send=False)
+        self.groups_plugin.addGroup(_GROUP)
+        self.groups_plugin.addPrincipalToGroup(
+            adapter.userid_for(_IDS[0]),
+            _GROUP,
+            )
+        folder = self.portal[self.portal.invokeFactory('Folder', 'rolesf')]
+        folder.manage_setLocalRoles(_GROUP, ['Editor'])
+        folder.manage_setLocalRoles(adapter.userid_for(_IDS[1]), ['Reader'])
+        result = adapter.roles_for_many(folder, _IDS + [_GROUP, 'unknown'])
+        self.assertEqual(result.keys(), _IDS + [_GROUP])
+        for name in result:
+            self.assertEqual(
+                set(result[name]),
+                set(adapter.roles_for(folder, name)),
+                )
+        self.assertIn('Editor', result[_IDS[0]])  # via group
+        self.assertIn('Editor', result[_GROUP])
+        self.assertNotIn('Editor', result[_IDS[1]])
+        self.assertIn('Reader', result[_IDS[1]])
+        self.assertIn('Member', result[_IDS[1]])
+        self.assertRaises(KeyError, adapter.roles_for, folder, 'unknown')
+        # bulk local roles agree with per-user plugin results:
+        plugin = self.portal.acl_users.enhanced_localroles
+        users = [adapter.get(name) for name in _IDS]
+        self.assertEqual(
+            [set(r) for r in plugin.getRolesInContextForMany(users, folder)],
+            [set(plugin.getRolesInContext(u, folder)) for u in users],
+            )
+
+    def test_group_index(self):
+        """Group membership index is maintained on plugin changes"""
+        _IDS = ['grouped1@example.com', 'grouped2@example.com']
+        _GROUP, _NESTED = 'indexedgroup', 'indexednested'
+        index = group_index(self.portal)
+        self.assertIsNotNone(index)
+        self.assertIn('source_groups', index.plugins)
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, send=False)
+        userids = [adapter.userid_for(name) for name in _IDS]
+        self.groups_plugin.addGroup(_GROUP)
+        self.groups_plugin.addGroup(_NESTED)
+        self.assertIn(_GROUP, index)
+        self.groups_plugin.addPrincipalToGroup(userids[0], _GROUP)
+        self.groups_plugin.addPrincipalToGroup(_NESTED, _GROUP)
+        self.assertEqual(index.groups_for(userids[0]), [_GROUP])
+        self.assertEqual(
+            sorted(index.members_of(_GROUP)),
+            sorted([userids[0], _NESTED]),
+            )
+        result = adapter.groups_for_many(_IDS + [_NESTED, 'unknown'])
+        self.assertEqual(result.keys(), _IDS + [_NESTED])
+        self.assertIn(_GROUP, result[_IDS[0]])
+        self.assertNotIn(_GROUP, result[_IDS[1]])
+        self.assertIn(_GROUP, result[_NESTED])
+        self.assertEqual(
+            set(result[_IDS[0]]),
+            set(adapter.groups_for(_IDS[0])),
+            )
+        self.groups_plugin.removePrincipalFromGroup(userids[0], _GROUP)
+        self.assertEqual(index.groups_for(userids[0]), [])
+        # principals are reindexed only on change, not on group removal:
+        reindexed = []
+        index.reindex = lambda acl_users, principal: reindexed.append(
+            principal
+            )
+        self.groups_plugin.removePrincipalFromGroup(userids[1], _GROUP)
+        self.groups_plugin.removeGroup(_GROUP)
+        del index.reindex
+        self.assertEqual(reindexed, [])
+        self.assertNotIn(_GROUP, index)
+        self.assertEqual(index.groups_for(_NESTED), [])
+
+    def test_user_index(self):
+        """Persistent user index is installed and maintained incrementally"""
+        _ID = 'indexed@example.com'
+        index = user_index(self.portal)
+        self.assertIsNotNone(index)
+        self.assertIn('source_users', index.plugins)
+        adapter = SiteMembers(self.portal)
+        self.assertIs(adapter._index, index)
+        adapter.register(_ID, send=False)
+        self.assertIn(_ID, index)
+        userid = index.userid_for(_ID)
+        self.assertEqual(userid, adapter.get(_ID).getId())
+        self.assertEqual(index.login_for(userid), _ID)
+        self.assertEqual(adapter.userid_for(_ID), userid)
+        self.assertEqual(adapter.login_name(userid), _ID)
+        # index matches what plugin enumeration yields:
+        plugin = self._users.source_users
+        self.assertEqual(
+            sorted(index.items()),
+            sorted(pas.list_users(plugin)),
+            )
+        del(adapter[_ID])
+        self.assertNotIn(_ID, index)
+        self.assertIsNone(index.login_for(userid))
+
+    def test_user_index_setup_step(self):
+        """Index import step rebuilds only for its own profile"""
+
+        class _ImportContext(object):
+            def __init__(self, site, data):
+                self.site, self.data = site, data
+
+            def getSite(self):
+                return self.site
+
+            def readDataFile(self, filename):
+                return self.data
+
+        index = user_index(self.portal)
+        generation = index.generation()
+        setup_user_index(_ImportContext(self.portal, None))
+        self.assertEqual(index.generation(), generation)
+        setup_user_index(_ImportContext(self.portal, 'marker'))
+        self.assertGreater(index.generation(), generation)
+
+    def test_user_index_rename(self):
+        """Login name changes are reflected in user index"""
+        _ID, _NEW = 'oldlogin@example.com', 'newlogin@example.com'
+        index = user_index(self.portal)
+        adapter = SiteMembers(self.portal)
+        adapter.register(_ID, send=False)
+        userid = adapter.userid_for(_ID)
+        self._users.updateLoginName(userid, _NEW)
+        self.assertNotIn(_ID, index)
+        self.assertIn(_NEW, index)
+        self.assertEqual(index.userid_for(_NEW), userid)
+        self.assertIn(_NEW, adapter.keys())
+
+    def test_login_sequence_plugins(self):
+        """Only plugins known to match login sequences are batched"""
+        self.assertTrue(pas.matches_login_sequence(self._users.source_users))
+        self.assertFalse(
+            pas.matches_login_sequence(self._users.mutable_properties)
+            )
+
+    def test_contains_many(self):
+        """Bulk existence check, case-insensitive, with negative results"""
+        _IDS = ('many1@example.com', 'many2@example.com')
+        _UNKNOWN = 'nobody-many@example.com'
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, send=False)
+        result = adapter.contains_many(_IDS + (_UNKNOWN, 'MANY1@example.com'))
+        self.assertEqual(len(result), 3)  # normalized, de-duplicated keys
+        self.assertTrue(result[_IDS[0]])
+        self.assertTrue(result[_IDS[1]])
+        self.assertFalse(result[_UNKNOWN])
+        # negative answer is cached for request, but registration of
+        # the user (via any adapter for the site) invalidates:
+        self.assertNotIn(_UNKNOWN, adapter)
+        SiteMembers(self.portal).register(_UNKNOWN, send=False)
+        self.assertIn(_UNKNOWN, adapter)
+        self.assertTrue(adapter.contains_many([_UNKNOWN])[_UNKNOWN])
+
+    def test_get_many(self):
+        """Bulk user materialization matches single user get()"""
+        _IDS = ['bulkget1@example.com', 'bulkget2@example.com']
+        _GROUP = 'bulkgetgroup'
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, fullname=name.upper(), send=False)
+        self.groups_plugin.addGroup(_GROUP)
+        self.groups_plugin.addPrincipalToGroup(
+            adapter.userid_for(_IDS[1]),
+            _GROUP,
+            )
+        users = adapter.get_many(
+            [_IDS[1], 'unknown-bulk@example.com', _IDS[0].upper()]
+            )
+        self.assertEqual(len(users), 2)  # unknown omitted
+        self.assertEqual([u.getUserName() for u in users], _IDS[::-1])
+        for user in users:
+            single = adapter.get(user.getUserName())
+            self.assertEqual(user.getId(), single.getId())
+            self.assertEqual(
+                user.getProperty('fullname'),
+                single.getProperty('fullname'),
+                )
+            self.assertEqual(set(user.getGroups()), set(single.getGroups()))
+            self.assertEqual(set(user.getRoles()), set(single.getRoles()))
+        self.assertIn(_GROUP, users[0].getGroups())
+        # limited properties, no groups:
+        user = adapter.get_many(
+            _IDS[:1],
+            properties=('email',),
+            groups=False,
+            )[0]
+        self.assertEqual(user.getProperty('email'), _IDS[0])
+        self.assertIsNone(user.getProperty('fullname', None))
+        self.assertEqual(user.getGroups(), [])
+        # mapping iteration uses bulk materialization:
+        items = dict(adapter.iteritems())
+        for name in _IDS:
+            self.assertEqual(items[name].getId(), adapter.userid_for(name))
+
+    def test_csv_schema(self):
+        """CSV columns include base properties unset for first member"""
+        records = [
+            MemberRecord('csv1', 'csv1', properties={'location': u'Here'}),
+            MemberRecord('csv2', 'csv2', email='csv2@example.com'),
+            ]
+        csv = WorkspaceMembershipCSV.__new__(WorkspaceMembershipCSV)
+        csv._update_schema(records)
+        self.assertEqual(csv.schemakeys, ['email', 'fullname', 'location'])
+
+    def test_records(self):
+        """Lightweight member records match properties of user objects"""
+        _IDS = ['record1@example.com', 'record2@example.com']
+        adapter = SiteMembers(self.portal)
+        for name in _IDS:
+            adapter.register(name, fullname=name.upper(), send=False)
+        records = adapter.records(
+            [_IDS[1], 'unknown-record@example.com', _IDS[0].upper()]
+            )
+        self.assertEqual(len(records), 2)  # unknown omitted
+        self.assertEqual([r.getUserName() for r in records], _IDS[::-1])
+        for record in records:
+            user = adapter.get(record.getUserName())
+            self.assertEqual(record.getId(), user.getId())
+            for name in ('fullname', 'email', 'location'):
+                self.assertEqual(
+                    record.getProperty(name),
+                    user.getProperty(name),
+                    )
+            self.assertIn('fullname', record.propertyIds())
+            self.assertFalse(hasattr(record, '__dict__'))  # slots only
+            # complete on construction, and immutable:
+            self.assertRaises(
+                AttributeError,
+                setattr,
+                record,
+                'fullname',
+                u'Changed',
+                )
+        # limited properties:
+        record = adapter.records(_IDS[:1], properties=('location',))[0]
+        self.assertEqual(record.getProperty('fullname'), _IDS[0].upper())
+        self.assertIsNone(record.getProperty('home_page'))
+        self.assertEqual(
+            set(record.propertyIds()),
+            set(['fullname', 'email', 'location']),
+            )
+
+    def test_register_notify_mailhost(self):
+        """Notification handed to a replacement (mock) MailHost"""
+        self.portal.manage_changeProperties(
+            email_from_address='site@example.com',
+            )
+        mailhost = self.portal.MailHost
+        mailhost.reset()
+        adapter = SiteMembers(self.portal)
+        adapter.register('notify1@example.com', send=True)
+        self.assertEqual(len(mailhost.messages), 1)
+        self.assertIn('notify1@example.com', mailhost.messages[0])
+
+    def test_pwreset_mailhost(self):
+        """Password reset message handed to a replacement (mock) MailHost"""
+        _ID = 'pwreset1@example.com'
+        adapter = SiteMembers(self.portal)
+        adapter.register(_ID, send=False)
+        mailhost = self.portal.MailHost
+        mailhost.reset()
+        # incomplete mail settings: logged, nothing sent
+        self.portal.manage_changeProperties(email_from_address='')
+        adapter.pwreset(_ID)
+        self.assertEqual(len(mailhost.messages), 0)
+        self.portal.manage_changeProperties(
+            email_from_address='site@example.com',
+            )
+        adapter.pwreset(_ID)
+        self.assertEqual(len(mailhost.messages), 1)
+        self.assertIn(_ID, mailhost.messages[0])
+
+    def test_register_many(self):
+        """Bulk registration, with notification deferred to commit"""
+        _IDS = ['cohort1@example.com', 'cohort2@example.com']
+        adapter = SiteMembers(self.portal)
+        adapter.mail_queue = MailQueue(smtp_factory=LocalSMTP)
+        LocalSMTP.reset()
+        result = adapter.register_many(
+            [{'username': name, 'fullname': name.upper()} for name in _IDS]
+            )
+        self.assertEqual(result, _IDS)
+        for name in _IDS:
+            self.assertIn(name, adapter)
+            self.assertEqual(adapter[name].getProperty('fullname'),
+                             name.upper())
+        # notification is only sent after commit:
+        hooks = list(transaction.get().getAfterCommitHooks())
+        hook, args, kwargs = hooks[-1]
+        hook(False, *args, **kwargs)  # failed commit: nothing sent
+        adapter.mail_queue.join()
+        self.assertEqual(len(LocalSMTP.sent), 0)
+        hook(True, *args, **kwargs)
+        adapter.mail_queue.join()
+        self.assertEqual(len(LocalSMTP.sent), len(_IDS))
+        recipients = [mto for mfrom, mto, text in LocalSMTP.sent]
+        for name in _IDS:
+            self.assertTrue([mto for mto in recipients if name in mto[0]])
+        # existing or duplicate user names fail before any registration:
+        self.assertRaises(
+            KeyError,
+            adapter.register_many,
+            [{'username': 'cohort3@example.com'}, {'username': _IDS[0]}],
+            )
+        self.assertRaises(
+            KeyError,
+            adapter.register_many,
+            [{'username': 'cohort3@example.com'}] * 2,
+            )
+        self.assertNotIn('cohort3@example.com', adapter)
+
     def test_login_name(self):
         pass  # TODO
 
     def test_search_users(self):
-        pass  # TODO
+        adapter = SiteMembers(self.portal)
+        adapter.register(
+            'jsearch@example.com',
+            fullname=u'Jane Searchable',
+            send=False,
+            )
+        adapter.register(
+            'searchable@example.com',
+            fullname=u'Joe Other',
+            send=False,
+            )
+        # all words in query match (the second user by full name), but
+        # exact match on login/email ranks first:
+        result = adapter.search('searchable@example.com')
+        names = [name for name, info in result]
+        self.assertEqual(
+            names,
+            ['searchable@example.com', 'jsearch@example.com'],
+            )
+        info = dict(result)['jsearch@example.com']
+        self.assertEqual(info.getProperty('fullname'), u'Jane Searchable')
+        self.assertEqual(
+            info.getId(),
+            adapter.userid_for('jsearch@example.com'),
+            )
+        # prefix of word in full name:
+        self.assertEqual(
+            [name for name, r in adapter.search('jan')],
+            ['jsearch@example.com'],
+            )
+        # pagination:
+        self.assertEqual(len(adapter.search('searchable', limit=1)), 1)
+        self.assertEqual(len(adapter.search('searchable', offset=1)), 1)
+        # removed users are not in search results:
+        del(adapter['jsearch@example.com'])
+        self.assertEqual(len(adapter.search('searchable')), 1)
 
     def test_password_reset(self):
         pass  # TODO
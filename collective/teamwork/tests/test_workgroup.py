@@ -12,6 +12,9 @@ from collective.teamwork.user.members import SiteMembers
 from collective.teamwork.user.interfaces import IWorkspaceRoster
 from collective.teamwork.user.interfaces import IMembershipModifications
 from collective.teamwork.user.interfaces import IWorkgroupTypes
+from collective.teamwork.user.utils import workspace_group_names
+from collective.teamwork.user.workgroups import ancestor_workspaces
+from collective.teamwork.user.workgroups import propagate_to_ancestors
 
 
 class WorkgroupAdaptersTest(unittest.TestCase):
@@ -77,6 +80,28 @@ class WorkgroupAdaptersTest(unittest.TestCase):
             expected_groupname = namespace + '-' + name
             self.assertEqual(expected_groupname, group.pas_group()[0])
 
+    def test_workspace_group_names(self):
+        """Group names/titles descriptor matches roster groups"""
+        workspace, roster = self._base_fixtures()
+        names = workspace_group_names(workspace)
+        self.assertEqual(sorted(names.keys()), sorted(roster.groups.keys()))
+        for name, group in roster.groups.items():
+            self.assertEqual(names[name], group.pas_group())
+        self.assertIn(roster.pas_group()[0], names.groupnames())
+        # cached until workspace is modified:
+        workspace.setTitle('Renamed project')
+        self.assertEqual(
+            workspace_group_names(workspace).path_title,
+            names.path_title,
+            )
+        workspace.notifyModified()
+        names = workspace_group_names(workspace)
+        self.assertEqual(names.path_title, 'Renamed project')
+        self.assertEqual(
+            names['viewers'][1],
+            u'Renamed project - %s' % roster.title,
+            )
+
     def test_user_add_and_containment(self):
         """
         Test user addition, containment matches containment in associated group
@@ -119,6 +144,30 @@ class WorkgroupAdaptersTest(unittest.TestCase):
         self.assertIn(roster.__name__, group.name)
         self.assertTrue(group.name.startswith(IUUID(workspace)))
 
+    def test_lazy_readonly_roster(self):
+        """Roster construction and reads never create PAS groups"""
+        workspace, roster = self._base_fixtures()
+        groups = roster.site_groups
+        groupname = roster.groups['contributors'].pas_group()[0]
+        groups.remove(groupname)  # e.g. group type configured later
+        roster = IWorkspaceRoster(workspace)
+        self.assertIsNone(roster._groups)  # not loaded until used
+        group = roster.groups['contributors']
+        self.assertIs(group.site_groups, roster.site_groups)
+        self.assertEqual(group.keys(), [])
+        self.assertNotIn(self.some_user, group)
+        self.assertNotIn(groupname, roster.site_groups)
+        # explicit repair creates missing group:
+        roster.repair()
+        self.assertIn(groupname, roster.site_groups)
+        self.assertEqual(group.keys(), [])
+        # as does adding a member:
+        roster.site_groups.remove(groupname)
+        roster = IWorkspaceRoster(workspace)
+        roster.groups['contributors'].add(self.some_user)
+        self.assertIn(groupname, roster.site_groups)
+        self.assertIn(self.some_user, roster.groups['contributors'])
+
     def test_add_user_already_added(self):
         """Attempt to add user already added"""
         workspace, roster = self._base_fixtures()
@@ -190,6 +239,23 @@ class WorkgroupAdaptersTest(unittest.TestCase):
         self.assertNotIn(username, team_roster)
         self.assertNotIn(username, subteam_roster)
 
+    def test_member_workspaces(self):
+        """Contained workspaces with user groups found via catalog"""
+        project, roster = self._base_fixtures()
+        team = project['team1']
+        subteam = team['subteam']
+        username = 'member-workspaces@example.com'
+        self.site_members.register(username, send=False)
+        self.assertEqual(roster._member_workspaces(set()), [])
+        IWorkspaceRoster(subteam).add(username)
+        usergroups = self.site_members.groups_for(username)
+        found = roster._member_workspaces(usergroups)
+        # deepest first, excluding context:
+        self.assertEqual(
+            [o.getPhysicalPath() for o in found],
+            [subteam.getPhysicalPath(), team.getPhysicalPath()],
+            )
+
     def test_unassign_groups(self):
         """
         Unassigning from 'viewers' group or roster, via IWorkspaceRoster
@@ -238,6 +304,31 @@ class WorkgroupAdaptersTest(unittest.TestCase):
         self.assertNotIn(username, team_roster)
         self.assertNotIn(username, team_roster.groups['managers'])
 
+    def test_bulk_unassign_contained(self):
+        """Bulk roster removal finds contained workspaces in one query"""
+        project, roster = self._base_fixtures()
+        team_roster = IWorkspaceRoster(project['team1'])
+        usernames = ['bulk-contained%s@example.com' % i for i in range(3)]
+        for username in usernames:
+            self.site_members.register(username, send=False)
+            roster.add(username)
+            team_roster.add(username)
+            team_roster.groups['managers'].add(username)
+        bulk = IMembershipModifications(project)
+        for username in usernames:
+            bulk.unassign(username)
+        queries = []
+        lookup = bulk.roster._member_workspaces
+        bulk.roster._member_workspaces = lambda names: (
+            queries.append(names) or lookup(names)
+            )
+        bulk.apply()
+        self.assertEqual(len(queries), 1)
+        for username in usernames:
+            self.assertNotIn(username, roster)
+            self.assertNotIn(username, team_roster)
+            self.assertNotIn(username, team_roster.groups['managers'])
+
     def test_unassign_base_group_removes_secondary(self):
         """Unassign from base group, get removed from others."""
         workspace, roster = self._base_fixtures()
@@ -464,3 +555,87 @@ class WorkgroupAdaptersTest(unittest.TestCase):
             bulk.apply()
         except ValueError:
             raise AssertionError('Bulk application failed multiple unassign')
+
+    def test_bulk_modification_plan(self):
+        """Bulk modifications apply net changes only"""
+        project, roster = self._base_fixtures()
+        team = project['team1']
+        email1 = 'plan1@example.com'
+        email2 = 'plan2@example.com'
+        for username in (email1, email2):
+            self.site_members.register(username, send=False)
+        bulk = IMembershipModifications(team)
+        bulk.assign(email1)
+        bulk.assign(email1, 'managers')
+        bulk.assign(email2)
+        bulk.unassign(email2)
+        bulk.unassign(self.some_user, 'managers')  # not a member, no-op
+        additions, removals = bulk.plan()
+        self.assertEqual(additions['viewers'], set([email1]))
+        self.assertEqual(additions['managers'], set([email1]))
+        self.assertEqual(removals['viewers'], set())
+        self.assertEqual(removals['managers'], set())
+        bulk.apply()
+        team_roster = IWorkspaceRoster(team)
+        self.assertIn(email1, team_roster.groups['managers'])
+        self.assertIn(email1, roster)  # parent roster updated
+        self.assertNotIn(email2, team_roster)
+        self.assertNotIn(email2, roster)
+        # removal from roster removes from other groups:
+        bulk.unassign(email1)
+        additions, removals = bulk.plan()
+        self.assertEqual(removals['managers'], set([email1]))
+        bulk.apply()
+        self.assertNotIn(email1, team_roster)
+        self.assertNotIn(email1, team_roster.groups['managers'])
+        self.assertIn(email1, roster)
+        # group assignment requires roster membership, nothing applied:
+        bulk.assign(email2, 'managers')
+        self.assertRaises(RuntimeError, bulk.apply)
+        self.assertNotIn(email2, team_roster.groups['managers'])
+
+    def test_bulk_modification_resolves_once(self):
+        """Bulk modifications resolve all users once, for all groups"""
+        project, roster = self._base_fixtures()
+        team = project['team1']
+        usernames = ['once%s@example.com' % i for i in range(3)]
+        for username in usernames:
+            self.site_members.register(username, send=False)
+        bulk = IMembershipModifications(team)
+        for username in usernames:
+            bulk.assign(username)
+            bulk.assign(username, 'managers')
+        site_members = bulk.roster.site_members
+        calls = []
+        for name in ('contains_many', 'userids_for'):
+            method = getattr(site_members, name)
+            counted = lambda names, name=name, method=method: (
+                calls.append(name) or method(names)
+                )
+            setattr(site_members, name, counted)
+        bulk.apply()
+        self.assertEqual(sorted(calls), ['contains_many', 'userids_for'])
+        team_roster = IWorkspaceRoster(team)
+        for username in usernames:
+            self.assertIn(username, team_roster)
+            self.assertIn(username, team_roster.groups['managers'])
+            self.assertIn(username, roster)
+
+    def test_ancestor_propagation(self):
+        """Roster additions propagate to all ancestors in one pass"""
+        project, roster = self._base_fixtures()
+        team = project['team1']
+        subteam = team['subteam']
+        self.assertEqual(
+            [o.getPhysicalPath() for o in ancestor_workspaces(subteam)],
+            [team.getPhysicalPath(), project.getPhysicalPath()],
+            )
+        self.assertEqual(ancestor_workspaces(project), [])
+        usernames = ['ancestor1@example.com', 'ancestor2@example.com']
+        for username in usernames:
+            self.site_members.register(username, send=False)
+        propagate_to_ancestors(subteam, usernames)
+        for username in usernames:
+            self.assertIn(username, IWorkspaceRoster(team))
+            self.assertIn(username, roster)
+            self.assertNotIn(username, IWorkspaceRoster(subteam))
@@ -0,0 +1,60 @@
+"""
+collective.teamwork.user.cache: request-scoped caches and cross-request
+(generation-validated) caches for membership adapters.
+"""
+
+import threading
+
+from zope.annotation.interfaces import IAnnotations
+from zope.globalrequest import getRequest
+
+
+def request_cache(name, request=None):
+    """
+    Get a dict stored in annotations of the request under the key
+    name, creating it as needed.  If no (annotatable) request is
+    available, return a new, unshared dict.
+    """
+    request = request if request is not None else getRequest()
+    if request is None:
+        return {}
+    annotations = IAnnotations(request, None)
+    if annotations is None:
+        return {}
+    if name not in annotations:
+        annotations[name] = {}
+    return annotations[name]
+
+
+class GenerationCache(object):
+    """
+    Cache shared across requests and threads: each namespace of
+    entries is valid only for a single generation value, usually a
+    persistent counter read within the current transaction (and thus
+    consistent with everything else that transaction sees via MVCC).
+
+    Asking for a namespace with a different generation than the one
+    stored discards its entries.  A namespace exceeding maxsize
+    entries is also discarded, to bound memory use.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, namespace, generation):
+        """Get dict of entries for namespace, valid for generation"""
+        with self._lock:
+            stored, entries = self._data.get(namespace, (None, None))
+            if stored != generation or len(entries) > self.maxsize:
+                entries = {}
+                self._data[namespace] = (generation, entries)
+            return entries
+
+    def invalidate(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._data.clear()
+            elif namespace in self._data:
+                del self._data[namespace]
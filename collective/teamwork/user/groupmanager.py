@@ -0,0 +1,250 @@
+# PAS group manager plugin optimized for workspace groups: groups named
+#  <uuid>-<role>, many of them, some with large and busy membership.
+
+from Acquisition import aq_parent
+from AccessControl.class_init import InitializeClass
+from AccessControl import ClassSecurityInfo
+from BTrees.OOBTree import OOBTree
+from Products.PageTemplates.PageTemplateFile import PageTemplateFile
+from Products.PlonePAS.plugins.group import GroupManager
+
+from index import MembershipTreeSet, plugin_group_index
+
+
+manage_addWorkspaceGroupManagerForm = PageTemplateFile(
+    "zmi/WorkspaceGroupManagerForm.pt", globals(),
+    __name__="manage_addWorkspaceGroupManagerForm")
+
+
+def manage_addWorkspaceGroupManager(dispatcher, id, title=None,
+                                    REQUEST=None):
+    plugin = WorkspaceGroupManager(id, title)
+    dispatcher._setObject(plugin.getId(), plugin)
+    if REQUEST is not None:
+        REQUEST.RESPONSE.redirect(
+            '%s/manage_workspace?manage_tabs_message='
+            'WorkspaceGroupManager+added.' %
+            dispatcher.absolute_url(),
+            )
+
+
+class WorkspaceGroupManager(GroupManager):
+    """
+    PAS group manager plugin for a workspaces site; acts like the
+    PlonePAS group manager (group metadata is stored the same way),
+    except for storage of group membership:
+
+        *   Each group has its own set of member principal ids, so
+            listing members of a group does not scan every principal
+            with any group membership.  Sets are MembershipTreeSet
+            objects (OOTreeSet, resolving conflicting writes by merging
+            ids added and removed), so concurrent changes to membership
+            of a busy group commit, rather than raising ConflictError.
+
+        *   A reverse index of principal id to a set of group ids
+            answers getGroupsForPrincipal().  Sets are created when a
+            principal is registered (see registerPrincipal()), so that
+            concurrent first assignments of a principal to different
+            groups only add to an existing set, and do not conflict.
+
+        *   Member counts are the length of each group's member set,
+            so they cannot drift from membership as a separate counter
+            could when conflicting writes are resolved.
+
+    Bulk operations (addPrincipalsToGroup(), removePrincipalsFromGroup())
+    and in-place rename (renameGroup()) are also provided, and used by
+    collective.teamwork.user.groups when available.
+    """
+
+    meta_type = 'Workspace Group Manager'
+
+    security = ClassSecurityInfo()
+
+    def __init__(self, id, title=None):
+        GroupManager.__init__(self, id, title)
+        self._principal_groups = OOBTree()  # principal id -> set
+        self._group_members = OOBTree()     # group id -> set
+
+    security.declarePrivate('registerPrincipal')
+
+    def registerPrincipal(self, principal_id):
+        """
+        Create (empty) storage of group membership for a principal, if
+        missing; called on creation of users (and groups), ahead of any
+        (possibly concurrent) assignment.
+        """
+        if principal_id not in self._principal_groups:
+            self._principal_groups[principal_id] = MembershipTreeSet()
+
+    def _assign(self, principal_id, group_id):
+        """Assign principal to group, return True if not already"""
+        members = self._group_members.get(group_id, None)
+        if members is None:
+            members = self._group_members[group_id] = MembershipTreeSet()
+        if not members.insert(principal_id):
+            return False
+        self.registerPrincipal(principal_id)  # if not already
+        self._principal_groups[principal_id].insert(group_id)
+        self._invalidatePrincipalCache(principal_id)
+        return True
+
+    def _unassign(self, principal_id, group_id):
+        """Unassign principal from group, return True if was assigned"""
+        members = self._group_members.get(group_id, None)
+        if members is None or principal_id not in members:
+            return False
+        members.remove(principal_id)
+        # empty reverse index entries are kept: removing them would
+        # conflict with concurrent assignment of the same principal.
+        self._principal_groups[principal_id].remove(group_id)
+        self._invalidatePrincipalCache(principal_id)
+        return True
+
+    def _reindex(self, principal_ids):
+        """Keep persistent group index current, if plugin is indexed"""
+        index, acl_users = plugin_group_index(self)
+        if index is not None:
+            for principal_id in principal_ids:
+                index.reindex(acl_users, principal_id)
+
+    # IGroupsPlugin:
+
+    security.declarePrivate('getGroupsForPrincipal')
+
+    def getGroupsForPrincipal(self, principal, request=None):
+        return tuple(self._principal_groups.get(principal.getId(), ()))
+
+    # IGroupIntrospection:
+
+    security.declarePrivate('getGroupMembers')
+
+    def getGroupMembers(self, group_id):
+        return tuple(self._group_members.get(group_id, ()))
+
+    security.declarePrivate('countGroupMembers')
+
+    def countGroupMembers(self, group_id):
+        """Number of principals directly assigned to group"""
+        return len(self._group_members.get(group_id, ()))
+
+    security.declarePrivate('listAssignedPrincipals')
+
+    def listAssignedPrincipals(self, group_id):
+        result = []
+        parent = aq_parent(self)
+        for principal_id in self.getGroupMembers(group_id):
+            info = parent.searchPrincipals(id=principal_id, exact_match=True)
+            if info:
+                title = info[0].get('title', principal_id)
+            else:
+                title = '<%s: not found>' % principal_id
+            result.append((principal_id, title))
+        return result
+
+    # IGroupManagement:
+
+    security.declarePrivate('addGroup')
+
+    def addGroup(self, group_id, *args, **kwargs):
+        result = GroupManager.addGroup(self, group_id, *args, **kwargs)
+        if group_id not in self._group_members:
+            # create storage with group, not on (concurrent) assignment:
+            self._group_members[group_id] = MembershipTreeSet()
+        self.registerPrincipal(group_id)  # as principal in other groups
+        return result
+
+    security.declarePrivate('addPrincipalToGroup')
+
+    def addPrincipalToGroup(self, principal_id, group_id):
+        self._groups[group_id]  # raise KeyError if unknown group
+        added = self._assign(principal_id, group_id)
+        if added:
+            self._reindex([principal_id])
+        return added
+
+    security.declarePrivate('removePrincipalFromGroup')
+
+    def removePrincipalFromGroup(self, principal_id, group_id):
+        self._groups[group_id]  # raise KeyError if unknown group
+        removed = self._unassign(principal_id, group_id)
+        if removed:
+            self._reindex([principal_id])
+        return removed
+
+    security.declarePrivate('addPrincipalsToGroup')
+
+    def addPrincipalsToGroup(self, principal_ids, group_id):
+        """Assign principals to group, return list of ids newly added"""
+        self._groups[group_id]  # raise KeyError if unknown group
+        added = [pid for pid in principal_ids if self._assign(pid, group_id)]
+        self._reindex(added)
+        return added
+
+    security.declarePrivate('removePrincipalsFromGroup')
+
+    def removePrincipalsFromGroup(self, principal_ids, group_id):
+        """Unassign principals from group, return list of ids removed"""
+        self._groups[group_id]  # raise KeyError if unknown group
+        removed = [
+            pid for pid in principal_ids if self._unassign(pid, group_id)
+            ]
+        self._reindex(removed)
+        return removed
+
+    security.declarePrivate('removeGroup')
+
+    def removeGroup(self, group_id):
+        if self._groups.get(group_id, None) is None:
+            return False
+        members = self.getGroupMembers(group_id)
+        for principal_id in members:
+            self._unassign(principal_id, group_id)
+        for containing in tuple(self._principal_groups.get(group_id, ())):
+            self._unassign(group_id, containing)
+        if group_id in self._group_members:
+            del self._group_members[group_id]
+        del self._groups[group_id]
+        index, acl_users = plugin_group_index(self)
+        if index is not None:
+            index.remove_group(group_id)
+            index.remove_principal(group_id)
+        return True
+
+    security.declarePrivate('renameGroup')
+
+    def renameGroup(self, oldname, newname, progress=None, interval=100):
+        """
+        Rename group in place, moving metadata, members, and membership
+        of the group (as a principal) in other groups.  If given,
+        progress is called with (done, total) members moved, every
+        interval members, and when done.
+        """
+        if newname in self._groups:
+            raise KeyError('Duplicate group id: %s' % newname)
+        info = dict(self._groups[oldname], id=newname)
+        members = self.getGroupMembers(oldname)
+        containing = tuple(self._principal_groups.get(oldname, ()))
+        for principal_id in members:
+            self._unassign(principal_id, oldname)
+        for group_id in containing:
+            self._unassign(oldname, group_id)
+        if oldname in self._group_members:
+            del self._group_members[oldname]
+        del self._groups[oldname]
+        self._groups[newname] = info
+        total = len(members)
+        for done, principal_id in enumerate(members, 1):
+            self._assign(principal_id, newname)
+            if progress is not None and (
+                    done % interval == 0 or done == total):
+                progress(done, total)
+        if not total and progress is not None:
+            progress(0, 0)
+        for group_id in containing:
+            self._assign(newname, group_id)
+        index, acl_users = plugin_group_index(self)
+        if index is not None:
+            index.rename_group(oldname, newname)
+
+
+InitializeClass(WorkspaceGroupManager)  # set up traversal security!
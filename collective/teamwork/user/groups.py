@@ -1,15 +1,18 @@
 from collections import OrderedDict
 import itertools
+from operator import itemgetter
 import threading
-import weakref
 
 from zope.component import adapts
 from zope.component.hooks import getSite
 from zope.interface import implements
 from Products.CMFCore.interfaces import ISiteRoot
+from Products.CMFCore.utils import getToolByName
 
 from collective.teamwork.user.interfaces import IGroup, IGroups
 from collective.teamwork.user.interfaces import ISiteMembers
+from cache import request_cache
+from index import group_index, group_closure
 import pas
 
 
@@ -17,79 +20,135 @@ _str = lambda v: v.encode('utf-8') if isinstance(v, unicode) else str(v)
 _u = lambda v: v.decode('utf-8') if isinstance(v, str) else unicode(v)
 
 
-class GroupInvalidation(threading.local):
+class GroupMemberCache(threading.local):
     """
-    Thread-local state synchronizer for GroupInfo cache invalidation.
-    We use this because shared state across transaction boundaries is more
-    complicated and risky (if transaction is aborted), and we use
-    thread-local storage as all other state is expected to comply with MVCC
-    via ZODB (as each thread and instance has own state/cache).
-    ** The goal is to have all state be consistent within a transaction. **
-
-    Impact on garbage collection:
-
-        - We use weakref to keep cached target references from preventing
-          GC on GroupInfo object.
-
-        - We use hash(target) to compute storage key, preventing duplicate
-          subscription.
-        
-        - GroupInfo.__del__() should unsubscribe from GroupInvalidation.
+    Thread-local, long-lived cache of direct members of groups, valid
+    across requests and transactions: each entry is stamped with the
+    generation of the group, read from the persistent group index
+    (collective.teamwork.user.index.GroupIndex), which is MVCC-visible,
+    so a change committed in any thread or ZEO client invalidates the
+    entry for all threads on their next transaction.
+
+    Only members for committed generations are stored, so that state
+    from an aborted transaction is never reused.  Changes in this
+    thread to groups in plugins not covered by the index are tracked
+    with a thread-local counter of changes, for invalidation of group
+    objects in this thread only (no members are cached for these).
     """
 
-    def __init__(self):
-        super(GroupInvalidation, self).__init__()
-        self.info = {}
-
-    def subscribe(self, name, target):
-        """Subscribe target object to invalidation for group name"""
-        if name not in self.info:
-            self.info[name] = {}
-        self.info[name][hash(target)] = weakref.ref(target)
-
-    def unsubscribe(self, name, target):
-        """Unsubscribe a target object to invalidation for group name"""
-        if name in self.info and hash(target) in self.info[name]:
-            del self.info[name][hash(target)]
-
-    def invalidate(self, name, context=None):
-        if name in self.info:
-            for ref in self.info[name].values():
-                signified = ref()
-                if signified is context:
-                    continue
-                target = ref()
-                if target is not None:
-                    target._usernames = None
+    def __init__(self, maxsize=5000):
+        super(GroupMemberCache, self).__init__()
+        self.maxsize = maxsize
+        self.members = {}  # key -> (generation, members)
+        self.changes = {}  # key -> count of local changes
+
+    def generation(self, key, index):
+        """
+        Return generation tuple for key (site path, group name): the
+        persisted generation (or None, if not indexed) and local count
+        of changes in this thread.
+        """
+        persisted = None
+        if index is not None:
+            persisted = index.group_generation(key[1])
+        return (persisted, self.changes.get(key, 0))
+
+    def get(self, key, generation):
+        cached = self.members.get(key, None)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        return None
+
+    def set(self, key, generation, members):
+        if len(self.members) >= self.maxsize:
+            self.members.clear()
+        self.members[key] = (generation, members)
 
+    def invalidate(self, key):
+        self.changes[key] = self.changes.get(key, 0) + 1
+        self.members.pop(key, None)
+
+
+_member_cache = GroupMemberCache()
+
+
+class GroupClosureCache(threading.local):
+    """
+    Thread-local cache of group containment closure: for each group,
+    the groups nested within it, directly or indirectly, as computed
+    from the persistent group index.  Each entry is stamped with the
+    generations of the group and of every group in its closure, which
+    are the only groups whose membership determines the closure; a
+    membership change thus invalidates only the closures including
+    the changed group, which are recomputed on next use.
+    """
 
-_group_invalidation = GroupInvalidation()
+    def __init__(self, maxsize=5000):
+        super(GroupClosureCache, self).__init__()
+        self.maxsize = maxsize
+        self.closures = {}  # key -> (stamp, names)
+
+    def _stamp(self, index, names):
+        return tuple(index.group_generation(name) for name in names)
+
+    def nested(self, key, index):
+        """
+        Names of groups nested in group, for key (site path, group
+        name), computed from (and validated against) index.
+        """
+        name = key[1]
+        cached = self.closures.get(key, None)
+        if cached is not None:
+            stamp, names = cached
+            if stamp == self._stamp(index, (name,) + names):
+                return list(names)
+        names = tuple(group_closure(name, index.nested_groups))
+        scope = (name,) + names
+        if all(index.group_committed(group) for group in scope):
+            if len(self.closures) >= self.maxsize:
+                self.closures.clear()
+            self.closures[key] = (self._stamp(index, scope), names)
+        return list(names)
+
+
+_closure_cache = GroupClosureCache()
 
 
 class GroupInfo(object):
 
     implements(IGroup)
 
-    def __init__(self, name, site=None, members=None):
+    def __init__(self, name, site=None, members=None, info=None,
+                 introspection=None, management=None):
         self._name = _str(name)
         self._site = site if site is not None else getSite()
         self._acl_users = self._site.acl_users
-        self._introspection = pas.group_introspection_plugins(self._acl_users)
-        self._management = pas.group_management_plugins(self._acl_users)[0]
-        self._init_info()
+        # plugin lists may be passed by Groups, resolved once for many:
+        if introspection is None:
+            introspection = pas.group_introspection_plugins(self._acl_users)
+        if management is None:
+            management = pas.group_management_plugins(self._acl_users)
+        self._introspection = introspection
+        # writes go to the plugin storing the group, not always the first:
+        self._management = pas.group_manager(management, self._name)
+        self._init_info(info)  # info may be prefetched by Groups
         self._members = self._members_adapter(members)
-        self.refresh()
-        _group_invalidation.subscribe(name, self)
-
-    def __del__(self):
-        _group_invalidation.unsubscribe(self._name, self)
+        self._index = index = group_index(self._site)
+        # members are cacheable across transactions only if group index
+        # covers every introspection plugin:
+        self._cacheable = index is not None and all(
+            plugin.getId() in index.plugins for plugin in self._introspection
+            )
+        self._cache_key = ('/'.join(self._site.getPhysicalPath()), self._name)
+        self._usernames = self._generation = None
 
     def applyTransform(self, username):
         return self._members.applyTransform(username)
 
-    def _init_info(self):
-        self._info = None
-        for plugin in self._introspection:
+    def _init_info(self, info=None):
+        self._info = info
+        plugins = self._introspection if info is None else ()
+        for plugin in plugins:
             try:
                 self._info = pas.group_info(plugin, self._name)
                 if self._info is not None:
@@ -113,7 +172,8 @@ class GroupInfo(object):
         site = site if site is not None else getSite()
         management = pas.group_management_plugins(site.acl_users)[0]
         management.addGroup(name, title, description)
-        return GroupInfo(name, site)
+        _identity_map(site).pop(name, None)
+        return group_info(name, site)
 
     @property
     def name(self):
@@ -127,6 +187,7 @@ class GroupInfo(object):
     def _set_title(self, value):
         IGroup['title'].validate(_u(value))
         self._management.updateGroup(self.name, title=_str(value))
+        self._init_info()
 
     title = property(_get_title, _set_title)
 
@@ -137,6 +198,7 @@ class GroupInfo(object):
     def _set_description(self, value):
         IGroup['description'].validate(_u(value))
         self._management.updateGroup(self.name, description=_str(value))
+        self._init_info()
 
     description = property(_get_description, _set_description)
 
@@ -145,29 +207,101 @@ class GroupInfo(object):
 
     def refresh(self):
         self._usernames = None
-        _group_invalidation.invalidate(self._name, context=self)
+        _member_cache.invalidate(self._cache_key)
 
-    def keys(self):
-        """User login name keys"""
-        if self._usernames is None:
-            _principals = []
-            for plugin in self._introspection:
-                group = plugin.getGroupById(self._name)
-                if group:
-                    _principals += list(plugin.getGroupMembers(self.name))
-            _principals = filter(
-                lambda login_name: login_name is not None,
-                map(self._members.login_name, _principals)
+    def _principals(self):
+        """
+        Return tuple of list of ids of principals directly assigned to
+        group (de-duplicated, retaining order found), and the set of
+        those principal ids which are (nested) groups, not users.
+        """
+        index = self._index
+        indexed = index.plugins if index is not None else ()
+        principals, groups = [], set()
+        for plugin in self._introspection:
+            if plugin.getId() in indexed:
+                members = index.members_of(self._name)
+                groups.update(name for name in members if name in index)
+            else:
+                if not pas.has_group(plugin, self._name):
+                    continue
+                members = list(plugin.getGroupMembers(self.name))
+                # check only members, not every group id in the site:
+                groups.update(
+                    name for name in members if pas.has_group(plugin, name)
+                    )
+            principals += members
+        return list(OrderedDict.fromkeys(principals)), groups
+
+    def _cached_principals(self, generation):
+        """
+        Direct members, as returned by _principals(), from thread-local
+        cache when valid for the current generation of the group.
+        """
+        if generation[0] is None:
+            return self._principals()  # not indexed, not cacheable
+        result = _member_cache.get(self._cache_key, generation)
+        if result is None:
+            result = self._principals()
+            if self._index.group_committed(self._name):
+                _member_cache.set(self._cache_key, generation, result)
+        return result
+
+    def _descendants(self):
+        """Names of groups nested in this group, directly or indirectly"""
+        if self._cacheable:
+            return _closure_cache.nested(self._cache_key, self._index)
+        _nested = lambda names: itertools.chain(*[
+            group_info(name, self._site, self._members).nested()
+            for name in names
+            ])
+        return group_closure(self._name, _nested)
+
+    def keys(self, transitive=False):
+        """
+        User login name keys; if transitive is True, include users
+        indirectly contained via nested groups.
+        """
+        usernames = self._direct_keys()
+        if not transitive:
+            return usernames
+        result = list(usernames)
+        for name in self._descendants():
+            result += group_info(name, self._site, self._members).keys()
+        return list(OrderedDict.fromkeys(result))
+
+    def _direct_keys(self):
+        """Login names of direct members, validated by group generation"""
+        index = self._index if self._cacheable else None
+        generation = _member_cache.generation(self._cache_key, index)
+        if self._usernames is None or generation != self._generation:
+            principals, groups = self._cached_principals(generation)
+            self._generation = generation
+            userids = [name for name in principals if name not in groups]
+            # resolve all user ids to login names in one batch:
+            self._usernames = list(
+                OrderedDict.fromkeys(
+                    self._members.login_names(userids).values()
+                    )
                 )
-            # set de-duplicated list, retaining order found
-            self._usernames = list(OrderedDict.fromkeys(_principals))
+            self._nested = [name for name in principals if name in groups]
         return self._usernames
 
-    def values(self):
-        return [self._members.get(k) for k in self.keys()]
+    def nested(self, transitive=False):
+        """
+        Names of groups directly contained by this group; if transitive
+        is True, also those contained indirectly.
+        """
+        if transitive:
+            return self._descendants()
+        self.keys()
+        return self._nested
+
+    def values(self, transitive=False):
+        return self._members.get_many(self.keys(transitive))
 
     def items(self):
-        return zip(self.keys(), self.values())
+        return [(user.getUserName(), user) for user in self.values()]
 
     def __iter__(self):
         return self.keys().__iter__()
@@ -175,12 +309,10 @@ class GroupInfo(object):
     iterkeys = __iter__
 
     def itervalues(self):
-        _get = lambda k: self._members.get(k)
-        return itertools.imap(_get, self.keys())
+        return iter(self.values())
 
     def iteritems(self):
-        _itemtuple = lambda k: (k, self._members.get(k))
-        return itertools.imap(_itemtuple, self.keys())
+        return iter(self.items())
 
     def __contains__(self, username):
         username = self.applyTransform(username)
@@ -206,6 +338,32 @@ class GroupInfo(object):
 
     # methods that cause state change in underlying user/group storage:
 
+    def _userids(self, usernames, known=None):
+        """
+        Resolve user names to (de-duplicated) user ids in one batch,
+        refreshing site members once to find possibly new user names;
+        raises ValueError if any user name remains unknown.  Names in
+        known, a mapping of (normalized) user name to id already
+        resolved by the caller, are not looked up again.
+        """
+        names = OrderedDict.fromkeys(
+            str(self.applyTransform(name)) for name in usernames
+            ).keys()
+        known = known or {}
+        userids = dict((name, known[name]) for name in names if name in known)
+        missing = [name for name in names if name not in userids]
+        if missing:
+            userids.update(self._members.userids_for(missing))
+        if len(userids) < len(names):
+            # possibly new user names, invalidate and try again
+            self._members.refresh()
+            missing = [name for name in names if name not in userids]
+            userids.update(self._members.userids_for(missing))
+        unknown = [name for name in names if name not in userids]
+        if unknown:
+            raise ValueError('unknown user name(s): %s' % ', '.join(unknown))
+        return list(OrderedDict.fromkeys(userids[name] for name in names))
+
     def assign(self, username):
         """Add/assign a username to group"""
         username = self.applyTransform(username)
@@ -228,12 +386,87 @@ class GroupInfo(object):
         self._management.removePrincipalFromGroup(userid, self.name)
         self.refresh()
 
+    def assign_many(self, usernames, userids=None):
+        """
+        Add/assign user names to group, in one plugin operation if the
+        group management plugin supports it, invalidating once.
+        """
+        userids = self._userids(usernames, userids)
+        if not userids:
+            return
+        bulk = getattr(self._management, 'addPrincipalsToGroup', None)
+        if bulk is not None:
+            bulk(userids, self.name)
+        else:
+            for userid in userids:
+                self._management.addPrincipalToGroup(userid, self.name)
+        self.refresh()
+
+    def unassign_many(self, usernames, userids=None):
+        """
+        Unassign user names from group, in one plugin operation if the
+        group management plugin supports it, invalidating once.
+        """
+        usernames = [self.applyTransform(name) for name in usernames]
+        current = set(self.keys())
+        missing = [name for name in usernames if name not in current]
+        if missing:
+            raise ValueError(
+                'username(s) provided not in group: %s' % ', '.join(missing)
+                )
+        userids = self._userids(usernames, userids)
+        if not userids:
+            return
+        bulk = getattr(self._management, 'removePrincipalsFromGroup', None)
+        if bulk is not None:
+            bulk(userids, self.name)
+        else:
+            for userid in userids:
+                self._management.removePrincipalFromGroup(userid, self.name)
+        self.refresh()
+
+
+def _identity_map(site):
+    """
+    Request-scoped identity map of group name to a dict of ISiteMembers
+    instance (or None, for the default adapter) to GroupInfo, for site.
+    """
+    path = '/'.join(site.getPhysicalPath())
+    return request_cache('collective.teamwork.user.groups.GroupInfo:%s' % (
+        path,
+        ))
+
+
+def group_info(name, site=None, members=None):
+    """
+    Get GroupInfo object for group name, from a request-scoped identity
+    map: one GroupInfo per group name, per site, per request, and per
+    ISiteMembers instance passed as members.  If members is None, any
+    GroupInfo already in the map for the name is returned.
+    """
+    site = site if site is not None else getSite()
+    name = _str(name)
+    entries = _identity_map(site).setdefault(name, {})
+    if members is None and entries:
+        if None in entries:
+            return entries[None]
+        return entries.values()[0]
+    if members not in entries:
+        entries[members] = GroupInfo(name, site, members)
+    return entries[members]
+
 
 class Groups(object):
 
     implements(IGroups)
     adapts(ISiteRoot)
 
+    # number of objects between progress reports in rename():
+    PROGRESS_INTERVAL = 100
+
+    # number of groups created at a time by itervalues(), iteritems():
+    BATCH_SIZE = 250
+
     def __init__(self, context=None):
         if context is None:
             context = getSite()
@@ -242,43 +475,142 @@ class Groups(object):
         self.context = context
         self._acl_users = self.context.acl_users
         self._enumeration = pas.group_enumeration_plugins(self._acl_users)
-        self._management = pas.group_management_plugins(self._acl_users)[0]
-        self.refresh()
+        self._introspection = pas.group_introspection_plugins(self._acl_users)
+        self._managers = pas.group_management_plugins(self._acl_users)
+        self._members = None
+        index = group_index(self.context)
+        # when the persistent group index covers all enumeration plugins,
+        # use it (an OOBTree keyed by group id) for containment checks:
+        self._index = None
+        if index is not None and all(
+                plugin.getId() in index.plugins
+                for plugin in self._enumeration):
+            self._index = index
+        self._group_ids = self._group_set = None
+
+    @property
+    def site_members(self):
+        """ISiteMembers for site, shared by groups prefetched"""
+        if self._members is None:
+            self._members = ISiteMembers(self.context)
+        return self._members
 
     def refresh(self):
-        self._group_ids = None
+        self._group_ids = self._group_set = None
+        _identity_map(self.context).clear()
 
     def __getitem__(self, name):
-        if name in self.keys():
-            return GroupInfo(name, site=self.context)
+        if name in self:
+            return group_info(name, site=self.context)
         raise KeyError(name)
 
     def get(self, name, default=None):
-        if name in self.keys():
-            return GroupInfo(name, site=self.context)
+        if name in self:
+            return group_info(name, site=self.context)
         return default
 
     def __contains__(self, name):
-        return name in self.keys()
+        if self._index is not None:
+            return name in self._index
+        self.keys()
+        return name in self._group_set
 
     def __len__(self):
+        if self._index is not None:
+            return len(self._index)
         return len(self.keys())
 
     def keys(self):
+        """List of group ids, in order found in enumeration plugins"""
         if self._group_ids is None:
             r = []
             for plugin in self._enumeration:
                 r += pas.group_ids(plugin)
             self._group_ids = list(OrderedDict.fromkeys(r))
+            self._group_set = set(self._group_ids)
         return self._group_ids
 
+    def _added(self, name):
+        """Incrementally update cached group ids for an added group"""
+        if self._group_ids is not None and name not in self._group_set:
+            self._group_ids.append(name)
+            self._group_set.add(name)
+
+    def _removed(self, name):
+        """Incrementally update cached group ids for a removed group"""
+        _identity_map(self.context).pop(name, None)
+        if self._group_ids is not None and name in self._group_set:
+            self._group_ids.remove(name)
+            self._group_set.remove(name)
+
+    def _metadata(self, match):
+        """
+        Dict of group name to metadata, for names matching, loaded in a
+        single enumeration of each group introspection plugin.
+        """
+        infos = {}
+        for plugin in self._introspection:
+            for info in pas.list_group_info(plugin):
+                name = _str(info.get('id'))
+                if match(name):
+                    infos.setdefault(name, info)  # first plugin wins
+        return infos
+
+    def _seed(self, names, infos):
+        """
+        Ordered dict of name to GroupInfo for names, seeding identity
+        map with groups using prefetched metadata (infos).
+        """
+        groups = _identity_map(self.context)
+        result = OrderedDict()
+        for name in names:
+            entries = groups.setdefault(name, {})
+            if not entries:
+                # share members adapter and plugin lists among groups:
+                entries[self.site_members] = GroupInfo(
+                    name,
+                    self.context,
+                    members=self.site_members,
+                    info=infos.get(name),  # if None, looked up per group
+                    introspection=self._introspection,
+                    management=self._managers,
+                    )
+            result[name] = group_info(name, self.context)
+        return result
+
+    def prefetch(self, prefix=None):
+        """
+        Get ordered dict of group name to GroupInfo for all groups, or
+        only those with names starting with prefix (e.g. a workspace
+        namespace), loading metadata (title, description) for all in a
+        single enumeration of each group introspection plugin, instead
+        of one query per group.  Seeds the request-scoped identity map.
+        """
+        _match = lambda name: prefix is None or name.startswith(prefix)
+        return self._seed(filter(_match, self.keys()), self._metadata(_match))
+
+    def _iterprefetched(self):
+        """
+        Generate (name, GroupInfo) for all groups, lazily: GroupInfo
+        objects are created (with prefetched metadata) BATCH_SIZE at
+        a time, as iteration proceeds.
+        """
+        names = list(self.keys())  # copy: may change while iterating
+        infos = None
+        for start in range(0, len(names), self.BATCH_SIZE):
+            if infos is None:
+                infos = self._metadata(lambda name: True)
+            batch = self._seed(names[start:start + self.BATCH_SIZE], infos)
+            for item in batch.iteritems():
+                yield item
+
     def values(self):
         """Get values: prefer itervalues() when possible"""
-        return [self.get(k) for k in self.keys()]
+        return self.prefetch().values()
 
     def items(self):
         """Get items: prefer iteritems() when possible"""
-        return zip(self.keys(), self.values())
+        return self.prefetch().items()
 
     def __iter__(self):
         return self.keys().__iter__()
@@ -286,11 +618,10 @@ class Groups(object):
     iterkeys = __iter__
 
     def itervalues(self):
-        return itertools.imap(self.get, self.keys())
+        return itertools.imap(itemgetter(1), self._iterprefetched())
 
     def iteritems(self):
-        _itemtuple = lambda k: (k, self.get(k))
-        return itertools.imap(_itemtuple, self.keys())
+        return self._iterprefetched()
 
     # write/create:
 
@@ -302,22 +633,24 @@ class Groups(object):
             site=self.context,
             )
         if members:
-            for member in members:
-                group.assign(member)
-        self.refresh()
+            group.assign_many(members)
+        self._added(group.name)
         return group
 
     def remove(self, groupname):
         """Remove a group by name"""
-        self._management.removeGroup(groupname)
-        self.refresh()
+        groupname = _str(groupname)
+        management = pas.group_manager(self._managers, groupname)
+        if management.removeGroup(groupname) is False:
+            return  # not removed, e.g. group not found
+        self._removed(groupname)
 
     def clone(self, source, destination):
         """
         Clone a group, with its members intact from a name (source) to
         a new name (destination).
         """
-        source = GroupInfo(source)  # name -> group obj
+        source = group_info(source, site=self.context)  # name -> group obj
         return self.add(
             destination,
             source.title,
@@ -325,15 +658,107 @@ class Groups(object):
             source.keys(),              # copies members
             )
 
-    def rename(self, oldname, newname):
+    def _copy(self, source, destination, progress=None):
         """
-        Rename a group, migrate members appropriately.
+        Clone group source to destination, assigning members in batches
+        of PROGRESS_INTERVAL, calling progress(done, total) after each.
+        """
+        source = group_info(source, site=self.context)
+        usernames = source.keys()
+        group = self.add(destination, source.title, source.description)
+        total, interval = len(usernames), self.PROGRESS_INTERVAL
+        for start in range(0, total, interval):
+            group.assign_many(usernames[start:start + interval])
+            if progress is not None:
+                progress(min(start + interval, total), total)
+        if not total and progress is not None:
+            progress(0, 0)
+        return group
 
-        Note: this does not affect objects using local roles assigned
-        to these groups as principals.  Calling code renaming a group
-        has the responsibility to sort out the consequences of that.
+    def rename(self, oldname, newname, localroles=False, progress=None):
+        """
+        Rename a group.  Members and metadata are moved in place, in one
+        operation, when the group management plugin supports it (as
+        ZODBGroupManager does); otherwise, the group is cloned (with
+        members) to the new name, and the old group removed.
+
+        If localroles is True, local roles assigned to the old group name
+        on the site and on content (found via the allowedRolesAndUsers
+        catalog index) are moved to the new name.  Otherwise, calling
+        code renaming a group has the responsibility to sort out objects
+        using local roles assigned to the old name.
+
+        If progress is given, it is called with (phase, done, total)
+        as work proceeds, where phase is 'members' or 'localroles'.
         """
-        newgroup = self.clone(oldname, newname)  # clone attrs, members
-        self.remove(oldname)
+        oldname, newname = _str(oldname), _str(newname)
+        if oldname not in self:
+            raise KeyError(oldname)
+        if newname in self:
+            raise KeyError('Duplicate group id: %s' % newname)
+        management = pas.group_manager(self._managers, oldname)
+        index = group_index(self.context)
+        indexed = index is not None and (
+            management.getId() in index.plugins
+            )
+        principals = index.members_of(oldname) if indexed else None
+        _progress = None
+        if progress is not None:
+            _progress = lambda done, total: progress('members', done, total)
+        renamed = pas.rename_group(
+            management,
+            oldname,
+            newname,
+            principals,
+            _progress,
+            self.PROGRESS_INTERVAL,
+            )
+        if renamed:
+            properties = pas.mutable_properties_plugins(self._acl_users)
+            for plugin in properties.values():
+                pas.rename_properties(plugin, oldname, newname)
+            if indexed and oldname in index:
+                index.rename_group(oldname, newname)  # if not by plugin
+            path = '/'.join(self.context.getPhysicalPath())
+            _member_cache.invalidate((path, oldname))
+            self._removed(oldname)
+            self._added(newname)
+            newgroup = group_info(newname, site=self.context)
+        else:
+            newgroup = self._copy(oldname, newname, _progress)
+        # site-wide roles of the group follow it to its new name:
+        pas.move_principal_roles(self._acl_users, oldname, newname)
+        if not renamed:
+            self.remove(oldname)
+        if localroles:
+            self._move_localroles(oldname, newname, progress)
         return newgroup
 
+    def _move_localroles(self, oldname, newname, progress=None):
+        """
+        Move local roles assigned to principal oldname to newname, on
+        the site and on content cataloged with the principal in its
+        allowedRolesAndUsers index (which includes inherited local
+        roles, so every object found is reindexed).
+        """
+        def _move(obj):
+            roles = obj.get_local_roles_for_userid(oldname)
+            if roles:
+                obj.manage_setLocalRoles(newname, list(roles))
+                obj.manage_delLocalRoles([oldname])
+        _move(self.context)
+        catalog = getToolByName(self.context, 'portal_catalog')
+        paths = [
+            brain.getPath() for brain in catalog.unrestrictedSearchResults(
+                allowedRolesAndUsers='user:%s' % oldname,
+                )
+            ]
+        total = len(paths)
+        for done, path in enumerate(paths, 1):
+            obj = self.context.unrestrictedTraverse(path, None)
+            if obj is not None:
+                _move(obj)
+                obj.reindexObject(idxs=['allowedRolesAndUsers'])
+            if progress is not None and (
+                    done % self.PROGRESS_INTERVAL == 0 or done == total):
+                progress('localroles', done, total)
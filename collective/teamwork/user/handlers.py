@@ -6,9 +6,12 @@ from zope.lifecycleevent.interfaces import IObjectAddedEvent
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
 from Acquisition import aq_base
 
+from collective.teamwork.user.index import reindex_principal
+from collective.teamwork.user.index import register_principals
 from collective.teamwork.user.interfaces import ISiteMembers
 from collective.teamwork.user.workgroups import WorkspaceRoster
 from collective.teamwork.user.utils import sync_group_roles
+from collective.teamwork.user.utils import workspace_group_names
 from collective.teamwork.utils import get_workspaces
 
 
@@ -31,9 +34,7 @@ def create_workspace_groups_roles(context):
     site = getSite()
     members = ISiteMembers(site)
     pasgroups = members.groups
-    roster = WorkspaceRoster(context)
-    for group in roster.groups.values():
-        groupname, title = group.pas_group()
+    for groupname, title in workspace_group_names(context).values():
         if groupname not in pasgroups:
             pasgroups.add(groupname, title=title)
         else:
@@ -48,6 +49,7 @@ def create_workspace_groups_roles(context):
         if authuser is not None:
             authuser = authuser.getUserName()
             if authuser in members:
+                roster = WorkspaceRoster(context)
                 roster.add(authuser)
                 roster.groups['managers'].add(authuser)
 
@@ -84,9 +86,7 @@ def handle_workspace_move_or_rename(context, event):
         return  # not an add, but a move of existing
     site = getSite()
     pasgroups = ISiteMembers(site).groups
-    roster = WorkspaceRoster(context)
-    for workgroup in roster.groups.values():
-        groupname, title = workgroup.pas_group()
+    for groupname, title in workspace_group_names(context).values():
         if groupname not in pasgroups:
             pasgroups.add(groupname, title=title)
         else:
@@ -99,9 +99,7 @@ def handle_workspace_removal(context, event):
     if site is None:
         return  # in case of recursive plone site removal, ignore
     pasgroups = ISiteMembers(site).groups
-    roster = WorkspaceRoster(context)
-    for group in roster.groups.values():
-        groupname = group.pas_group()[0]
+    for groupname in workspace_group_names(context).groupnames():
         if groupname in pasgroups:
             pasgroups.remove(groupname)
     # remove group names for nested workspaces (also, by implication,
@@ -109,3 +107,41 @@ def handle_workspace_removal(context, event):
     for workspace in get_workspaces(context):
         handle_workspace_removal(workspace, event=event)
 
+
+# event handlers for PAS principal lifecycle, maintaining user indexes:
+
+def _reindex_principal(userid):
+    site = getSite()
+    if site is None:
+        return
+    reindex_principal(site, userid)
+
+
+def handle_principal_created(event):
+    """
+    Handler for IPrincipalCreatedEvent, indexes new user, and creates
+    its group membership storage ahead of any assignment to groups.
+    """
+    userid = event.principal.getId()
+    site = getSite()
+    if site is not None:
+        register_principals(site, [userid])
+    _reindex_principal(userid)
+
+
+def handle_principal_deleted(event):
+    """
+    Handler for IPrincipalDeletedEvent; PAS passes the principal id,
+    not an object, as event.principal.
+    """
+    principal = event.principal
+    if not isinstance(principal, basestring):
+        principal = principal.getId()
+    _reindex_principal(principal)
+
+
+def handle_properties_updated(event):
+    """Handler for IPropertiesUpdatedEvent, reindexes user for search"""
+    principal = event.principal
+    if principal is not None and hasattr(principal, 'getId'):
+        _reindex_principal(principal.getId())
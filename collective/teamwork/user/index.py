@@ -0,0 +1,494 @@
+"""
+collective.teamwork.user.index: persistent, incrementally maintained
+indexes of user (and group) data, stored in annotations of the site.
+
+These avoid repeated enumeration of every PAS plugin for questions
+that are asked on nearly every request (e.g. login name to user id).
+Each index only covers the plugins it was built from; callers are
+expected to fall back to plugin enumeration for anything else.
+"""
+
+from Acquisition import aq_inner, aq_parent
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree, OOSet, OOTreeSet
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from Products.CMFCore.interfaces import ISiteRoot
+from zope.annotation.interfaces import IAnnotations
+
+from collective.teamwork.interfaces import APP_LOG
+from search import search_index, reindex_user
+import pas
+
+
+USER_INDEX_KEY = 'collective.teamwork.user.index.UserIndex'
+GROUP_INDEX_KEY = 'collective.teamwork.user.index.GroupIndex'
+
+
+_str = lambda v: v.encode('utf-8') if isinstance(v, unicode) else str(v)
+
+
+class UserIndex(Persistent):
+    """
+    Bidirectional index of login name to user id, and of user id to
+    login name, for users stored in indexed user enumeration plugins.
+    """
+
+    def __init__(self):
+        self.plugins = ()  # ids of indexed enumeration plugins
+        self._generation = Length()
+        self.clear()
+
+    def generation(self):
+        """
+        Counter incremented on every change to the index, usable
+        for invalidation of caches derived from index contents.
+        """
+        return self._generation()
+
+    def clear(self):
+        self._login_to_userid = OOBTree()
+        self._userid_to_login = OOBTree()
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, login):
+        return _str(login) in self._login_to_userid
+
+    def userid_for(self, login, default=None):
+        return self._login_to_userid.get(_str(login), default)
+
+    def login_for(self, userid, default=None):
+        return self._userid_to_login.get(_str(userid), default)
+
+    def logins(self):
+        return list(self._login_to_userid.keys())
+
+    def items(self):
+        """Return list of (userid, login) tuples"""
+        return list(self._userid_to_login.items())
+
+    def add(self, userid, login):
+        """Add or update (e.g. on login name change) a user"""
+        userid, login = _str(userid), _str(login)
+        previous = self._userid_to_login.get(userid, None)
+        if previous == login:
+            return
+        if previous is None:
+            self._length.change(1)
+        else:
+            del self._login_to_userid[previous]
+        self._userid_to_login[userid] = login
+        self._login_to_userid[login] = userid
+        self._generation.change(1)
+
+    def remove(self, userid):
+        userid = _str(userid)
+        login = self._userid_to_login.get(userid, None)
+        if login is None:
+            raise KeyError(userid)
+        del self._userid_to_login[userid]
+        if self._login_to_userid.get(login, None) == userid:
+            del self._login_to_userid[login]
+        self._length.change(-1)
+        self._generation.change(1)
+
+    def reindex(self, acl_users, userid):
+        """
+        (Re-)index a single user by id from the indexed plugins, or
+        remove the user from the index if no indexed plugin has it.
+        Returns True if the user is indexed.
+        """
+        userid = _str(userid)
+        for name in self.plugins:
+            plugin = getattr(acl_users, name, None)
+            if plugin is None:
+                continue
+            try:
+                login = plugin.getLoginForUserId(userid)
+            except KeyError:
+                continue
+            if login is not None:
+                self.add(userid, login)
+                return True
+        if userid in self._userid_to_login:
+            self.remove(userid)
+        return False
+
+    def rebuild(self, acl_users):
+        """Rebuild index from all indexable enumeration plugins"""
+        plugins = pas.indexable_plugins(acl_users)
+        self.plugins = tuple(sorted(plugins.keys()))
+        self.clear()
+        self._generation.change(1)
+        for plugin in plugins.values():
+            for userid, login in pas.list_users(plugin):
+                self.add(userid, login)
+
+
+def _merge_keys(old, committed, new):
+    """
+    Merge keys of conflicting set states: keys added and removed by the
+    new state (relative to old) are applied to the committed state.
+    """
+    added, removed = new - old, old - new
+    return tuple(sorted((committed | added) - removed))
+
+
+class MembershipBucket(OOSet):
+    """
+    Bucket of a MembershipTreeSet: resolves conflicts stock buckets
+    cannot, the same key added (or removed) by both transactions.
+    """
+
+    def _p_resolveConflict(self, old, committed, new):
+        try:
+            return OOSet._p_resolveConflict(self, old, committed, new)
+        except ConflictError:
+            # state is (keys,) or (keys, next bucket); only keys merge:
+            if not old[1:] == committed[1:] == new[1:]:
+                raise  # bucket split or linked differently
+            keys = [set(state[0]) for state in (old, committed, new)]
+            return (_merge_keys(*keys),) + tuple(committed[1:])
+
+
+class MembershipTreeSet(OOTreeSet):
+    """
+    OOTreeSet of principal (or group) ids, for group membership, with
+    set semantics for conflicting writes: concurrent additions and
+    removals of different ids merge (as they do for any OOTreeSet),
+    and so do the same id added (or removed) by both transactions,
+    which stock buckets treat as a conflict.
+    """
+
+    _bucket_type = MembershipBucket
+
+    def _p_resolveConflict(self, old, committed, new):
+        try:
+            return OOTreeSet._p_resolveConflict(self, old, committed, new)
+        except ConflictError:
+            # small sets store one bucket inline, as ((keys,),), or None
+            # if empty; larger sets resolve conflicts in their buckets:
+            states = (old, committed, new)
+            if not all(state is None or len(state) == 1 for state in states):
+                raise
+            keys = [set(state[0][0]) if state else set() for state in states]
+            merged = _merge_keys(*keys)
+            return ((merged,),) if merged else None
+
+
+class GroupIndex(Persistent):
+    """
+    Index of direct group membership for principals (users or nested
+    groups) in indexed group plugins: a reverse index of principal id
+    to group ids, and an index of group id to principal ids.
+    """
+
+    def __init__(self):
+        self.plugins = ()  # ids of indexed group plugins
+        self._generation = Length()
+        self.clear()
+
+    def generation(self):
+        """
+        Counter incremented on every change to the index, usable
+        for invalidation of caches derived from index contents.
+        """
+        return self._generation()
+
+    def clear(self):
+        # membership sets are MembershipTreeSet (OOTreeSet, if older):
+        self._groups = OOBTree()   # principal id -> set of group ids
+        self._members = OOBTree()  # group id -> set of principal ids
+        # group id -> Length, counter of changes to group; these are not
+        # cleared, so that a group's generation never repeats:
+        if getattr(self, '_generations', None) is None:
+            self._generations = OOBTree()
+
+    def group_generation(self, group):
+        """
+        Counter incremented on every change to the direct membership
+        of a group, usable for invalidation of caches of members.
+        """
+        counter = self._generations.get(_str(group), None)
+        return counter() if counter is not None else 0
+
+    def group_committed(self, group):
+        """
+        Is the generation of the group unchanged by the current
+        transaction (as seen by this connection)?  Caches shared across
+        transactions should only store values for committed generations.
+        """
+        counter = self._generations.get(_str(group), None)
+        if counter is None:
+            return True
+        return counter._p_jar is not None and not counter._p_changed
+
+    def committed(self):
+        """Is the generation of the index unchanged by this transaction?"""
+        counter = self._generation
+        return counter._p_jar is not None and not counter._p_changed
+
+    def touch(self, group):
+        """Increment generation of group (and of index)"""
+        group = _str(group)
+        if group not in self._generations:
+            self._generations[group] = Length()
+        self._generations[group].change(1)
+        self._generation.change(1)
+
+    def __len__(self):
+        """Number of groups"""
+        return len(self._members)
+
+    def __contains__(self, group):
+        return _str(group) in self._members
+
+    def groups_for(self, principal):
+        """List of ids of groups directly containing principal"""
+        return list(self._groups.get(_str(principal), ()))
+
+    def members_of(self, group):
+        """List of ids of principals directly contained by group"""
+        return list(self._members.get(_str(group), ()))
+
+    def nested_groups(self, groups):
+        """List of ids of groups directly contained by any of groups"""
+        return [
+            principal
+            for group in groups
+            for principal in self._members.get(_str(group), ())
+            if principal in self._members
+            ]
+
+    def containing_groups(self, groups):
+        """List of ids of groups directly containing any of groups"""
+        return [
+            group
+            for principal in groups
+            for group in self._groups.get(_str(principal), ())
+            ]
+
+    def add_group(self, group):
+        group = _str(group)
+        if group not in self._members:
+            self._members[group] = MembershipTreeSet()
+            self.touch(group)
+        self.add_principal(group)  # as principal in other groups
+
+    def remove_group(self, group):
+        """Remove group, and any membership of principals in it"""
+        group = _str(group)
+        members = self._members.get(group, None)
+        if members is None:
+            return
+        for principal in list(members):
+            self._discard(self._groups, principal, group)
+        del self._members[group]
+        self.touch(group)
+
+    def add(self, principal, group):
+        """Add principal to group"""
+        principal, group = _str(principal), _str(group)
+        if group in self._groups.get(principal, ()):
+            return
+        for tree, key, value in ((self._groups, principal, group),
+                                 (self._members, group, principal)):
+            if key not in tree:
+                tree[key] = MembershipTreeSet()
+            tree[key].insert(value)
+        self.touch(group)
+
+    def remove(self, principal, group):
+        """Remove principal from group"""
+        principal, group = _str(principal), _str(group)
+        if group not in self._groups.get(principal, ()):
+            return
+        self._discard(self._groups, principal, group)
+        self._members[group].remove(principal)
+        self.touch(group)
+
+    def rename_group(self, oldname, newname):
+        """
+        Move direct membership of group (and of the group as a principal
+        in other groups) from oldname to newname.
+        """
+        members = self.members_of(oldname)
+        containing = self.groups_for(oldname)
+        self.remove_group(oldname)
+        self.remove_principal(oldname)
+        self.add_group(newname)
+        for principal in members:
+            self.add(principal, newname)
+        for group in containing:
+            self.add(newname, group)
+
+    def add_principal(self, principal):
+        """
+        Create (empty) set of groups for principal, if missing, ahead
+        of (possibly concurrent) assignment to groups.
+        """
+        principal = _str(principal)
+        if principal not in self._groups:
+            self._groups[principal] = MembershipTreeSet()
+
+    def remove_principal(self, principal):
+        """Remove principal from all groups"""
+        principal = _str(principal)
+        for group in self.groups_for(principal):
+            self.remove(principal, group)
+
+    def _discard(self, tree, key, value):
+        values = tree.get(key, None)
+        if values is None or value not in values:
+            return
+        # an emptied set is kept: deleting it from the tree would lose
+        # a concurrent (conflict-resolved) addition to it.
+        values.remove(value)
+
+    def reindex(self, acl_users, principal):
+        """
+        (Re-)index direct group membership of a single principal from
+        the indexed plugins.
+        """
+        principal = _str(principal)
+        groups = set()
+        for name in self.plugins:
+            plugin = getattr(acl_users, name, None)
+            if plugin is not None:
+                groups.update(pas.principal_groups(plugin, principal))
+        current = set(self.groups_for(principal))
+        for group in groups - current:
+            self.add(principal, group)
+        for group in current - groups:
+            self.remove(principal, group)
+
+    def rebuild(self, acl_users):
+        """Rebuild index from all indexable group plugins"""
+        plugins = pas.indexable_group_plugins(acl_users)
+        self.plugins = tuple(sorted(plugins.keys()))
+        for group in list(self._members.keys()):
+            self.touch(group)  # invalidate, even if group is now gone
+        self.clear()
+        self._generation.change(1)
+        for plugin in plugins.values():
+            for group in pas.group_ids(plugin):
+                self.add_group(group)
+            for principal, groups in pas.list_group_members(plugin):
+                for group in groups:
+                    self.add(principal, group)
+
+
+def user_index(site, create=False):
+    """
+    Get user index stored for site, or None if not installed and
+    create is False.
+    """
+    annotations = IAnnotations(site, None)
+    if annotations is None:
+        return None
+    index = annotations.get(USER_INDEX_KEY, None)
+    if index is None and create:
+        index = annotations[USER_INDEX_KEY] = UserIndex()
+    return index
+
+
+def group_index(site, create=False):
+    """
+    Get group index stored for site, or None if not installed and
+    create is False.
+    """
+    annotations = IAnnotations(site, None)
+    if annotations is None:
+        return None
+    index = annotations.get(GROUP_INDEX_KEY, None)
+    if index is None and create:
+        index = annotations[GROUP_INDEX_KEY] = GroupIndex()
+    return index
+
+
+def plugin_group_index(plugin):
+    """
+    Get tuple of (group index, acl_users) for a group plugin in the
+    user folder of a site, or (None, None) if plugin is not indexed.
+    """
+    acl_users = aq_parent(aq_inner(plugin))
+    site = aq_parent(aq_inner(acl_users))
+    if not ISiteRoot.providedBy(site):
+        return None, None
+    index = group_index(site)
+    if index is None or plugin.getId() not in index.plugins:
+        return None, None
+    return index, acl_users
+
+
+def group_closure(group, adjacent):
+    """
+    Breadth-first closure of groups reachable from group, given a
+    callable returning names of groups adjacent to (containing, or
+    contained by) any in a sequence of names; returns list of names
+    in order found, excluding group itself.  Each group is visited
+    once, so a containment cycle terminates (and is logged).
+    """
+    group = _str(group)
+    result, seen, frontier = [], set([group]), [group]
+    cycle = False
+    while frontier:
+        found = []
+        for name in adjacent(frontier):
+            name = _str(name)
+            cycle = cycle or name == group
+            if name not in seen:
+                seen.add(name)
+                found.append(name)
+        result += found
+        frontier = found
+    if cycle:
+        APP_LOG.warning('Group %s contains itself via nested groups', group)
+    return result
+
+
+def register_principals(site, principal_ids):
+    """
+    Create empty group membership storage for principals, in the group
+    index and in group plugins providing registerPrincipal() (like the
+    workspace group manager), so concurrent first assignments of one
+    principal to different groups do not conflict.
+    """
+    acl_users = site.acl_users
+    groups = group_index(site)
+    plugins = [
+        plugin for plugin in pas.group_management_plugins(acl_users)
+        if hasattr(plugin, 'registerPrincipal')
+        ]
+    for principal_id in principal_ids:
+        principal_id = _str(principal_id)
+        if groups is not None:
+            groups.add_principal(principal_id)
+        for plugin in plugins:
+            plugin.registerPrincipal(principal_id)
+
+
+def reindex_principal(site, userid):
+    """
+    Incrementally update persistent user indexes (login/userid index,
+    search index, and group membership index) for a site, given a
+    user id.
+    """
+    acl_users = site.acl_users
+    groups = group_index(site)
+    if groups is not None:
+        groups.reindex(acl_users, userid)
+    index = user_index(site)
+    if index is None:
+        return
+    indexed = index.reindex(acl_users, userid)
+    searchable = search_index(site)
+    if searchable is None:
+        return
+    if indexed:
+        reindex_user(searchable, acl_users, userid)
+    else:
+        searchable.unindex_user(userid)
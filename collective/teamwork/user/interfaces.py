@@ -84,12 +84,20 @@ class IGroup(Interface):
         Return list of roles in context for the group
         """
 
-    def keys():
+    def keys(transitive=False):
         """
-        Return list of user login names.
+        Return list of user login names.  If transitive is True, include
+        users indirectly contained, via (possibly cyclic) nested groups.
         """
 
-    def values():
+    def nested(transitive=False):
+        """
+        Return list of names of groups directly contained by this group
+        (which are not included in keys); if transitive is True, include
+        groups indirectly contained.
+        """
+
+    def values(transitive=False):
         """
         Return list of user objects providing IPropertiedUser.
         """
@@ -121,6 +129,22 @@ class IGroup(Interface):
     def unassign(username):
         """Unassign a user (login) name from a group"""
 
+    def assign_many(usernames, userids=None):
+        """
+        Add/assign a sequence of user (login) names to group, resolving
+        all user ids at once; raise ValueError (before any assignment)
+        if any user name is unknown.  If given, userids is a mapping
+        of user name to user id already resolved by the caller.
+        """
+
+    def unassign_many(usernames, userids=None):
+        """
+        Unassign a sequence of user (login) names from group; raise
+        ValueError (before any change) if any user name is not a
+        group member.  If given, userids is a mapping of user name to
+        user id already resolved by the caller.
+        """
+
 
 class IGroupListing(IIterableMapping):
     """
@@ -175,14 +199,18 @@ class IGroups(IGroupListing):
         a new name (destination).
         """
 
-    def rename(oldname, newname):
+    def rename(oldname, newname, localroles=False, progress=None):
         """
-        Rename a group, migrate members appropriately. Return the newly
-        created renamed group.
+        Rename a group, migrate members appropriately (in place, where
+        the group plugin supports it). Return the renamed group.
+
+        Note: unless localroles is True, this does not affect objects
+        using local roles assigned to these groups as principals, and
+        calling code renaming a group has the responsibility to sort
+        out the consequences of that.
 
-        Note: this does not affect objects using local roles assigned
-        to these groups as principals.  Calling code renaming a group
-        has the responsibility to sort out the consequences of that.
+        progress, if provided, is a callable called with arguments of
+        (phase, done, total) to report progress on large groups.
         """
 
 
@@ -219,6 +247,14 @@ class ISiteMembers(Interface):
     def __contains__(username):
         """Does user exist in site for user login name"""
 
+    def contains_many(usernames):
+        """
+        Bulk existence check for a sequence of user login names; returns
+        a dict of (normalized) user login name keys to boolean values.
+        Results (positive or negative) may be cached for the duration
+        of a request.
+        """
+
     def __len__():
         """Return number of users in site"""
 
@@ -234,11 +270,41 @@ class ISiteMembers(Interface):
         Non-default result should provide IPropertiedUser.
         """
 
-    def search(query, **kwargs):
+    def get_many(usernames, properties=None, groups=True):
+        """
+        Bulk get of users by user login name; return a list of objects
+        providing IPropertiedUser, in order given, omitting unknown
+        user names.  Users are resolved in batch, with one pass over
+        each PAS plugin for all users.
+
+        If properties is not None, it is a sequence of property names,
+        and only those properties are loaded.  If groups is False,
+        group membership (and roles) are not resolved.
+        """
+
+    def records(usernames, properties=None):
+        """
+        Bulk get of lightweight, read-only member records by user login
+        name, for listing users; return a list of objects providing
+        getId(), getUserName(), getProperty() and propertyIds(), in
+        order given, omitting unknown user names.  Groups and roles
+        are not resolved.
+
+        If properties is not None, it is a sequence of property names
+        to load in addition to fullname and email.
+        """
+
+    def search(query, limit=None, offset=0, **kwargs):
         """
         Given a string or unicode object as a query, search for
-        user by full name or user login name.  Return a
-        iterator of tuples of (username, user) for each match.
+        user by full name, email, or user login name.  Return a
+        list of tuples of (username, result) for each match, where
+        result is a lightweight record providing getId(), getUserName()
+        and getProperty() for 'fullname' and 'email' properties.
+
+        Results are ranked (best match first) if a search index is
+        available, and may be sliced using limit and offset.
+
         Fielded search keywords can be passed for use by underlying
         user query mechanism provided by PluggableAuthService.
         """
@@ -252,11 +318,25 @@ class ISiteMembers(Interface):
         the internal user id for that user.
         """
 
+    def userids_for(usernames):
+        """
+        Bulk lookup of internal user ids for user (login) names; returns
+        a mapping of (normalized) login name to user id, omitting
+        unknown user names.
+        """
+
     def login_name(key):
         """
         Get user login name for a user or an internal user id.
         """
 
+    def login_names(userids):
+        """
+        Bulk lookup of user login names for internal user ids; returns
+        an ordered mapping of user id to login name, omitting unknown
+        user ids.
+        """
+
     # add and remove users:
     def register(username, send=True, **kwargs):
         """
@@ -268,6 +348,20 @@ class ISiteMembers(Interface):
         If send argument is false, do not notify user via email.
         """
 
+    def register_many(records, send=True):
+        """
+        Bulk registration of members, given a sequence of dicts, each
+        containing a 'username' key and other member attributes (as
+        keyword arguments to register()).  All records are validated
+        before any member is added; duplicate or existing user names
+        raise KeyError.
+
+        If send is true, notification messages are sent only after
+        the current transaction is successfully committed.
+
+        Returns list of registered user names.
+        """
+
     def __delitem__(username):
         """
         Given a key of user login name, purge/remove a
@@ -278,6 +372,18 @@ class ISiteMembers(Interface):
         component does not check permissions.
         """
 
+    def purge_many(usernames):
+        """
+        Given a sequence of user login names, purge/remove each user
+        from the system in one pass over user plugins.  Returns an
+        ordered mapping of (normalized) user name to an outcome: one
+        of 'purged', 'unknown', or 'not removable'.
+
+        Note: it is expected that callers will check permissions
+        accordingly in the context of the site being managed; this
+        component does not check permissions.
+        """
+
     # other utility functionality
 
     def pwreset(username):
@@ -286,15 +392,33 @@ class ISiteMembers(Interface):
     def groupnames():
         """Return iterable of all groupnames"""
 
-    def groups_for(username):
+    def groups_for(username, transitive=False):
+        """
+        List all PAS groupnames for user login name; unless transitive
+        is True, does not include indirect membership in nested groups.
+        """
+
+    def groups_for_many(usernames, transitive=False):
         """
-        List all PAS groupnames for user login name; does not
-        include indirect membership in nested groups.
+        Bulk lookup of PAS groupnames for user login names (or group
+        names); returns an ordered mapping of (normalized) name keys to
+        lists of groupnames, omitting unknown principals.  Unless
+        transitive is True, does not include indirect membership in
+        nested groups.
         """
 
     def roles_for(context, username):
         """Return roles for context for a given user login name"""
 
+    def roles_for_many(context, usernames):
+        """
+        Bulk lookup of roles in context for user login names (or group
+        names); returns an ordered mapping of (normalized) name keys to
+        lists of roles (local and site-wide), omitting unknown
+        principals.  Local roles are computed for all principals in
+        one walk of the parent chain of context.
+        """
+
     def portrait_for(username, use_default=False):
         """
         Get portrait object for username, or return None (if use_default
@@ -438,6 +562,13 @@ class IWorkspaceGroup(ILocation):
         Raise ValueError if user is not a member of the group.
         """
 
+    def repair():
+        """
+        Create the PAS group(s) for this group if missing; reading
+        membership never creates groups (a missing group is empty),
+        while adding a member does.  Returns IGroup object.
+        """
+
 
 class IWorkspaceRoster(IWorkspaceGroup):
     """
@@ -579,5 +710,18 @@ class IMembershipModifications(Interface):
         unassignments.
 
         Always apply roster assignments before subsidiary group assignment.
+
+        Only the net changes against current membership (see plan())
+        are written, in bulk per group; parent workspace rosters are
+        updated once, and local role caches are invalidated once.
+        """
+
+    def plan():
+        """
+        Return net changes queued, without applying them, as a tuple of
+        two dicts (additions, removals), each keyed by role group name,
+        with values of sets of user names.  Raise RuntimeError if any
+        queued assignment is not allowed (unknown user, or user not
+        in workspace roster for a role group other than base group).
         """
 
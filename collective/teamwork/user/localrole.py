@@ -25,10 +25,19 @@ filter_roles = lambda s: filter(lambda r: r not in BLOCKROLES, s)
 
 def clear_cached_localroles(userid):
     """Given user id (not login name), clear cached localroles"""
+    clear_cached_localroles_many([userid])
+
+
+def clear_cached_localroles_many(userids):
+    """Given user ids, clear cached localroles in one pass"""
     prefix = 'collective.teamwork.user.localrole.checkLocalRolesAllowed'
     request = getRequest()
     anno = IAnnotations(request)
-    relevant = [k for k in anno.keys() if k.startswith(prefix) and userid in k]
+    userids = set(userids)
+    relevant = [
+        k for k in anno.keys()
+        if k.startswith(prefix) and any(userid in k for userid in userids)
+        ]
     for key in relevant:
         del anno[key]
 
@@ -104,6 +113,38 @@ class WorkspaceLocalRoleManager(BasePlugin):
                 workspace = obj  # mark ws as seen before looking at parents
         return list(roles)
 
+    security.declarePrivate("getRolesInContextForMany")
+
+    def getRolesInContextForMany(self, users, object):
+        """
+        List of roles in context for each of a sequence of users, as
+        getRolesInContext() returns for each (and with the same context
+        check of each user), reading local roles of each object in the
+        parent chain once for all users.
+        """
+        infos = [self._user_info(user) for user in users]
+        result = [set() for user in users]
+        workspace = None
+        for obj in self._parent_chain(object):
+            checked = [
+                (roles, principal_ids)
+                for roles, (user, principal_ids) in zip(result, infos)
+                if user._check_context(obj)
+                ]
+            if checked:
+                for provider in self._getAdapters(obj):
+                    rolemap = dict(provider.getAllRoles())
+                    for roles, principal_ids in checked:
+                        for principal_id in principal_ids:
+                            context_roles = list(rolemap.get(principal_id, ()))
+                            if workspace:
+                                # as in getRolesInContext():
+                                context_roles = filter_roles(context_roles)
+                            roles.update(context_roles)
+            if IWorkspaceContext.providedBy(obj):
+                workspace = obj  # mark ws as seen before looking at parents
+        return [list(roles) for roles in result]
+
     security.declarePrivate("checkLocalRolesAllowed")
 
     @cache(get_key=clra_cache_key, get_cache=store_on_request)
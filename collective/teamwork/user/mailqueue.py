@@ -0,0 +1,314 @@
+"""
+collective.teamwork.user.mailqueue: transactional outbound mail queue
+for membership notifications (registration, password reset).
+
+Messages are rendered within a transaction, but only queued for
+delivery after that transaction successfully commits.  Where the site
+MailHost queues mail itself (smtp_queue, a persistent maildir queue
+with its own processor thread) or is not a stock MailHost (e.g. a
+MockMailHost in tests), messages are handed to MailHost.send() with
+immediate=False.  Otherwise, a background worker thread delivers
+queued messages via SMTP in batches, with retry, so that SMTP latency
+never holds a transaction open; note that this queue is kept in
+memory only, so configure smtp_queue where mail must survive restart.
+"""
+
+from collections import namedtuple
+from email import message_from_string
+from email.utils import formatdate, getaddresses, parseaddr
+import heapq
+import itertools
+import Queue
+import smtplib
+import socket
+import threading
+import time
+
+from Acquisition import aq_base
+from Products.MailHost.MailHost import MailHost
+import transaction
+
+from collective.teamwork.interfaces import APP_LOG
+
+
+# SMTP delivery settings, copied from a MailHost at time of queueing:
+SMTPSettings = namedtuple(
+    'SMTPSettings',
+    ('host', 'port', 'userid', 'password', 'tls'),
+    )
+
+# queued message: envelope sender, recipients, text, delivery attempts
+QueuedMessage = namedtuple(
+    'QueuedMessage',
+    ('mfrom', 'mto', 'text', 'attempts'),
+    )
+
+
+def smtp_settings(mailhost):
+    """Get SMTPSettings from a MailHost"""
+    return SMTPSettings(
+        getattr(mailhost, 'smtp_host', 'localhost') or 'localhost',
+        int(getattr(mailhost, 'smtp_port', 25) or 25),
+        getattr(mailhost, 'smtp_uid', '') or None,
+        getattr(mailhost, 'smtp_pwd', '') or None,
+        bool(getattr(mailhost, 'force_tls', False)),
+        )
+
+
+def message_for(text, mto=None, mfrom=None):
+    """
+    Get a QueuedMessage from message text, with envelope recipients
+    (To, Cc, Bcc) and sender (From) parsed from headers if not given;
+    Bcc headers are removed, and a Date header added if missing.
+    """
+    message = message_from_string(text)
+    if not mto:
+        headers = itertools.chain(*[
+            message.get_all(name, []) for name in ('To', 'Cc', 'Bcc')
+            ])
+        mto = [addr for name, addr in getaddresses(list(headers)) if addr]
+    if isinstance(mto, basestring):
+        mto = [mto]
+    if not mfrom:
+        mfrom = parseaddr(message.get('From', ''))[1]
+    if not mto or not mfrom:
+        raise ValueError('Message has no recipients or no sender')
+    del message['Bcc']
+    if 'Date' not in message:
+        message['Date'] = formatdate(localtime=True)
+    return QueuedMessage(mfrom, list(mto), message.as_string(), 0)
+
+
+def mailhost_delivers(mailhost):
+    """
+    Should messages be handed to mailhost (MailHost.send()) rather than
+    to a MailQueue?  True if the MailHost queues mail itself, or is not
+    a stock MailHost (a replacement is trusted to handle delivery).
+    """
+    if getattr(mailhost, 'smtp_queue', False):
+        return True
+    return type(aq_base(mailhost)) is not MailHost
+
+
+def send_after_commit(mailhost, texts, charset='utf-8', queue=None):
+    """
+    Deliver rendered message texts only after (and if) the current
+    transaction successfully commits: via mailhost, if it delivers
+    mail itself (see mailhost_delivers()) and no queue is given, or
+    via the given queue (or the default, shared mail_queue) using the
+    SMTP settings of mailhost.
+    """
+    if queue is None and mailhost_delivers(mailhost):
+        for text in texts:
+            # not immediate: MailHost defers delivery until commit
+            mailhost.send(text, immediate=False, charset=charset)
+        return
+    queue = queue if queue is not None else mail_queue
+    queue.after_commit(
+        smtp_settings(mailhost),
+        [message_for(text) for text in texts],
+        )
+
+
+class MailQueue(object):
+    """
+    Thread-safe outbound mail queue, drained by a daemon worker thread
+    (started on demand).  The worker delivers up to batch_size messages
+    for the same SMTP settings over one connection, with a socket
+    timeout of timeout seconds.  Messages failing to deliver because
+    of connection or transient (4xx) server errors are scheduled for
+    retry after retry_delay seconds, up to retries times; the worker
+    keeps delivering other messages meanwhile.  Messages refused
+    permanently (5xx), or for all recipients, are logged and dropped.
+
+    smtp_factory is a callable taking (host, port, timeout=...)
+    returning an object with the smtplib.SMTP API, which may be
+    replaced for testing with a local, in-process stand-in.
+    """
+
+    def __init__(self, smtp_factory=smtplib.SMTP, batch_size=50, retries=3,
+                 retry_delay=30.0, timeout=30.0):
+        self.smtp_factory = smtp_factory
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._queue = Queue.Queue()
+        self._delayed = []  # heap of (due, seq, settings, message)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = 0   # messages neither delivered nor dropped
+        self._done = threading.Condition(self._lock)
+        self._worker = None
+
+    def put(self, settings, messages):
+        """Queue sequence of QueuedMessage for delivery via settings"""
+        messages = list(messages)
+        with self._lock:
+            self._pending += len(messages)
+        for message in messages:
+            self._queue.put((settings, message))
+        self._start()
+
+    def after_commit(self, settings, messages):
+        """
+        Queue messages for delivery only after (and if) the current
+        transaction successfully commits.
+        """
+        transaction.get().addAfterCommitHook(
+            self._committed,
+            args=(settings, list(messages)),
+            )
+
+    def _committed(self, status, settings, messages):
+        if status:
+            self.put(settings, messages)
+
+    def join(self):
+        """
+        Block until all queued messages are delivered or dropped,
+        including those waiting for retry.
+        """
+        with self._done:
+            while self._pending:
+                self._done.wait()
+
+    def _finished(self, count=1):
+        """Count messages delivered or dropped"""
+        with self._done:
+            self._pending -= count
+            if not self._pending:
+                self._done.notify_all()
+
+    def _start(self):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(
+                target=self._run,
+                name='collective.teamwork mail queue',
+                )
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _batch(self):
+        """
+        Block for next message (or until the next retry is due), then
+        get up to batch_size messages, including retries now due.
+        """
+        batch = []
+        timeout = None
+        if self._delayed:
+            timeout = max(self._delayed[0][0] - time.time(), 0)
+        try:
+            if timeout is None:
+                batch.append(self._queue.get())
+            elif timeout > 0:
+                batch.append(self._queue.get(timeout=timeout))
+        except Queue.Empty:
+            pass
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            if len(batch) >= self.batch_size:
+                break
+            due, seq, settings, message = heapq.heappop(self._delayed)
+            batch.append((settings, message))
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._batch()
+            bysettings = {}
+            for settings, message in batch:
+                bysettings.setdefault(settings, []).append(message)
+            for settings, messages in bysettings.items():
+                self._deliver(settings, messages)
+
+    def _connect(self, settings):
+        smtp = self.smtp_factory(
+            settings.host,
+            settings.port,
+            timeout=self.timeout,
+            )
+        if settings.tls:
+            smtp.starttls()
+        if settings.userid:
+            smtp.login(settings.userid, settings.password)
+        return smtp
+
+    def _permanent(self, error):
+        """Is error a permanent (5xx) SMTP error response?"""
+        code = getattr(error, 'smtp_code', None)
+        return isinstance(code, int) and 500 <= code < 600
+
+    def _drop(self, messages, reason):
+        for message in messages:
+            APP_LOG.error('%s, message dropped: %s', reason, message.mto)
+        self._finished(len(messages))
+
+    def _deliver(self, settings, messages):
+        try:
+            smtp = self._connect(settings)
+        except (socket.error, smtplib.SMTPException) as error:
+            if self._permanent(error):
+                self._drop(messages, 'SMTP server refused connection')
+                return
+            APP_LOG.exception('Unable to connect to SMTP server')
+            self._retry(settings, messages)
+            return
+        except Exception:
+            APP_LOG.exception('Mail queue delivery failure')
+            self._drop(messages, 'Unexpected error')
+            return
+        failed = []
+        try:
+            for message in messages:
+                try:
+                    smtp.sendmail(message.mfrom, message.mto, message.text)
+                except smtplib.SMTPRecipientsRefused:
+                    self._drop([message], 'Recipients refused')
+                except (socket.error, smtplib.SMTPException) as error:
+                    if self._permanent(error):
+                        self._drop([message], 'Message refused')
+                    else:
+                        failed.append(message)
+                except Exception:
+                    APP_LOG.exception('Mail queue delivery failure')
+                    self._drop([message], 'Unexpected error')
+                else:
+                    self._finished()
+        finally:
+            try:
+                smtp.quit()
+            except (socket.error, smtplib.SMTPException):
+                pass
+        if failed:
+            self._retry(settings, failed)
+
+    def _retry(self, settings, messages):
+        """Schedule messages for retry (called only by worker thread)"""
+        due = time.time() + self.retry_delay
+        for message in messages:
+            attempts = message.attempts + 1
+            if attempts > self.retries:
+                APP_LOG.error(
+                    'Giving up on message delivery to %s after %s attempts',
+                    message.mto,
+                    attempts,
+                    )
+                self._finished()
+                continue
+            heapq.heappush(
+                self._delayed,
+                (due, next(self._seq), settings,
+                 message._replace(attempts=attempts)),
+                )
+
+
+# default, shared queue for the process:
+mail_queue = MailQueue()
@@ -1,7 +1,9 @@
+from collections import OrderedDict
 import logging
 import re
 import itertools
 
+
 from Acquisition import aq_base
 from plone.app.workflow.browser.sharing import merge_search_results
 from zope.component import adapts, queryUtility
@@ -11,11 +13,18 @@ from plone.uuid.interfaces import IUUIDGenerator
 from Products.CMFCore.interfaces import ISiteRoot
 from Products.CMFCore.utils import getToolByName
 from Products.PlonePAS.interfaces.plugins import ILocalRolesPlugin
+from Products.PluggableAuthService.interfaces import plugins as PAS
 from Products.PlonePAS.tools.membership import default_portrait
-from Products.PlonePAS.utils import cleanId, getGroupsForPrincipal
+from Products.PlonePAS.utils import cleanId
 
 from collective.teamwork.utils import request_for, log_status
 from interfaces import ISiteMembers, IGroups
+import mailqueue
+from cache import GenerationCache, request_cache
+from index import user_index, group_index, group_closure
+from index import reindex_principal
+from records import MemberRecord, member_record
+from search import search_index, SearchResult
 from utils import authenticated_user
 import pas
 
@@ -29,6 +38,15 @@ except ImportError:
 
 MAILCONF = ('smtp_host', 'email_from_address')
 
+# outcomes of SiteMembers.purge_many() for each user name:
+PURGED, UNKNOWN, NOT_REMOVABLE = ('purged', 'unknown', 'not removable')
+
+# existence answers for user names, shared across requests, when enabled:
+_existence_cache = GenerationCache()
+
+# groups (transitively) containing each group, for group index generation:
+_containment_cache = GenerationCache()
+
 
 class SiteMembers(object):
     """
@@ -44,6 +62,18 @@ class SiteMembers(object):
 
     _rtool = _mdata = None
 
+    # Opt-in sharing of existence checks across requests: entries are
+    # invalidated when the persistent user index generation changes, so
+    # changes made directly to unindexed plugins (outside of SiteMembers)
+    # may not be seen until the next indexed change when this is enabled.
+    shared_existence_cache = False
+
+    # number of users materialized at once in bulk by iteration methods:
+    BATCH_SIZE = 250
+
+    # outbound mail queue for notifications, None for shared default:
+    mail_queue = None
+
     def __init__(self, context=None, request=None):
         self.portal = self.context = context
         if not ISiteRoot.providedBy(context):
@@ -55,9 +85,36 @@ class SiteMembers(object):
         self._uf = getToolByName(self.context, 'acl_users')
         self._enumerators = pas.enumeration_plugins(self._uf)
         self._management = pas.management_plugins(self._uf)
-        self.refresh()
+        self._load_index()
+        self._user_ids_names = self._user_names_ids = None
         self._groups = None
 
+    def _load_index(self):
+        """
+        Load persistent user index, if installed and usable; plugins
+        not covered by the index are enumerated as fallback.
+        """
+        plugins = dict((p.getId(), p) for p in self._enumerators)
+        index = user_index(self.portal)
+        if index is not None and not set(index.plugins).issubset(plugins):
+            index = None  # an indexed plugin is no longer active, ignore
+        self._index = index
+        self._search_index = None
+        if index is not None:
+            self._search_index = search_index(self.portal)
+        indexed = index.plugins if index is not None else ()
+        self._unindexed = [
+            plugin for name, plugin in plugins.items() if name not in indexed
+            ]
+        groupmakers = self._uf.plugins.listPlugins(PAS.IGroupsPlugin)
+        self._groupmakers = groupmakers
+        groups = group_index(self.portal)
+        if groups is not None:
+            active = set(name for name, plugin in groupmakers)
+            if not set(groups.plugins).issubset(active):
+                groups = None  # an indexed plugin is no longer active
+        self._group_index = groups
+
     @property
     def groups(self):
         if self._groups is None:
@@ -80,32 +137,122 @@ class SiteMembers(object):
     def _log(self, msg, level=logging.INFO):
         log_status(msg, self.context, level=level)
 
-    def _usernames(self):
+    def _unindexed_users(self):
+        """Mapping of user id to login for users in unindexed plugins"""
         if self._user_ids_names is None:
-            users = set().union(*map(pas.list_users, self._enumerators))
+            users = set().union(*map(pas.list_users, self._unindexed))
             self._user_ids_names = dict(users)
-            self._user_names_ids = zip(*list(reversed(zip(*users))))
-        return self._user_ids_names.values()
+            self._user_names_ids = dict((v, k) for k, v in users)
+        return self._user_ids_names
+
+    def _usernames(self):
+        names = self._unindexed_users().values()
+        if self._index is None:
+            return names
+        if not names:
+            return self._index.logins()
+        # de-duplicate, as users may be in indexed and unindexed plugins:
+        return list(
+            OrderedDict.fromkeys(itertools.chain(self._index.logins(), names))
+            )
+
+    def _reindex(self, userid):
+        """Incrementally update persistent indexes for a user id"""
+        if self._index is not None:
+            reindex_principal(self.portal, userid)
 
     def applyTransform(self, username):
         return self._uf.applyTransform(username)
 
     def refresh(self):
+        # only caches for unindexed plugins; persistent index is maintained
+        # incrementally and need not be discarded.
         self._user_ids_names = None
         self._user_names_ids = None
+        self._existence().clear()
+
+    def _existence(self):
+        """
+        Request-scoped cache of user name to (positive or negative)
+        existence; when shared_existence_cache is enabled and there is
+        a user index, shared across requests for the index generation.
+        """
+        path = '/'.join(self.portal.getPhysicalPath())
+        if self.shared_existence_cache and self._index is not None:
+            return _existence_cache.get(path, self._index.generation())
+        return request_cache(
+            'collective.teamwork.user.members.exists:%s' % path,
+            self.request,
+            )
+
+    def _enumerate_logins(self, usernames):
+        """
+        Return dict of (transformed) login name to user id for the given
+        login names found in unindexed plugins, making one enumeration
+        call per plugin known to match a sequence of login names, and
+        one call per name for any other plugin.
+        """
+        found = {}
+        for plugin in self._unindexed:
+            if pas.matches_login_sequence(plugin):
+                r = plugin.enumerateUsers(
+                    login=tuple(usernames),
+                    exact_match=True,
+                    )
+            else:
+                _enum = lambda n: plugin.enumerateUsers(
+                    login=n,
+                    exact_match=True,
+                    )
+                r = itertools.chain(*map(_enum, usernames))
+            for info in r:
+                if info.get('login'):
+                    login = str(self.applyTransform(info.get('login')))
+                    found.setdefault(login, info.get('id'))
+        return found
+
+    def contains_many(self, usernames):
+        """
+        Bulk check of existence of users by login name, returns a dict
+        of (transformed) user name keys to boolean values.  Users not
+        in the persistent user index, nor already known to the request
+        (or shared) cache, are checked in one pass over unindexed plugins.
+        """
+        names = set(str(self.applyTransform(name)) for name in usernames)
+        result = {}
+        if self._index is not None:
+            # index lookups are cheap, and always current; not cached:
+            result.update((name, True) for name in names
+                          if name in self._index)
+        unknown = [name for name in names if name not in result]
+        if not unknown:
+            return result
+        cache = self._existence()
+        result.update((name, cache[name]) for name in unknown if name in cache)
+        unknown = [name for name in unknown if name not in result]
+        if unknown:
+            found = self._enumerate_logins(unknown) if self._unindexed else {}
+            checked = dict((name, name in found) for name in unknown)
+            cache.update(checked)
+            result.update(checked)
+        return result
 
     def __contains__(self, username):
         """Does user exist in site for user login name / email"""
-        username = self.applyTransform(username)
-        within = lambda p: p.enumerateUsers(login=username, exact_match=True)
-        return any(map(within, self._enumerators))
+        username = str(self.applyTransform(username))
+        return self.contains_many((username,))[username]
 
     def __len__(self):
         """Return number of users in site"""
         listids = lambda plugin: pas.list_users(plugin, keyonly=True)
-        if self._user_ids_names:
-            return len(self._user_ids_names)
-        return len(set().union(*map(listids, self._enumerators)))
+        if self._user_ids_names is not None:
+            userids = self._user_ids_names.keys()
+        else:
+            userids = set().union(*map(listids, self._unindexed))
+        if self._index is None:
+            return len(userids)
+        _unindexed = lambda userid: self._index.login_for(userid) is None
+        return len(self._index) + len(filter(_unindexed, userids))
 
     def __getitem__(self, username):
         """
@@ -128,6 +275,137 @@ class SiteMembers(object):
             return default
         return self._uf.getUser(username)
 
+    def _userids_for(self, usernames):
+        """
+        Return dict of (transformed) login name to user id for existing
+        users among usernames, using the user index and then one pass
+        over unindexed plugins.
+        """
+        names = [str(self.applyTransform(name)) for name in usernames]
+        result = {}
+        if self._index is not None:
+            for name in names:
+                userid = self._index.userid_for(name)
+                if userid is not None:
+                    result[name] = userid
+        missing = [name for name in names if name not in result]
+        if missing and self._unindexed:
+            found = self._enumerate_logins(missing)
+            result.update(
+                (name, found[name]) for name in missing if found.get(name)
+                )
+        return result
+
+    def _get_many(self, usernames, properties=None, groups=True):
+        """
+        Return list of (username, user) tuples for existing users in
+        usernames; this does what PAS getUser() does for a single user,
+        but with one pass over each plugin for all users in batch.
+        """
+        names = OrderedDict.fromkeys(
+            str(self.applyTransform(name)) for name in usernames
+            ).keys()
+        userids = self._userids_for(names)
+        plugins = self._uf.plugins
+        users = [
+            (name, self._uf._createUser(plugins, userids[name], name))
+            for name in names if name in userids
+            ]
+        for sheet_id, plugin in plugins.listPlugins(PAS.IPropertiesPlugin):
+            for name, user in users:
+                data = plugin.getPropertiesForUser(user, self.request)
+                if data and properties is not None:
+                    if hasattr(data, 'propertyItems'):
+                        data = dict(data.propertyItems())
+                    data = dict(
+                        (k, v) for k, v in data.items() if k in properties
+                        )
+                if data:
+                    user.addPropertysheet(sheet_id, data)
+        if groups:
+            self._add_groups([user for name, user in users])
+            for rolemaker_id, plugin in plugins.listPlugins(PAS.IRolesPlugin):
+                for name, user in users:
+                    roles = plugin.getRolesForPrincipal(user, self.request)
+                    if roles:
+                        user._addRoles(roles)
+            for name, user in users:
+                user._addRoles(['Authenticated'])
+        return [(name, user.__of__(self._uf)) for name, user in users]
+
+    def _add_groups(self, users):
+        """
+        Add direct groups to (unwrapped) PAS principal objects from each
+        groups plugin, in plugin order as PAS does; membership in indexed
+        plugins is answered by the persistent group index.
+        """
+        index = self._group_index
+        for groupmaker_id, plugin in self._groupmakers:
+            indexed = index is not None and groupmaker_id in index.plugins
+            for user in users:
+                if indexed:
+                    groups = index.groups_for(user.getId())
+                else:
+                    groups = plugin.getGroupsForPrincipal(user, self.request)
+                user._addGroups(groups)
+
+    def get_many(self, usernames, properties=None, groups=True):
+        """
+        Bulk get of users by user name / email address.  Returns a list
+        of objects providing IPropertiedUser, in order given, omitting
+        any unknown user names.
+
+        If properties is not None, it is a sequence of property names,
+        and only those properties are loaded.  If groups is False, groups
+        (and roles, which depend upon groups) are not resolved.
+        """
+        return [user for name, user in self._get_many(
+            usernames,
+            properties,
+            groups,
+            )]
+
+    def records(self, usernames, properties=None):
+        """
+        Get list of lightweight, read-only MemberRecord objects for
+        user names, in order given, omitting unknown user names.
+        Properties are read directly from property plugin storage
+        where possible; no groups or roles are resolved.
+
+        If properties is not None, it is a sequence of property names
+        to load in addition to fullname and email.
+        """
+        names = OrderedDict.fromkeys(
+            str(self.applyTransform(name)) for name in usernames
+            ).keys()
+        userids = self._userids_for(names)
+        found = [(name, userids[name]) for name in names if name in userids]
+        sheets = dict((userid, []) for name, userid in found)
+        wanted = None
+        if properties is not None:
+            wanted = set(properties).union(MemberRecord.BASE_PROPERTIES)
+        plugins = self._uf.plugins.listPlugins(PAS.IPropertiesPlugin)
+        for sheet_id, plugin in plugins:
+            if pas.direct_properties(plugin):
+                defaults = plugin._getDefaultValues()
+                for name, userid in found:
+                    sheets[userid].append(
+                        pas.stored_properties(plugin, userid, defaults)
+                        )
+                continue
+            for name, userid in found:
+                # record without properties stands in for user object:
+                user = MemberRecord(userid, name)
+                data = plugin.getPropertiesForUser(user, self.request)
+                if data and hasattr(data, 'propertyItems'):
+                    data = dict(data.propertyItems())
+                if data:
+                    sheets[userid].append(data)
+        return [
+            member_record(userid, name, sheets[userid], wanted)
+            for name, userid in found
+            ]
+
     def userid_for(self, key):
         """
         Given key as login name or a user object, return
@@ -137,16 +415,22 @@ class SiteMembers(object):
         avoids an optimization that would be specific to
         ZODBUserManager
         """
-        key = self.applyTransform(key)
-        if self._user_names_ids and key in self._user_names_ids:
-            return self._user_names_ids.get(key)
         user = key
         if isinstance(key, basestring):
-            key = str(key)
+            key = str(self.applyTransform(key))
+            if self._index is not None and key in self._index:
+                return self._index.userid_for(key)
             if self._user_names_ids and key in self._user_names_ids:
                 return self._user_names_ids.get(key)
             user = self.get(key)
-        return user.getId()
+        return user.getId() if user is not None else None
+
+    def userids_for(self, usernames):
+        """
+        Bulk lookup of user ids for login names; returns a dict of
+        (normalized) login name to user id, omitting unknown names.
+        """
+        return self._userids_for(usernames)
 
     def login_name(self, key):
         """
@@ -155,32 +439,117 @@ class SiteMembers(object):
         user = key
         if isinstance(key, basestring):
             key = str(key)
+            if self._index is not None:
+                login = self._index.login_for(key)
+                if login is not None:
+                    return login
             if self._user_ids_names and key in self._user_ids_names:
                 return self._user_ids_names.get(key)
             user = self._uf.getUserById(key, self.get(key))
         return user.getUserName() if user else None
 
-    def search(self, query, **kwargs):
+    def login_names(self, userids):
+        """
+        Bulk lookup of login names for user ids; returns an ordered dict
+        of user id to login name, in order given, omitting unknown ids.
+        Uses the user index, then the (cached) table of users in
+        unindexed plugins, and only then looks up remaining users.
+        """
+        userids = OrderedDict.fromkeys(map(str, userids)).keys()
+        found = {}
+        if self._index is not None:
+            for userid in userids:
+                login = self._index.login_for(userid)
+                if login is not None:
+                    found[userid] = login
+        missing = [userid for userid in userids if userid not in found]
+        if missing and self._unindexed:
+            table = self._unindexed_users()
+            found.update(
+                (userid, table[userid]) for userid in missing
+                if table.get(userid) is not None
+                )
+            missing = [userid for userid in missing if userid not in found]
+        for userid in missing:
+            # e.g. users in plugins that cannot enumerate all users:
+            user = self._uf.getUserById(userid)
+            if user is not None:
+                found[userid] = user.getUserName()
+        return OrderedDict(
+            (userid, found[userid]) for userid in userids if userid in found
+            )
+
+    def search(self, query, limit=None, offset=0, **kwargs):
         """
         Given a string or unicode object as a query, search for
         user by full name or email address / user id.  Return a
-        iterator of tuples of (username, user) for each match.
+        list of tuples of (username, result) for each match, where
+        result is a lightweight SearchResult record (not a user object),
+        ranked best match first when the search index is installed.
+
+        Results may be paginated using limit and offset.  Additional
+        fielded search keywords bypass the search index, and are passed
+        to PAS searchUsers().
+        """
+        end = offset + limit if limit is not None else None
+        if self._search_index is None or kwargs:
+            result = self._search_plugins(query, **kwargs)
+        else:
+            result = self._search_index.search(query)
+            if self._unindexed:
+                seen = set(r.login for r in result)
+                result += [
+                    r for r in self._search_plugins(query, unindexed=True)
+                    if r.login not in seen
+                    ]
+        return [(r.login, self._result(r)) for r in result[offset:end]]
+
+    def _result(self, result):
+        """
+        Return result record, or a complete copy of a result record
+        missing properties, if needed.
+        """
+        if result.fullname is None:
+            user = self._uf.getUserById(result.userid)
+            _get = lambda name: user.getProperty(name, u'') if user else u''
+            return SearchResult(
+                result.userid,
+                result.login,
+                fullname=_get('fullname'),
+                email=_get('email'),
+                score=result.score,
+                )
+        return result
+
+    def _search_plugins(self, query, unindexed=False, **kwargs):
+        """
+        Search PAS plugins, return list of SearchResult records, whose
+        properties are only loaded (by self._result()) when returned.
+        If unindexed is True, only include users not in the user index.
         """
-        q = {'name': query, 'email': query}  # either name or email
-        q.update(kwargs or {})
         search_fields = ('login', 'fullname')
         result = list(itertools.chain(*[
-            self._uf.searchUsers(**{field: query}) for field in search_fields
+            self._uf.searchUsers(**dict(kwargs, **{field: query}))
+            for field in search_fields
             ]))
         for info in result:
             if 'email' not in info:
                 info['email'] = info['login']
         r = merge_search_results(result, key='email')
         # filter search results in case any PAS plugin is keeping cruft for
-        # since removed users:
-        r = filter(lambda info: info['email'] in self.keys(), r)
-        _t = lambda username: (username, self._uf.getUser(username))
-        return [_t(username) for username in [info['email'] for info in r]]
+        # since removed users (checked in bulk, not per-result):
+        exists = self.contains_many(info['login'] for info in r)
+        _valid = lambda info: exists.get(
+            str(self.applyTransform(info['login'])),
+            False,
+            )
+        r = filter(_valid, r)
+        if unindexed and self._index is not None:
+            r = [info for info in r if info['login'] not in self._index]
+        return [
+            SearchResult(info['id'], info['login'], fullname=None)
+            for info in r
+            ]
 
     def keys(self):
         return self._usernames()
@@ -191,11 +560,20 @@ class SiteMembers(object):
 
     iterkeys = __iter__
 
+    def _batches(self, keys):
+        keys = list(keys)
+        size = self.BATCH_SIZE
+        return (keys[i:i + size] for i in range(0, len(keys), size))
+
     def itervalues(self):
-        return itertools.imap(lambda k: self.get(k), self.keys())
+        for batch in self._batches(self.keys()):
+            for user in self.get_many(batch):
+                yield user
 
     def iteritems(self):
-        return itertools.imap(lambda k: (k, self.get(k)), self.keys())
+        for batch in self._batches(self.keys()):
+            for item in self._get_many(batch):
+                yield item
 
     def values(self):
         return list(self.itervalues())
@@ -204,43 +582,164 @@ class SiteMembers(object):
         return list(self.iteritems())
 
     # add and remove users:
-    def register(self, username, send=True, **kwargs):
+    def _registration(self, username, send=True, **kwargs):
         """
-        Given username and keyword arguments containing
-        possible user/member attributes, register a member.
-        This should trigger the usual registration process: a user
-        should receive an email to complete setup.
+        Validate and return normalized member properties for registration
+        of a (not yet existing) user, or raise KeyError (or ValueError,
+        for an invalid email address when notification is to be sent).
         """
         username = self.applyTransform(username)
         fullname = kwargs.get('fullname', username)
         VALID_EMAIL = re.compile('[A-Za-z0-9_+\-]+@[A-Za-z0-9_+\-]+')
         fallback_email = username if VALID_EMAIL.search(username) else None
         email = kwargs.get('email', fallback_email)
-        if username in self:
-            msg = 'Duplicate username: %s in use' % username
+        if send and email is None:
+            msg = 'email not provided, but send specified'
             self._log(msg, logging.ERROR)
             raise KeyError(msg)
+        if send and not self._reg_tool().isValidEmail(email):
+            # as registeredNotify() would, but before adding any member:
+            raise ValueError('Invalid email address: %s' % email)
+        return {'email': email, 'username': username, 'fullname': fullname}
+
+    def _add_member(self, props):
+        """Add member for validated properties, return user id"""
         rtool = self._reg_tool()
         pw = rtool.generatePassword()     # random temporary password
-        props = {'email': email, 'username': username, 'fullname': fullname}
         userid = self._generate_userid(props)
         rtool.addMember(userid, pw, properties=props)
-        if userid != username:
-            self._uf.updateLoginName(userid, username)
+        if userid != props['username']:
+            self._uf.updateLoginName(userid, props['username'])
+        self._reindex(userid)
+        return userid
+
+    def register(self, username, send=True, **kwargs):
+        """
+        Given username and keyword arguments containing
+        possible user/member attributes, register a member.
+        This should trigger the usual registration process: a user
+        should receive an email to complete setup.
+        """
+        username = self.applyTransform(username)
+        if username in self:
+            msg = 'Duplicate username: %s in use' % username
+            self._log(msg, logging.ERROR)
+            raise KeyError(msg)
+        props = self._registration(username, send, **kwargs)
+        userid = self._add_member(props)
         if send:
-            if email is None:
-                msg = 'email not provided, but send specified'
-                self._log(msg, logging.ERROR)
-                raise KeyError(msg)
-            rtool.registeredNotify(userid)
+            self._queue_mail([self._registration_message(userid)])
         msg = u'Registered user %s (%s) for this site.' % (
-            fullname,
+            props['fullname'],
             username
             )
         if send:
-            msg += u' Sent notification message to user.'
+            msg += u' Notification message queued for sending.'
+        self._log(msg)
+        self.refresh()
+
+    def register_many(self, records, send=True):
+        """
+        Bulk registration: given a sequence of dicts, each containing
+        a 'username' key and other member attributes (as keyword
+        arguments to register()), register all members.
+
+        All records are validated before any user is added; duplicate
+        or existing user names raise KeyError.  If send is true,
+        notification messages are sent only after (and if) the
+        current transaction successfully commits.
+
+        Returns list of registered user names.
+        """
+        registrations = []
+        for record in records:
+            record = dict(record)
+            username = record.pop('username')
+            registrations.append(self._registration(username, send, **record))
+        usernames = [props['username'] for props in registrations]
+        duplicates = set(
+            name for name in usernames if usernames.count(name) > 1
+            )
+        exists = self.contains_many(usernames)
+        duplicates.update(name for name in usernames if exists[str(name)])
+        if duplicates:
+            msg = 'Duplicate username(s): %s in use' % (
+                ', '.join(sorted(duplicates)),
+                )
+            self._log(msg, logging.ERROR)
+            raise KeyError(msg)
+        userids = map(self._add_member, registrations)
+        if send and userids:
+            # render messages now, as password reset requests must be
+            # stored within this transaction; deliver only after commit:
+            self._queue_mail(map(self._registration_message, userids))
+        msg = u'Registered %s users for this site.' % len(userids)
+        if send:
+            msg += u' Notification messages queued for sending.'
         self._log(msg)
         self.refresh()
+        return usernames
+
+    def _mail_encoding(self):
+        return self.portal.getProperty('email_charset', 'utf-8')
+
+    def _registration_message(self, userid):
+        """
+        Render registration notification message text for user id, as
+        portal_registration.registeredNotify() does before sending.
+        """
+        rtool = self._reg_tool()
+        mtool = getToolByName(self.portal, 'portal_membership')
+        pwrt = getToolByName(self.portal, 'portal_password_reset')
+        member = mtool.getMemberById(userid)
+        email = member.getProperty('email')
+        reset = pwrt.requestReset(userid)
+        mail_text = rtool.registered_notify_template(
+            rtool,
+            self.request,
+            member=member,
+            reset=reset,
+            email=email,
+            )
+        if isinstance(mail_text, unicode):
+            mail_text = mail_text.encode(self._mail_encoding())
+        return mail_text
+
+    def _password_message(self, userid):
+        """
+        Render password reset message text for user id, as
+        portal_registration.mailPassword() does before sending.
+        """
+        rtool = self._reg_tool()
+        mtool = getToolByName(self.portal, 'portal_membership')
+        pwrt = getToolByName(self.portal, 'portal_password_reset')
+        member = mtool.getMemberById(userid)
+        reset = pwrt.requestReset(userid)
+        encoding = self._mail_encoding()
+        mail_text = rtool.mail_password_template(
+            rtool,
+            self.request,
+            member=member,
+            reset=reset,
+            password=member.getPassword(),
+            charset=encoding,
+            )
+        if isinstance(mail_text, unicode):
+            mail_text = mail_text.encode(encoding)
+        return mail_text
+
+    def _queue_mail(self, messages):
+        """
+        Queue rendered message texts for delivery (via, or using the
+        settings of, the site MailHost) after the transaction commits.
+        """
+        mailhost = getToolByName(self.portal, 'MailHost')
+        mailqueue.send_after_commit(
+            mailhost,
+            messages,
+            charset=self._mail_encoding(),
+            queue=self.mail_queue,
+            )
 
     def _generate_userid(self, data):
         username = data.get('username')
@@ -262,31 +761,72 @@ class SiteMembers(object):
         accordingly in the context of the site being managed; this
         component does not check permissions.
         """
-        username = self.applyTransform(username)
+        username = str(self.applyTransform(username))
+        outcome = self.purge_many((username,))[username]
+        if outcome == UNKNOWN:
+            raise KeyError('Attempt to delete unknown username: %s' % (
+                username,
+                ))
+        if outcome == NOT_REMOVABLE:
+            raise KeyError(
+                'Unable to remove %s -- not found in removable user '
+                'source.' % (username,)
+                )
+
+    def purge_many(self, usernames):
+        """
+        Given a sequence of user names, purge/remove each user from the
+        system, in one pass over user management and properties plugins.
+        Returns an ordered dict of (normalized) user name keys to outcome
+        values of PURGED, UNKNOWN, or NOT_REMOVABLE.
+
+        Note: it is expected that callers will check permissions
+        accordingly in the context of the site being managed; this
+        component does not check permissions.
+        """
         if not self._management:
             raise KeyError('No plugins allow user removal')
-        if username not in self:
-            msg = 'Attempt to delete unknown username: %s' % username
-            self._log(msg, logging.ERROR)
-            raise KeyError(msg)
-        userid = self.userid_for(username)
-        removed = False
-        for name, plugin in pas.mutable_properties_plugins(self._uf).items():
-            plugin.deleteUser(userid)  # delete user properties
-        for name, plugin in self._management:
-            try:
-                plugin.doDeleteUser(userid)
-                removed = True
-            except KeyError:
-                pass  # continue, user might be in next plugin
-        if not removed:
-            msg = 'Unable to remove %s -- not found in removable user '\
-                  'source.' % (username,)
-            self._log(msg, logging.ERROR)
-            raise KeyError(msg)
-        msg = u'User %s has been removed from this site.' % (username,)
-        self._log(msg)
+        names = OrderedDict.fromkeys(
+            str(self.applyTransform(name)) for name in usernames
+            ).keys()
+        userids = self._userids_for(names)
+        properties = pas.mutable_properties_plugins(self._uf).values()
+        result = OrderedDict()
+        for username in names:
+            userid = userids.get(username)
+            if userid is None:
+                msg = 'Attempt to delete unknown username: %s' % username
+                self._log(msg, logging.ERROR)
+                result[username] = UNKNOWN
+                continue
+            for plugin in properties:
+                plugin.deleteUser(userid)  # delete user properties
+            removed = False
+            for name, plugin in self._management:
+                try:
+                    plugin.doDeleteUser(userid)
+                    removed = True
+                except KeyError:
+                    pass  # continue, user might be in next plugin
+            if not removed:
+                msg = 'Unable to remove %s -- not found in removable user '\
+                      'source.' % (username,)
+                self._log(msg, logging.ERROR)
+                result[username] = NOT_REMOVABLE
+                continue
+            self._reindex(userid)
+            result[username] = PURGED
+        purged = [name for name, v in result.items() if v == PURGED]
+        if len(purged) == 1:
+            self._log(u'User %s has been removed from this site.' % (
+                purged[0],
+                ))
+        elif purged:
+            self._log(u'%s users have been removed from this site.' % (
+                len(purged),
+                ))
         self.refresh()
+        return result
 
     # other utility functionality
 
@@ -303,9 +843,13 @@ class SiteMembers(object):
             raise KeyError(msg)
         mh = aq_base(getToolByName(self.portal, 'MailHost'))
         _all = lambda s: reduce(lambda a, b: bool(a and b), s)
-        if not _all([getattr(mh, k, None) for k in MAILCONF]):
+        # settings of MailHost, or (email_from_address) of site:
+        _setting = lambda k: (
+            getattr(mh, k, None) or self.portal.getProperty(k, None)
+            )
+        if not _all(map(_setting, MAILCONF)):
             msg = u'Site mail settings incomplete; could not reset password'\
-                  u'for user' % username
+                  u' for user %s' % username
             self._log(msg, level=logging.WARNING)
             return
         userid = self.userid_for(username)
@@ -324,48 +868,158 @@ class SiteMembers(object):
             self._log(msg, level=logging.WARNING)
             return
         self.request.form['new_password'] = pw
-        rtool.mailPassword(username, REQUEST=self.request)
-        msg = u'Reset user password and sent reset email to %s' % username
+        self._queue_mail([self._password_message(userid)])
+        msg = u'Reset user password and queued reset email to %s' % username
         self._log(msg, level=logging.INFO)
 
-    def groups_for(self, username):
+    def _group_names(self, names):
+        """Subset of names that are names of existing groups"""
+        if self._group_index is not None:
+            return set(name for name in names if name in self._group_index)
+        known = set()
+        for plugin in pas.group_enumeration_plugins(self._uf):
+            known.update(pas.group_ids(plugin))
+        return set(names).intersection(known)
+
+    def _principals(self, usernames):
         """
-        List all PAS groupnames for username / email; does not
-        include indirect membership in nested groups.
+        Return list of (name, principal) tuples for user (or group) names,
+        in order given, omitting unknown names; each principal is a bare,
+        unwrapped PAS principal object with direct groups added (but no
+        properties or roles).
         """
-        username = self.applyTransform(username)
-        if username not in self:
-            if username not in self._uf.source_groups.listGroupIds():
-                msg = 'Unknown principal in SiteMembers.groups_for(): %s' % (
-                    username,
-                    )
-                self._log(msg, logging.ERROR)
-                raise KeyError(msg)
-        return getGroupsForPrincipal(self.get(username), self._uf.plugins)
+        names = OrderedDict.fromkeys(
+            str(self.applyTransform(name)) for name in usernames
+            ).keys()
+        userids = self._userids_for(names)
+        unknown = [name for name in names if name not in userids]
+        if unknown:
+            userids.update((name, name) for name in self._group_names(unknown))
+        plugins = self._uf.plugins
+        principals = [
+            (name, self._uf._createUser(plugins, userids[name], name))
+            for name in names if name in userids
+            ]
+        self._add_groups([principal for name, principal in principals])
+        return principals
+
+    def _containing(self):
+        """
+        Return tuple of a dict of group name to names of groups containing
+        it (directly or indirectly), and a callable listing groups directly
+        containing any of a sequence of group names, used to compute
+        missing entries.  The dict is shared across requests for the group
+        index generation if all group plugins storing membership are
+        indexed (plugins deriving groups, like recursive_groups and
+        auto_group, store no nesting, so need not be).
+        """
+        index = self._group_index
+        stored = [
+            name for name, plugin in self._groupmakers
+            if pas.stores_group_membership(plugin)
+            ]
+        if index is None or not all(name in index.plugins for name in stored):
+            adjacent = lambda names: itertools.chain(
+                *self.groups_for_many(names).values()
+                )
+            return {}, adjacent
+        containing = {}
+        if index.committed():
+            path = '/'.join(self.portal.getPhysicalPath())
+            containing = _containment_cache.get(path, index.generation())
+        return containing, index.containing_groups
+
+    def _transitive_groups(self, result):
+        """
+        Given ordered dict of principal names to lists of direct group
+        names, add indirect groups to each list (in place).
+        """
+        containing, adjacent = self._containing()
+        for name, groups in result.items():
+            indirect = []
+            for group in groups:
+                if group not in containing:
+                    containing[group] = group_closure(group, adjacent)
+                indirect += containing[group]
+            result[name] = list(OrderedDict.fromkeys(groups + indirect))
+        return result
+
+    def groups_for_many(self, usernames, transitive=False):
+        """
+        Bulk lookup of PAS group names for user names (or group names, for
+        nested groups).  Returns an ordered dict of (normalized) user name
+        keys to lists of group names, omitting unknown principals; unless
+        transitive is True, does not include indirect membership in nested
+        groups.
+        """
+        result = OrderedDict(
+            (name, list(principal.getGroups()))
+            for name, principal in self._principals(usernames)
+            )
+        if transitive:
+            return self._transitive_groups(result)
+        return result
+
+    def groups_for(self, username, transitive=False):
+        """
+        List all PAS groupnames for username / email; unless transitive
+        is True, does not include indirect membership in nested groups.
+        """
+        username = str(self.applyTransform(username))
+        result = self.groups_for_many((username,), transitive)
+        if username not in result:
+            msg = 'Unknown principal in SiteMembers.groups_for(): %s' % (
+                username,
+                )
+            self._log(msg, logging.ERROR)
+            raise KeyError(msg)
+        return result[username]
+
+    def roles_for_many(self, context, usernames):
+        """
+        Return ordered dict of (normalized) user (or group) name to list
+        of roles in context (local roles, and all site-wide roles) for
+        each principal, omitting unknown names.
+
+        Local roles are read in one walk of the parent chain of context
+        for all principals, where local role plugins can provide roles
+        for many users at once (getRolesInContextForMany(), as the
+        enhanced workspace local role manager does), otherwise with
+        one getRolesInContext() call per principal.
+        """
+        principals = self._principals(usernames)
+        result = OrderedDict((name, set()) for name, principal in principals)
+        users = [principal.__of__(self._uf) for name, principal in principals]
+        lrm_plugins = self._uf.plugins.listPlugins(ILocalRolesPlugin)
+        for plugin_id, plugin in lrm_plugins:
+            bulk = getattr(plugin, 'getRolesInContextForMany', None)
+            if bulk is not None:
+                roles = bulk(users, context)
+            else:
+                roles = [plugin.getRolesInContext(u, context) for u in users]
+            for name, user_roles in zip(result.keys(), roles):
+                result[name].update(user_roles)
+        role_mgr = self._uf.portal_role_manager
+        for name, principal in principals:
+            result[name].update(role_mgr.getRolesForPrincipal(principal))
+        return OrderedDict(
+            (name, list(roles)) for name, roles in result.items()
+            )
 
     def roles_for(self, context, username):
         """
         Return roles for context for a given user id (local roles)
         and all site-wide roles for the user.
         """
-        username = self.applyTransform(username)
-        result = set()
-        if username in self:
-            user = self.get(username)
-        elif username in self._uf.source_groups.listGroupIds():
-            user = self._uf.source_groups.getGroup(username)
-        else:
+        username = str(self.applyTransform(username))
+        result = self.roles_for_many(context, (username,))
+        if username not in result:
             msg = 'Unknown principal in SiteMembers.roles_for(): %s' % (
                 username,
                 )
             self._log(msg, logging.ERROR)
             raise KeyError(msg)
-        role_mgr = self._uf.portal_role_manager
-        lrm_plugins = self._uf.plugins.listPlugins(ILocalRolesPlugin)
-        for name, plugin in lrm_plugins:
-            result = result.union(plugin.getRolesInContext(user, context))
-        result = result.union(role_mgr.getRolesForPrincipal(user))
-        return list(result)
+        return result[username]
 
     def portrait_for(self, username, use_default=False):
         """
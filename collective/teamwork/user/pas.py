@@ -3,7 +3,17 @@ collective.teamwork.user.pas:
 Common convenience functions for working with PAS/PlonePAS plugins.
 """
 
+import inspect
+
+from Acquisition import aq_base
 from Products.PluggableAuthService.interfaces import plugins as PAS
+from Products.PluggableAuthService.plugins.RecursiveGroupsPlugin import \
+    RecursiveGroupsPlugin
+from Products.PluggableAuthService.plugins.ZODBGroupManager import \
+    ZODBGroupManager
+from Products.PluggableAuthService.plugins.ZODBUserManager import \
+    ZODBUserManager
+from Products.PlonePAS.plugins.autogroup import AutoGroup
 from Products.PlonePAS.interfaces.plugins import IUserManagement
 from Products.PlonePAS.interfaces.plugins import IMutablePropertiesPlugin
 from Products.PlonePAS.interfaces.group import IGroupManagement
@@ -24,14 +34,215 @@ def mutable_properties_plugins(acl_users):
         )
 
 
-def enumeration_plugins(acl_users):
-    """All enumeration plugins minus known duplicative ones"""
+def direct_properties(plugin):
+    """
+    Can stored properties for a principal be read directly from plugin,
+    without constructing a property sheet?  Duck-typed capabilities of
+    PlonePAS ZODBMutablePropertyProvider.
+    """
+    direct_attrs = ('_storage', '_getDefaultValues')
+    return all(hasattr(aq_base(plugin), n) for n in direct_attrs)
+
+
+def stored_properties(plugin, userid, defaults=None):
+    """
+    Get dict of properties stored for user id in plugin providing
+    direct_properties(), with any defaults for missing values.
+    """
+    result = dict(defaults or {})
+    result.update(plugin._storage.get(userid, None) or {})
+    return result
+
+
+def _enumeration_plugins(acl_users):
     plugins = acl_users.plugins.listPlugins(PAS.IUserEnumerationPlugin)
     result = dict((name, enumerator) for name, enumerator in plugins)
     if 'source_users' in result and 'mutable_properties' in result:
         # we don't need both, will have same keys
         del(result['mutable_properties'])
-    return result.values()
+    return result
+
+
+def enumeration_plugins(acl_users):
+    """All enumeration plugins minus known duplicative ones"""
+    return _enumeration_plugins(acl_users).values()
+
+
+def direct_listing(plugin):
+    """
+    Can plugin list user ids, login names directly?  Duck-typed
+    capabilities of ZODBUserManager.
+    """
+    direct_methods = ('getLoginForUserId', 'listUserIds')
+    return all(hasattr(plugin, n) for n in direct_methods)
+
+
+def matches_login_sequence(plugin):
+    """
+    Does user enumeration plugin match each of a sequence of login
+    names passed to enumerateUsers(login=...), as ZODBUserManager
+    (and its PlonePAS subclass) does?  Other plugins may accept a
+    sequence, but match it as one string, finding nothing.
+    """
+    return isinstance(aq_base(plugin), ZODBUserManager)
+
+
+def indexable_plugins(acl_users):
+    """
+    Dict of name to enumeration plugin, for plugins that can be kept
+    in a persistent user index (collective.teamwork.user.index).
+    """
+    return dict(
+        filter(
+            lambda r: direct_listing(r[1]),
+            _enumeration_plugins(acl_users).items()
+            )
+        )
+
+
+def indexable_group_plugins(acl_users):
+    """
+    Dict of name to groups plugin, for plugins whose group membership
+    can be kept in a persistent group index: those storing membership
+    in a ZODBGroupManager (including the PlonePAS GroupManager), which
+    collective.teamwork.patch wraps to keep the index current.
+    """
+    return dict(
+        filter(
+            lambda r: isinstance(r[1], ZODBGroupManager),
+            _plugins(acl_users, PAS.IGroupsPlugin).items()
+            )
+        )
+
+
+# groups plugins storing no membership of their own: computing groups
+# of groups from other plugins, or assigning a fixed group to all:
+DERIVED_GROUP_PLUGINS = (RecursiveGroupsPlugin, AutoGroup)
+
+
+def stores_group_membership(plugin):
+    """
+    Does groups plugin store group membership (including nesting of
+    groups), rather than derive groups from other plugins or assign
+    a fixed group?
+    """
+    return not isinstance(aq_base(plugin), DERIVED_GROUP_PLUGINS)
+
+
+def list_group_members(plugin):
+    """
+    Return list of (principal id, group ids) tuples for all principals
+    assigned to groups in a ZODBGroupManager, without enumerating
+    each group.
+    """
+    return list(plugin._principal_groups.items())
+
+
+def principal_groups(plugin, principal_id):
+    """Tuple of group ids for a principal id in a ZODBGroupManager"""
+    return tuple(plugin._principal_groups.get(principal_id, ()))
+
+
+def _report(progress, done, total, interval):
+    """Call progress(done, total) every interval items, and when done"""
+    if progress is not None and (done % interval == 0 or done == total):
+        progress(done, total)
+
+
+def _accepts_progress(method):
+    return 'progress' in inspect.getargspec(method).args
+
+
+def rename_group(plugin, oldname, newname, principals=None, progress=None,
+                 interval=100):
+    """
+    Rename a group in place in a plugin, moving its metadata and its
+    membership (of member principals, and of the group as a principal
+    in other groups) in one operation.  Plugins may provide this via
+    a renameGroup() method; ZODBGroupManager storage is modified
+    directly.  Returns False if the plugin does not support rename.
+
+    principals, if given, is a sequence of ids of principals known to
+    include all members of the group, which avoids visiting all
+    principals with any group membership in the plugin.
+
+    progress, if given, is called with (done, total) principals every
+    interval principals, where supported (ZODBGroupManager storage, or
+    a renameGroup() method taking progress and interval arguments);
+    otherwise, once when done.
+    """
+    if hasattr(plugin, 'renameGroup'):
+        if progress is not None and _accepts_progress(plugin.renameGroup):
+            plugin.renameGroup(oldname, newname, progress, interval)
+        else:
+            plugin.renameGroup(oldname, newname)
+            if progress is not None:
+                count = len(plugin.getGroupMembers(newname))
+                progress(count, count)
+        return True
+    if not isinstance(plugin, ZODBGroupManager):
+        return False
+    groups, assignments = plugin._groups, plugin._principal_groups
+    if newname in groups:
+        raise KeyError('Duplicate group id: %s' % newname)
+    info = dict(groups[oldname], id=newname)
+    del groups[oldname]
+    groups[newname] = info
+    if principals is None:
+        principals = assignments.keys()
+    principals = [
+        principal_id for principal_id in principals
+        if oldname in assignments.get(principal_id, ())
+        ]
+    total = len(principals)
+    for done, principal_id in enumerate(principals, 1):
+        assignments[principal_id] = tuple(
+            newname if name == oldname else name
+            for name in assignments[principal_id]
+            )
+        plugin._invalidatePrincipalCache(principal_id)
+        _report(progress, done, total, interval)
+    if not total and progress is not None:
+        progress(0, 0)
+    if oldname in assignments:
+        assignments[newname] = assignments[oldname]  # nested in groups
+        del assignments[oldname]
+    for principal_id in (oldname, newname):
+        plugin._invalidatePrincipalCache(principal_id)
+    return True
+
+
+def move_principal_roles(acl_users, oldname, newname):
+    """
+    Move global roles assigned to principal id oldname to newname, in
+    each role assigner plugin storing assignments as ZODBRoleManager
+    does (duck-typed on its _principal_roles storage).
+    """
+    plugins = acl_users.plugins.listPlugins(PAS.IRoleAssignerPlugin)
+    for plugin_id, plugin in plugins:
+        assigned = getattr(aq_base(plugin), '_principal_roles', None)
+        if assigned is None:
+            continue
+        roles = tuple(assigned.get(oldname, ()))
+        if not roles:
+            continue
+        existing = tuple(assigned.get(newname, ()))
+        plugin.assignRolesToPrincipal(
+            existing + tuple(r for r in roles if r not in existing),
+            newname,
+            )
+        for role_id in roles:
+            plugin.removeRoleFromPrincipal(role_id, oldname)
+
+
+def rename_properties(plugin, oldname, newname):
+    """
+    Move properties stored for a principal id in a plugin providing
+    direct_properties() to a new principal id.
+    """
+    if direct_properties(plugin) and oldname in plugin._storage:
+        plugin._storage[newname] = plugin._storage[oldname]
+        del plugin._storage[oldname]
 
 
 def management_plugins(acl_users):
@@ -57,8 +268,35 @@ def group_info(plugin, name):
     return None
 
 
+def list_group_info(plugin):
+    """
+    List metadata (dicts with id, title, description) for all groups a
+    plugin has, in one call where the plugin allows it.
+    """
+    if hasattr(plugin, 'listGroupInfo'):
+        return plugin.listGroupInfo()  # ZODBGroupManager
+    if hasattr(plugin, 'enumerateGroups'):
+        return plugin.enumerateGroups()
+    return ()
+
+
 def group_management_plugins(acl_users):
-    return _plugins(acl_users, IGroupManagement).values()
+    """Group management plugins, in order of activation (first is used)"""
+    plugins = acl_users.plugins.listPlugins(IGroupManagement)
+    return [plugin for name, plugin in plugins]
+
+
+def group_manager(plugins, group_id):
+    """
+    Of group management plugins (in order of activation), the one that
+    stores group_id, or the first plugin if none does (as for a group
+    yet to be created).
+    """
+    if len(plugins) > 1:
+        for plugin in plugins:
+            if has_group(plugin, group_id):
+                return plugin
+    return plugins[0]
 
 
 def group_enumeration_plugins(acl_users):
@@ -72,10 +310,7 @@ def list_users(plugin, keyonly=False):
     """
     if not PAS.IUserEnumerationPlugin.providedBy(plugin):
         raise ValueError('Plugin does not provide IUserEnumerationPlugin')
-    direct_methods = ('getLoginForUserId', 'listUserIds')
-    direct_listing = all(hasattr(plugin, n) for n in direct_methods)
-    if direct_listing:
-        # duck-typed capabilities of ZODBUserManager:
+    if direct_listing(plugin):
         userids = plugin.listUserIds()
         if keyonly:
             return userids  # optimal for __len__()
@@ -96,3 +331,16 @@ def group_ids(plugin):
         return plugin.listGroupIds()
     return [info.get('id') for info in plugin.enumerateGroups()]
 
+
+def has_group(plugin, group_id):
+    """
+    Does plugin store a group with group_id?  Checked without listing
+    all groups of plugin: via the group storage of ZODBGroupManager
+    (duck-typed), or getGroupById(), or an exact-match enumeration.
+    """
+    groups = getattr(aq_base(plugin), '_groups', None)
+    if groups is not None:
+        return group_id in groups
+    if hasattr(plugin, 'getGroupById'):
+        return bool(plugin.getGroupById(group_id))
+    return bool(plugin.enumerateGroups(id=group_id, exact_match=True))
@@ -0,0 +1,92 @@
+"""
+collective.teamwork.user.records: lightweight, read-only member records
+for listing users, in lieu of full IPropertiedUser objects.
+"""
+
+
+class MemberRecord(object):
+    """
+    Compact, read-only record of a member: user id, login name, and
+    properties.  Provides enough of the IPropertiedUser API (getId,
+    getUserName, getProperty) for use in place of a user object by
+    listing views, without group or role resolution.
+
+    Records are complete on construction (see member_record()), and
+    immutable: attributes cannot be set or deleted afterward.
+    """
+
+    __slots__ = ('userid', 'login', 'fullname', 'email', 'properties')
+
+    BASE_PROPERTIES = ('fullname', 'email')
+
+    def __init__(self, userid, login, fullname=None, email=None,
+                 properties=None):
+        _set = lambda name, value: object.__setattr__(self, name, value)
+        _set('userid', userid)
+        _set('login', login)
+        _set('fullname', fullname)
+        _set('email', email)
+        # properties other than base properties, as tuple of pairs:
+        _set('properties', tuple(sorted((properties or {}).items())))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    def getId(self):
+        return self.userid
+
+    def getUserName(self):
+        return self.login
+
+    def isGroup(self):
+        return False
+
+    def getProperty(self, name, default=None):
+        if name in self.BASE_PROPERTIES:
+            value = getattr(self, name)
+            return default if value is None else value
+        return dict(self.properties).get(name, default)
+
+    def propertyIds(self):
+        """Names of all loaded properties"""
+        base = [
+            name for name in self.BASE_PROPERTIES
+            if getattr(self, name) is not None
+            ]
+        return base + [name for name, value in self.properties]
+
+    def __repr__(self):
+        return '<%s %s (%s)>' % (
+            self.__class__.__name__,
+            self.login,
+            self.userid,
+            )
+
+
+def member_record(userid, login, sheets, names=None):
+    """
+    Build a complete MemberRecord from a sequence of property mappings
+    (property sheets), optionally limited to a set of names.  Earlier
+    sheets take precedence, as the first property sheet found does for
+    PAS users; for base properties, a value of None does not.
+    """
+    data = {}
+    for sheet in sheets:
+        for name, value in sheet.items():
+            if names is not None and name not in names:
+                continue
+            if name in MemberRecord.BASE_PROPERTIES:
+                if data.get(name) is None:
+                    data[name] = value
+                continue
+            data.setdefault(name, value)
+    return MemberRecord(
+        userid,
+        login,
+        fullname=data.pop('fullname', None),
+        email=data.pop('email', None),
+        properties=data,
+        )
@@ -0,0 +1,254 @@
+"""
+collective.teamwork.user.search: persistent user search index over
+login name, full name and email, with prefix and trigram (substring)
+matching and ranked, paginated results.
+"""
+
+import re
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree, OOTreeSet, intersection, union
+from persistent import Persistent
+from zope.annotation.interfaces import IAnnotations
+
+from records import MemberRecord
+
+
+SEARCH_INDEX_KEY = 'collective.teamwork.user.search.MemberSearchIndex'
+
+# scores for ranking results, by type of match:
+EXACT, PREFIX, SUBSTRING = (100, 10, 1)
+
+_WORDSPLIT = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def _u(v):
+    if v is None:
+        return u''
+    if isinstance(v, str):
+        v = v.decode('utf-8')
+    return unicode(v).strip()
+
+
+_text = lambda v: _u(v).lower()  # normalized for search
+
+
+_key = lambda v: v.encode('utf-8')  # BTree keys: always str, never unicode
+
+
+def words(value):
+    """Given (unicode) text, return set of words"""
+    return set(w for w in _WORDSPLIT.split(value) if w)
+
+
+def trigrams(value):
+    """Given (unicode) text, return set of three-character substrings"""
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+class SearchResult(MemberRecord):
+    """
+    Lightweight, read-only user search result record, with a score
+    for ranking.
+    """
+
+    __slots__ = ('score',)
+
+    def __init__(self, userid, login, fullname=u'', email=u'', score=0):
+        super(SearchResult, self).__init__(userid, login, fullname, email)
+        object.__setattr__(self, 'score', score)
+
+
+class MemberSearchIndex(Persistent):
+    """
+    Search index of users by user id.  Each user is indexed by whole
+    (normalized, lower-case) field values, by words for prefix search,
+    and by trigrams for substring search.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._records = OOBTree()   # userid -> (login, fullname, email)
+        self._values = OOBTree()    # whole field value -> userids
+        self._words = OOBTree()     # word -> userids
+        self._trigrams = OOBTree()  # trigram -> userids
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, userid):
+        return str(userid) in self._records
+
+    def _terms(self, record):
+        values, _words, _trigrams = set(), set(), set()
+        for value in map(_text, record):
+            if not value:
+                continue
+            values.add(value)
+            _words.update(words(value))
+            _trigrams.update(trigrams(value))
+        return (
+            (self._values, values),
+            (self._words, _words),
+            (self._trigrams, _trigrams),
+            )
+
+    def _add_terms(self, userid, record):
+        for tree, terms in self._terms(record):
+            for term in map(_key, terms):
+                if term not in tree:
+                    tree[term] = OOTreeSet()
+                tree[term].insert(userid)
+
+    def _remove_terms(self, userid, record):
+        for tree, terms in self._terms(record):
+            for term in map(_key, terms):
+                userids = tree.get(term, None)
+                if userids is None or userid not in userids:
+                    continue
+                userids.remove(userid)
+                if not len(userids):
+                    del tree[term]
+
+    def index_user(self, userid, login, fullname=u'', email=u''):
+        """Index or re-index a user"""
+        userid = str(userid)
+        record = (str(login), _u(fullname), _u(email))
+        previous = self._records.get(userid, None)
+        if previous == record:
+            return
+        if previous is None:
+            self._length.change(1)
+        else:
+            self._remove_terms(userid, previous)
+        self._records[userid] = record
+        self._add_terms(userid, record)
+
+    def unindex_user(self, userid):
+        userid = str(userid)
+        previous = self._records.get(userid, None)
+        if previous is None:
+            return
+        self._remove_terms(userid, previous)
+        del self._records[userid]
+        self._length.change(-1)
+
+    def _lookup(self, query):
+        """
+        Return dict of userid to score for query; all words in query
+        must match (as a prefix or substring of a word in any field).
+        Matching a whole field value exactly ranks highest.
+        """
+        query = _text(query)
+        if not query:
+            return {}
+        scores = {}
+        matched = None
+        for word in words(query) or set([query]):
+            prefixed = self._prefixed(word)
+            candidates = union(prefixed, self._substring(word))
+            if not candidates:
+                matched = None
+                break
+            for userid in prefixed or ():
+                scores[userid] = scores.get(userid, 0) + PREFIX
+            matched = candidates if matched is None else intersection(
+                matched,
+                candidates,
+                )
+            if not matched:
+                break
+        result = dict(
+            (userid, scores.get(userid, 0) + SUBSTRING)
+            for userid in (matched or ())
+            )
+        for userid in self._values.get(_key(query), ()):
+            result[userid] = result.get(userid, 0) + EXACT
+        return result
+
+    def _prefixed(self, word):
+        """Set of userids having a word with given prefix"""
+        result = None
+        start = _key(word)
+        for term in self._words.keys(min=start):
+            if not term.startswith(start):
+                break
+            result = union(result, self._words[term])
+        return result
+
+    def _substring(self, word):
+        """Set of userids having word as a substring of any field"""
+        grams = trigrams(word)
+        if not grams:
+            return None  # too short for substring match, prefix only
+        result = None
+        for gram in grams:
+            userids = self._trigrams.get(_key(gram), None)
+            if userids is None:
+                return None
+            result = userids if result is None else intersection(
+                result,
+                userids,
+                )
+            if not result:
+                return None
+        # trigram intersection may yield false positives, verify:
+        verify = lambda userid: any(
+            word in _text(v) for v in self._records[userid]
+            )
+        return OOTreeSet(filter(verify, result))
+
+    def search(self, query, limit=None, offset=0):
+        """
+        Search for query, returning ranked list of SearchResult objects,
+        sliced by offset and limit.
+        """
+        scores = self._lookup(query)
+        _rank = lambda item: (-item[1], self._records[item[0]][0])
+        ranked = sorted(scores.items(), key=_rank)
+        end = offset + limit if limit is not None else None
+        return [self.record(userid, score) for userid, score in
+                ranked[offset:end]]
+
+    def record(self, userid, score=0):
+        login, fullname, email = self._records[userid]
+        return SearchResult(userid, login, fullname, email, score)
+
+    def rebuild(self, acl_users, userids):
+        """Rebuild index for a sequence of user ids"""
+        self.clear()
+        for userid in userids:
+            reindex_user(self, acl_users, userid)
+
+
+def reindex_user(index, acl_users, userid):
+    """
+    (Re-)index a user from PAS, or unindex if user no longer exists.
+    """
+    user = acl_users.getUserById(userid)
+    if user is None:
+        index.unindex_user(userid)
+        return
+    index.index_user(
+        userid,
+        user.getUserName(),
+        user.getProperty('fullname', u''),
+        user.getProperty('email', u''),
+        )
+
+
+def search_index(site, create=False):
+    """
+    Get search index stored for site, or None if not installed and
+    create is False.
+    """
+    annotations = IAnnotations(site, None)
+    if annotations is None:
+        return None
+    index = annotations.get(SEARCH_INDEX_KEY, None)
+    if index is None and create:
+        index = annotations[SEARCH_INDEX_KEY] = MemberSearchIndex()
+    return index
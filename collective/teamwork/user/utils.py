@@ -1,7 +1,9 @@
 import itertools
+from collections import OrderedDict
 
 from AccessControl.SecurityManagement import getSecurityManager
 from Acquisition import aq_base
+from Products.CMFCore.interfaces import ISiteRoot
 from plone.app.workflow.browser.sharing import SharingView
 from plone.uuid.interfaces import IUUID
 from zope.component import queryUtility
@@ -12,7 +14,6 @@ from collective.teamwork.utils import request_for, get_workspaces
 from collective.teamwork.utils import group_workspace
 from config import APP_ROLES
 from collective.teamwork.user.interfaces import IWorkgroupTypes, ISiteMembers
-from collective.teamwork.user.interfaces import IWorkspaceRoster
 
 
 def authenticated_user(site):
@@ -37,16 +38,15 @@ def user_workspaces(username, context=None, finder=get_workspaces):
     if not all_workspaces:
         # context contains no workspaces, even if context itself is workspace
         return []
-    _pasgroup = lambda g: g.pas_group()
-    _wgroups = lambda w: map(_pasgroup, IWorkspaceRoster(w).groups.values())
-    local_groups = set(
-        zip(*itertools.chain(*map(_wgroups, all_workspaces)))[0]
-        )
+    _wgroups = lambda w: workspace_group_names(w).groupnames()
+    local_groups = set(itertools.chain(*map(_wgroups, all_workspaces)))
     if not local_groups:
         return []
     # get all '-viewers' groups user belongs to, intersect with local:
-    user = ISiteMembers(site).get(username)
-    usergroups = [name for name in user.getGroups() if name.endswith(suffix)]
+    usergroups = [
+        name for name in ISiteMembers(site).groups_for(username)
+        if name.endswith(suffix)
+        ]
     considered = [name for name in local_groups.intersection(usergroups)]
     # each considered group (by suffix convention) is always 1:1 with
     # workspaces, no dupes, so we can map those workspaces:
@@ -78,6 +78,100 @@ def group_namespace(context):
     return IUUID(context)
 
 
+def _workspace_chain(context):
+    """List of context and its parents, up to (excluding) site root"""
+    chain = []
+    while getattr(context, '__parent__', None) is not None:
+        if ISiteRoot.providedBy(context):
+            break
+        chain.append(context)
+        context = context.__parent__
+    return chain
+
+
+class WorkspaceGroupNames(object):
+    """
+    Descriptor of PAS group names and titles for a workspace, computed
+    from its UUID, titles of the workspace and its parents, and group
+    type configuration (IWorkgroupTypes), without loading any
+    PAS-backed objects.  Maps workgroup id (e.g. 'viewers') to a
+    tuple of (PAS group name, group title).
+
+    Use workspace_group_names() to get a (cached) instance.
+    """
+
+    def __init__(self, context, namespace=None, path_title=None):
+        self.namespace = namespace or group_namespace(context)
+        if path_title is None:
+            titles = [o.Title() for o in reversed(_workspace_chain(context))]
+            path_title = ' / '.join(titles).encode('utf-8')
+        self.path_title = path_title
+        config = queryUtility(IWorkgroupTypes)
+        if IProjectContext.providedBy(context):
+            config = config.select('project', config.items)
+        else:
+            config = config.items()
+        self._names = OrderedDict(
+            (name, self.pas_group(info['groupid'], info['title']))
+            for name, info in config
+            )
+
+    def groupname(self, groupid):
+        return '-'.join((self.namespace, groupid))
+
+    def grouptitle(self, title):
+        return u'%s - %s' % (self.path_title, title)
+
+    def pas_group(self, groupid, title):
+        return (self.groupname(groupid), self.grouptitle(title))
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __getitem__(self, name):
+        return self._names[name]
+
+    def get(self, name, default=None):
+        return self._names.get(name, default)
+
+    def keys(self):
+        return self._names.keys()
+
+    def values(self):
+        return self._names.values()
+
+    def items(self):
+        return self._names.items()
+
+    def groupnames(self):
+        return [groupname for groupname, title in self._names.values()]
+
+
+def workspace_group_names(context):
+    """
+    Get WorkspaceGroupNames for a workspace context.  The UUID and
+    title parts are cached in a volatile attribute of the workspace,
+    keyed by its path and the modification times of it and its
+    parents (so moving or re-titling any of these invalidates);
+    group type configuration is always read anew.
+    """
+    chain = _workspace_chain(context)
+    key = (
+        context.getPhysicalPath(),
+        tuple(o.modified() for o in chain),
+        )
+    cached = getattr(aq_base(context), '_v_workspace_group_names', None)
+    if cached is not None and cached[0] == key:
+        namespace, path_title = cached[1]
+        return WorkspaceGroupNames(context, namespace, path_title)
+    names = WorkspaceGroupNames(context)
+    aq_base(context)._v_workspace_group_names = (
+        key,
+        (names.namespace, names.path_title),
+        )
+    return names
+
+
 def always_inherit_local_roles(context):
     if bool(getattr(aq_base(context), '__ac_local_roles_block__', False)):
         context.__ac_local_roles_block__ = None  # always inherit local roles
@@ -11,23 +11,24 @@ __copyright__ = """
 __license__ = 'GPL'
 
 
-import itertools
 import logging
 
 from plone.indexer.decorator import indexer
-from Products.CMFCore.interfaces import ISiteRoot
 from zope.interface import implements
 from zope.component import adapts, queryUtility
 from zope.component.hooks import getSite
+from Products.CMFCore.interfaces import ISiteRoot
+from Products.CMFCore.utils import getToolByName
 
 from collective.teamwork.interfaces import IWorkspaceContext, IProjectContext
 from collective.teamwork.user import interfaces
-from collective.teamwork.user.groups import GroupInfo, Groups
+from collective.teamwork.user.groups import Groups, group_info
 from collective.teamwork.user.localrole import clear_cached_localroles
+from collective.teamwork.user.localrole import clear_cached_localroles_many
 from collective.teamwork.user.utils import group_namespace, user_workspaces
+from collective.teamwork.user.utils import workspace_group_names
 from collective.teamwork.user.config import BASE_GROUPNAME
-from collective.teamwork.utils import get_projects, get_workspaces
-from collective.teamwork.utils import workspace_for, log_status
+from collective.teamwork.utils import get_projects, log_status
 
 
 def valid_setattr(obj, field, value):
@@ -49,6 +50,7 @@ class WorkspaceGroup(object):
 
     # class attribute defaults (for instance attributes):
     __parent__ = None
+    _members = _site_groups = _groupinfo = _names = None
 
     def __init__(self,
                  context,
@@ -72,12 +74,53 @@ class WorkspaceGroup(object):
         valid_setattr(self, schema['description'], _decode(description))
         valid_setattr(self, schema['namespace'], _decode(namespace))
         self.portal = getSite()
-        self.site_members = members or interfaces.ISiteMembers(self.portal)
-        groups = Groups(self.portal)
-        groupname = self.pas_group()[0]
-        if groupname not in groups:
-            groups.add(groupname)  # edge-case: may cause write-on-read
-        self._group = GroupInfo(groupname, members=self.site_members)
+        self._members = members
+        # PAS-backed objects are only loaded on first use (construction
+        # is cheap, and read-only); see repair() for group creation.
+
+    @property
+    def site_members(self):
+        if self._members is None:
+            if self.__parent__ is not None:
+                self._members = self.__parent__.site_members
+            else:
+                self._members = interfaces.ISiteMembers(self.portal)
+        return self._members
+
+    @property
+    def site_groups(self):
+        """IGroups for site, shared by a roster and its groups"""
+        if self._site_groups is None:
+            if self.__parent__ is not None:
+                self._site_groups = self.__parent__.site_groups
+            else:
+                self._site_groups = Groups(self.portal)
+        return self._site_groups
+
+    @property
+    def _group(self):
+        """IGroup for PAS group, or None if the group does not exist"""
+        if self._groupinfo is None:
+            groupname = self.pas_group()[0]
+            if groupname not in self.site_groups:
+                return None  # not yet created, see repair()
+            self._groupinfo = group_info(
+                groupname,
+                site=self.portal,
+                members=self.site_members,
+                )
+        return self._groupinfo
+
+    def repair(self):
+        """
+        Create PAS group for this workspace group, if missing (e.g. for
+        a group type configured after creation of the workspace).
+        Reading membership never creates groups; adding a member does.
+        """
+        groupname, title = self.pas_group()
+        if groupname not in self.site_groups:
+            self.site_groups.add(groupname, title=title)
+        return self._group
 
     @property
     def __name__(self):
@@ -88,15 +131,9 @@ class WorkspaceGroup(object):
         return '-'.join((ns, self.baseid))
 
     def _grouptitle(self):
-        r = []  # stack of object context (LIFO)
-        context = self.context
-        while getattr(context, '__parent__', None) is not None:
-            if ISiteRoot.providedBy(context):
-                break
-            r.append(context)
-            context = context.__parent__
-        titles = [o.Title() for o in reversed(r)]
-        return u'%s - %s' % (' / '.join(titles).encode('utf-8'), self.title)
+        if self._names is None:
+            self._names = workspace_group_names(self.context)
+        return self._names.grouptitle(self.title)
 
     def pas_group(self):
         return (self._groupname(), self._grouptitle())
@@ -136,13 +173,14 @@ class WorkspaceGroup(object):
         as it is expensive to list assigned group principals in the
         stock Plone group plugin (ZODBGroupManager).
         """
-        return self._group.keys()
+        group = self._group
+        return group.keys() if group is not None else []
 
     def values(self):
-        return [self._get_user(k) for k in self.keys()]
+        return self.site_members.get_many(self.keys())
 
     def items(self):
-        return [(k, self._get_user(k)) for k in self.keys()]
+        return [(user.getUserName(), user) for user in self.values()]
 
     def __len__(self):
         return len(self.keys())
@@ -155,11 +193,10 @@ class WorkspaceGroup(object):
     __iter__ = iterkeys
 
     def itervalues(self):
-        return itertools.imap(self._get_user, self.keys())
+        return iter(self.values())
 
     def iteritems(self):
-        func = lambda username: (username, self._get_user(username))  # (k,v)
-        return itertools.imap(func, self.keys())
+        return iter(self.items())
 
     # add / delete (assign/unassign) methods:
 
@@ -169,7 +206,7 @@ class WorkspaceGroup(object):
         if username not in self.site_members:
             raise RuntimeError('User %s unknown to site' % username)
         if username not in self.keys():
-            self._group.assign(username)
+            self.repair().assign(username)
             user = self.site_members.get(username)
             fullname = user.getProperty('fullname', '')
             basemsg = u'Added user %s (%s) to' % (
@@ -199,10 +236,7 @@ class WorkspaceGroup(object):
                 raise RuntimeError(msg)
         else:
             # viewers/base group:
-            parent_workspace = workspace_for(self.context.__parent__)
-            if parent_workspace:
-                parent_roster = WorkspaceRoster(parent_workspace)
-                parent_roster.add(username)
+            propagate_to_ancestors(self.context, [username])
         if msg:
             log_status(msg, self.context)
         self.refresh(username)  # invalidate keys -- membership modified.
@@ -235,7 +269,8 @@ class WorkspaceGroup(object):
         self.refresh()  # need to invalidate keys -- membership modified.
 
     def refresh(self, username=None):
-        self._group.refresh()
+        if self._group is not None:
+            self._group.refresh()
         if username is not None:
             username = self.applyTransform(username)
             userid = self.site_members.userid_for(username)
@@ -257,6 +292,8 @@ class WorkspaceRoster(WorkspaceGroup):
     implements(interfaces.IWorkspaceRoster)
     adapts(IWorkspaceContext)
 
+    _groups = None
+
     def __init__(self, context):
         self.adapts_project = IProjectContext.providedBy(context)
         self._load_config()
@@ -268,7 +305,6 @@ class WorkspaceRoster(WorkspaceGroup):
             description=self._base['description'],
             namespace=group_namespace(context),
             )
-        self._load_groups()
 
     def _load_config(self):
         self._config = config = queryUtility(interfaces.IWorkgroupTypes)
@@ -277,15 +313,27 @@ class WorkspaceRoster(WorkspaceGroup):
             self._config = dict(config.select('project', config.items))
         self._base = self._config[basename]
 
-    def _load_groups(self):
-        self.groups = {}
-        for name, group_cfg in self._config.items():
-            self.groups[name] = WorkspaceGroup(
-                self.context,
-                parent=self,
-                namespace=self.namespace,
-                members=self.site_members,
-                **group_cfg)  # title, description, groupid
+    @property
+    def groups(self):
+        """Dict of workgroup name to IWorkspaceGroup, loaded on first use"""
+        if self._groups is None:
+            self._groups = {}
+            for name, group_cfg in self._config.items():
+                self._groups[name] = WorkspaceGroup(
+                    self.context,
+                    parent=self,
+                    namespace=self.namespace,
+                    **group_cfg)  # title, description, groupid
+        return self._groups
+
+    def repair(self):
+        """
+        Create any missing PAS groups for roster and its workgroups;
+        returns IGroup for the roster.
+        """
+        for group in self.groups.values():
+            group.repair()
+        return super(WorkspaceRoster, self).repair()
 
     def can_purge(self, username):
         username = self.applyTransform(username)
@@ -302,18 +350,71 @@ class WorkspaceRoster(WorkspaceGroup):
         recursive = role is None or role == 'viewers'
         groups = self.groups.values() if recursive else [self.groups.get(role)]
         if recursive:
-            contained = get_workspaces(self.context)
-            for workspace in contained:
-                roster = interfaces.IWorkspaceRoster(workspace)
-                if username in roster:
-                    # though sub-optimal, a roster check avoids race condition
-                    # on flat workspace enumeration vs. recursive walking.
-                    roster.unassign(username)
+            self._unassign_contained(username)
         for group in groups:
             if username in group.keys():
                 group.unassign(username)
         self.refresh(username)
 
+    def _member_workspaces(self, groupnames):
+        """
+        Workspaces contained in (excluding) context with any of the
+        given PAS group names, found via the pas_groups catalog index;
+        ordered deepest first.
+        """
+        if not groupnames:
+            return []
+        catalog = getToolByName(self.context, 'portal_catalog')
+        path = '/'.join(self.context.getPhysicalPath())
+        brains = catalog.unrestrictedSearchResults({
+            'pas_groups': list(groupnames),
+            'object_provides': IWorkspaceContext.__identifier__,
+            'path': path,
+            })
+        brains = [b for b in brains if b.getPath() != path]
+        _depth = lambda b: len(b.getPath().split('/'))
+        brains.sort(key=_depth, reverse=True)
+        return [b._unrestrictedGetObject() for b in brains]
+
+    def _unassign_contained(self, username):
+        """Unassign user from all groups in contained workspaces"""
+        self._unassign_contained_many([username])
+
+    def _unassign_contained_many(self, usernames, userids=None):
+        """
+        Unassign users from all groups in contained workspaces, visiting
+        only workspaces (deepest first) with groups any of the users are
+        directly assigned to, found in one catalog query; each group is
+        written once.  No rosters are loaded, local role caches are left
+        for the caller to invalidate.  If given, userids maps user names
+        to user ids already resolved by the caller.
+        """
+        found = self.site_members.groups_for_many(usernames)
+        assigned = {}  # group name -> user names directly assigned
+        for username, groupnames in found.items():
+            for groupname in groupnames:
+                assigned.setdefault(groupname, set()).add(username)
+        workspaces = self._member_workspaces(assigned.keys())
+        removed = set()
+        for workspace in workspaces:
+            for groupname in workspace_group_names(workspace).groupnames():
+                if groupname in assigned:
+                    names = sorted(assigned[groupname])
+                    self.site_groups.get(groupname).unassign_many(
+                        names,
+                        userids,
+                        )
+                    removed.update(names)
+        if workspaces:
+            msg = (
+                'Removed user(s) %s from %s workspace(s) contained '
+                'in "%s"' % (
+                    ', '.join(sorted(removed)),
+                    len(workspaces),
+                    self.context.Title(),
+                ))
+            log_status(msg, self.context)
+
     def purge_user(self, username):
         username = self.applyTransform(username)
         if not self.can_purge(username):
@@ -328,15 +429,54 @@ class WorkspaceRoster(WorkspaceGroup):
             self.groups[self.baseid].refresh()
 
 
+# upward propagation of roster membership:
+
+def ancestor_workspaces(context):
+    """
+    Workspaces containing context (not including context), nearest
+    first, found in one walk of __parent__ up to the site root.
+    """
+    result = []
+    context = getattr(context, '__parent__', None)
+    while context is not None and not ISiteRoot.providedBy(context):
+        if IWorkspaceContext.providedBy(context):
+            result.append(context)
+        context = getattr(context, '__parent__', None)
+    return result
+
+
+def ancestor_rosters(context):
+    """IWorkspaceRoster for each of ancestor_workspaces(context)"""
+    return [WorkspaceRoster(w) for w in ancestor_workspaces(context)]
+
+
+def propagate_to_ancestors(context, usernames, userids=None):
+    """
+    Add user names to rosters of all workspaces containing context,
+    in one pass (one bulk assignment per ancestor roster lacking any
+    of them), as membership in a workspace requires membership in
+    each containing workspace.  If given, userids maps user names to
+    user ids already resolved by the caller.
+    """
+    usernames = set(usernames)
+    if not usernames:
+        return
+    for roster in ancestor_rosters(context):
+        missing = usernames - set(roster.keys())
+        if missing:
+            roster.repair().assign_many(missing, userids)
+            msg = 'Added user(s) %s to workspace "%s".' % (
+                ', '.join(sorted(missing)),
+                roster.context.Title(),
+                )
+            log_status(msg, roster.context)
+
+
 # indexer adapter for project/workspace context group names:
 
 @indexer(IWorkspaceContext)
 def workspace_pas_groups(context, **kw):
-    roster = interfaces.IWorkspaceRoster(context)
-    names = set([roster.pas_group()[0]])
-    groups = roster.groups.values()
-    names = names.union(group.pas_group()[0] for group in groups)
-    return list(names)
+    return workspace_group_names(context).groupnames()
 
 
 # bulk modification:
@@ -369,27 +509,120 @@ class MembershipModifications(object):
     def unassign(self, username, group=BASE_GROUPNAME):
         self._queue(group, username, 'planned_unassign')
 
-    def _apply_group(self, name, attr, action):
-        data = getattr(self, attr)[name]
+    def _groups(self):
+        """
+        Map of group name to IWorkspaceGroup (roster for base group) for
+        base group and groups with queued changes; all groups, if any
+        user is to be removed from the base group.
+        """
         roster = self.roster
-        group = roster if name == BASE_GROUPNAME else roster.groups[name]
-        callable = getattr(group, action)
-        for username in data:
-            callable(username)
+        if self.planned_unassign[BASE_GROUPNAME]:
+            names = set(roster.groups.keys())
+        else:
+            names = set(
+                name for name in self._config.keys()
+                if self.planned_assign[name] or self.planned_unassign[name]
+                )
+        names.add(BASE_GROUPNAME)
+        _group = lambda name: (
+            roster if name == BASE_GROUPNAME else roster.groups[name]
+            )
+        return dict((name, _group(name)) for name in names)
+
+    def plan(self):
+        """
+        Compute net changes of queued operations against current group
+        membership, as a tuple of dicts (additions, removals), each of
+        group name to set of (normalized) user names.  Assignments are
+        applied before unassignments; removal from the base group
+        implies removal from all other groups of the workspace.
+        Raises RuntimeError, before any change is made, for unknown
+        users or additions to groups of users not in the roster.
+        """
+        return self._plan()[:2]
+
+    def _plan(self):
+        """
+        plan(), also returning a dict of user name to user id for all
+        users in the plan, resolved once for use by all group writes.
+        """
+        roster = self.roster
+        _names = lambda names: set(map(roster.applyTransform, names))
+        groups = self._groups()
+        current = dict(
+            (name, set(group.keys())) for name, group in groups.items()
+            )
+        additions, removals = {}, {}
+        for name in groups:
+            assign = _names(self.planned_assign.get(name, ()))
+            unassign = _names(self.planned_unassign.get(name, ()))
+            additions[name] = assign - unassign - current[name]
+            removals[name] = unassign & current[name]
+        leaving = removals[BASE_GROUPNAME]
+        for name in groups:
+            if name != BASE_GROUPNAME:
+                additions[name] -= leaving
+                removals[name] |= current[name] & leaving
+        # validate before making any changes, all users checked at once:
+        site_members = roster.site_members
+        adding = set().union(*additions.values())
+        known = site_members.contains_many(adding)
+        for username in sorted(adding):
+            if not known.get(str(username)):
+                raise RuntimeError('User %s unknown to site' % username)
+        in_roster = (current[BASE_GROUPNAME] | additions[BASE_GROUPNAME])
+        for name, usernames in additions.items():
+            outside = usernames - in_roster
+            if outside:
+                msg = (
+                    'User(s) %s not allowed in "%s" '
+                    'without workgroup membership' % (
+                        ', '.join(sorted(outside)),
+                        name,
+                    ))
+                log_status(msg, self.context, level=logging.ERROR)
+                raise RuntimeError(msg)
+        userids = site_members.userids_for(
+            adding.union(*removals.values())
+            )
+        return additions, removals, userids
 
     def apply(self):
-        # assign first:
-        data = getattr(self, 'planned_assign')
-        self._apply_group(BASE_GROUPNAME, 'planned_assign', 'add')
-        for name in (k for k in data if k != BASE_GROUPNAME):
-            self._apply_group(name, 'planned_assign', 'add')
-        # then unassign:
-        data = getattr(self, 'planned_unassign')
-        # always base group last - removal from roster may be recursive
-        # and lead to race condition, so it must happen last.
-        for name in (k for k in data if k != BASE_GROUPNAME):
-            self._apply_group(name, 'planned_unassign', 'unassign')
-        self._apply_group(BASE_GROUPNAME, 'planned_unassign', 'unassign')
+        additions, removals, userids = self._plan()
+        roster = self.roster
+        groups = self._groups()
+        # assign first, base group (roster) before others:
+        added = additions.pop(BASE_GROUPNAME)
+        if added:
+            roster.repair().assign_many(added, userids)
+        for name, usernames in additions.items():
+            if usernames:
+                groups[name].repair().assign_many(usernames, userids)
+        # then unassign, base group last (removal is recursive):
+        leaving = removals.pop(BASE_GROUPNAME)
+        for name, usernames in removals.items():
+            if usernames:
+                groups[name]._group.unassign_many(usernames, userids)
+        if leaving:
+            roster._group.unassign_many(leaving, userids)
+            roster._unassign_contained_many(leaving, userids)
+        # propagate roster additions to all ancestor workspaces, once:
+        propagate_to_ancestors(self.context, added, userids)
+        changed = set(added) | set(leaving)
+        changed = changed.union(*(additions.values() + removals.values()))
+        if changed:
+            msg = (
+                'Membership of workspace "%s" modified: %s assignment(s), '
+                '%s unassignment(s) for %s user(s)' % (
+                    self.context.Title(),
+                    len(added) + sum(map(len, additions.values())),
+                    len(leaving) + sum(map(len, removals.values())),
+                    len(changed),
+                ))
+            log_status(msg, self.context)
+            clear_cached_localroles_many(
+                userids[str(name)] for name in changed if str(name) in userids
+                )
         # finally, reset working sets:
         self.planned_assign = self._mk_worklist()
         self.planned_unassign = self._mk_worklist()
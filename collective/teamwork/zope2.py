@@ -1,11 +1,14 @@
 from AccessControl.Permissions import add_user_folders
 from Products.PluggableAuthService import registerMultiPlugin
 
-from collective.teamwork.user import localrole
+from collective.teamwork.user import localrole, groupmanager
 from collective.teamwork.patch import patch_atct_copyrefs
 from collective.teamwork.patch import patch_atct_buildquery
+from collective.teamwork.patch import patch_pas_login_rename
+from collective.teamwork.patch import patch_pas_group_membership
 
 registerMultiPlugin(localrole.WorkspaceLocalRoleManager.meta_type)
+registerMultiPlugin(groupmanager.WorkspaceGroupManager.meta_type)
 
 
 def initialize(context):
@@ -17,6 +20,15 @@ def initialize(context):
                       localrole.manage_addEnhancedWorkspaceLRM,),
         visibility = None,
         )
+    context.registerClass(
+        groupmanager.WorkspaceGroupManager,
+        permission=add_user_folders,
+        constructors=(groupmanager.manage_addWorkspaceGroupManagerForm,
+                      groupmanager.manage_addWorkspaceGroupManager,),
+        visibility = None,
+        )
     patch_atct_copyrefs()
     patch_atct_buildquery()
+    patch_pas_login_rename()
+    patch_pas_group_membership()
 